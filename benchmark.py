@@ -0,0 +1,352 @@
+from PIL import Image
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import datetime
+import platform
+import tempfile
+import tracemalloc
+import resource
+import statistics
+import json
+import time
+import io
+import os
+import sys
+import click
+
+SIZES = [ 256, 1024, 4096, 16384 ]
+LINEAR_MODES = [ 'lossless', 'lossy', 'jpeg' ]
+IMAGEMATH_MODES = [ 'naive', 'full' ]
+# Relative increase above which a measurement is flagged by `compare`
+DEFAULT_THRESHOLD = 0.10
+METRICS = [ 'wall_s', 'rss_increase', 'allocated' ]
+
+
+def synthetic_image(size, seed):
+    # Smooth gradients with some noise on top, closer to a photograph than pure noise and still reproducible
+    rng = np.random.default_rng(seed)
+    y, x = np.ogrid[:size, :size]
+    base = np.empty((size, size, 3), dtype=np.uint8)
+    for channel in range(3):
+        phase = rng.integers(0, 256)
+        base[:, :, channel] = (x * (channel + 1) + y * (3 - channel) + phase) * 255 // (4 * size) % 256
+    base += rng.integers(0, 16, size=base.shape, dtype=np.uint8)
+    return Image.fromarray(base, mode='RGB')
+
+
+def secret_size(size):
+    # Small enough to fit with every method, including lossless
+    return max(size // 4, 8)
+
+
+def cases(engines, sizes, bits):
+    for size in sizes:
+        if 'linear' in engines:
+            for mode in LINEAR_MODES:
+                for noise in (False, True):
+                    yield dict(engine='linear', mode=mode, noise=noise, size=size)
+            for n in bits:
+                for noise in (False, True):
+                    yield dict(engine='linear', mode='bitplane-n{}'.format(n), noise=noise, size=size)
+        for engine in ('imagemath', 'lut'):
+            if engine in engines:
+                for mode in IMAGEMATH_MODES:
+                    for n in bits:
+                        yield dict(engine=engine, mode='{}-n{}'.format(mode, n), noise=False, size=size)
+        if 'pil' in engines:
+            yield dict(engine='pil', mode='png', noise=False, size=size)
+
+
+def case_key(result):
+    return (result['engine'], result['mode'], result['noise'], result['size'], result['stage'])
+
+
+# Memory measurement helpers. Linux allows resetting the RSS high water mark, elsewhere we use the lifetime peak.
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def _stage_function(case, stage, paths):
+    # Returns a function running the measured operation on already loaded inputs, and the inputs
+    engine, mode = case['engine'], case['mode']
+    if engine == 'pil':
+        if stage == 'decode':
+            def decode():
+                image = Image.open(paths['base'])
+                image.load()
+                return image
+            return decode
+        base = Image.open(paths['base'])
+        base.load()
+        return lambda: base.save(io.BytesIO(), format='png')
+
+    if stage == 'hide':
+        base, secret = Image.open(paths['base']), Image.open(paths['secret'])
+        base.load()
+        secret.load()
+    else:
+        base = Image.open(paths['hidden'])
+        base.load()
+
+    if engine in ('imagemath', 'lut'):
+        import stegano
+        naive_merge, full_merge, unmerge = stegano.BACKENDS[engine]
+        merge_name, n = mode.split('-n')
+        n = int(n)
+        if stage == 'hide':
+            merge = full_merge if merge_name == 'full' else naive_merge
+            return lambda: merge(base, secret, n)
+        return lambda: unmerge(base, n)
+
+    from linear_encoding_methods import METHODS, make_encoder
+    name, _, n = mode.partition('-n')
+    encoder = make_encoder(METHODS[name], bits=int(n or 4), threads=case.get('threads'))
+    if stage == 'hide':
+        return lambda: encoder.hide(base, secret, add_noise=case['noise'], engrave_method=True)
+    return lambda: encoder.reveal(base)
+
+
+def _cold():
+    # Every measured run prepares its payload (see linear_payloads.py), as the first hide of a secret does,
+    # otherwise the JPEG and compressed cases would time cache hits after the first repeat
+    payloads = sys.modules.get('linear_payloads')
+    if payloads is not None:
+        payloads.payload_cache.clear()
+
+
+def measure(case, stage, paths, repeat):
+    # Runs in a fresh process so that memory figures are not polluted by the previous cases
+    import logging
+    run = _stage_function(case, stage, paths)
+    # The stages log at the info level, which is not part of what is measured
+    logging.getLogger().setLevel(logging.WARNING)
+
+    timings = []
+    for _ in range(repeat):
+        _cold()
+        start = time.perf_counter()
+        output = run()
+        timings.append(time.perf_counter() - start)
+        del output
+
+    _cold()
+    _reset_peak_rss()
+    rss_before = _peak_rss()
+    tracemalloc.start()
+    output = run()
+    _, allocated = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    peak_rss = _peak_rss()
+
+    if stage == 'hide' and case['engine'] != 'pil':
+        # The reveal stage of the same case works on this output
+        output.save(paths['hidden'], compress_level=1)
+
+    return dict(case, stage=stage, repeat=repeat, wall_s=statistics.median(timings), wall_min_s=min(timings),
+                peak_rss=peak_rss, rss_increase=max(peak_rss - rss_before, 0), allocated=allocated)
+
+
+def _run_isolated(*args):
+    # A new interpreter per measurement, numpy and PIL imports are not part of the measured time
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(measure, *args).result()
+
+
+def environment(seed):
+    import PIL
+    return dict(
+        date=datetime.datetime.now().isoformat(timespec='seconds'),
+        python=platform.python_version(),
+        numpy=np.__version__,
+        pillow=PIL.__version__,
+        platform=platform.platform(),
+        machine=platform.machine(),
+        cpu_count=os.cpu_count(),
+        seed=seed,
+    )
+
+
+def run_benchmarks(engines, sizes, bits, repeat, seed, workdir):
+    workdir = Path(workdir)
+    results = []
+    for size in sizes:
+        paths = dict(base=str(workdir / 'base_{}.png'.format(size)), secret=str(workdir / 'secret_{}.png'.format(size)))
+        synthetic_image(size, seed).save(paths['base'], compress_level=1)
+        synthetic_image(secret_size(size), seed + 1).save(paths['secret'], compress_level=1)
+        for case in cases(engines, [size], bits):
+            stages = ('decode', 'encode') if case['engine'] == 'pil' else ('hide', 'reveal')
+            case_paths = dict(paths, hidden=str(workdir / 'hidden_{engine}_{mode}_{noise}_{size}.png'.format(**case)))
+            for stage in stages:
+                result = _run_isolated(case, stage, case_paths, repeat)
+                click.echo('{engine:>9} {mode:>9} noise={noise!s:5} {size:>6}² {stage:>6}: '
+                           '{wall_s:8.4f}s RSS +{rss_increase:>13,d} B allocated {allocated:>13,d} B'.format(**result))
+                results.append(result)
+    return results
+
+
+def thread_counts(maximum):
+    # 1, 2, 4... up to `maximum` included
+    counts = [1]
+    while counts[-1] * 2 < maximum:
+        counts.append(counts[-1] * 2)
+    return counts + [maximum] if maximum > 1 else counts
+
+
+def run_scaling(modes, size, threads, repeat, seed, workdir):
+    # Same measurements as run_benchmarks for the linear engine, with an increasing number of kernel threads
+    workdir = Path(workdir)
+    paths = dict(base=str(workdir / 'base_{}.png'.format(size)), secret=str(workdir / 'secret_{}.png'.format(size)))
+    synthetic_image(size, seed).save(paths['base'], compress_level=1)
+    synthetic_image(secret_size(size), seed + 1).save(paths['secret'], compress_level=1)
+    results = []
+    for mode in modes:
+        for noise in (False, True):
+            reference = dict()
+            for count in thread_counts(threads):
+                case = dict(engine='linear', mode=mode, noise=noise, size=size, threads=count)
+                case_paths = dict(paths, hidden=str(workdir / 'hidden_{}_{}_{}.png'.format(mode, noise, count)))
+                for stage in ('hide', 'reveal'):
+                    result = _run_isolated(case, stage, case_paths, repeat)
+                    reference.setdefault(stage, result['wall_s'])
+                    result['speedup'] = reference[stage] / result['wall_s']
+                    click.echo('{mode:>11} noise={noise!s:5} {size:>6}² {stage:>6} threads={threads:<3}: '
+                               '{wall_s:8.4f}s speed-up x{speedup:.2f}'.format(**result))
+                    results.append(result)
+    return results
+
+
+def _timed(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        _cold()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def run_writers(writers, sizes, repeat, seed, workdir):
+    # Time against size of each output writer, on hidden images with and without noise, and the time taken to
+    # reveal from the written file
+    from linear_encoding_methods import LosslessEncoder
+    from linear_writers import save_image, writer_for
+    from linear_io import open_base
+    workdir = Path(workdir)
+    encoder = LosslessEncoder()
+    results = []
+    for size in sizes:
+        base, secret = synthetic_image(size, seed), synthetic_image(secret_size(size), seed + 1)
+        for noise in (False, True):
+            hidden = encoder.hide(base, secret, add_noise=noise, engrave_method=True)
+            for writer in writers:
+                _, output = writer_for(workdir / 'hidden_{}_{}'.format(size, noise), writer)
+                write_s = _timed(lambda: save_image(hidden, output, writer), repeat)
+                reveal_s = _timed(lambda: encoder.reveal(open_base(output)), repeat)
+                result = dict(writer=writer, size=size, noise=noise, repeat=repeat, write_s=write_s, reveal_s=reveal_s,
+                              bytes=os.path.getsize(output), ratio=os.path.getsize(output) / (size * size * 3))
+                click.echo('{writer:>10} noise={noise!s:5} {size:>6}²: write {write_s:8.4f}s reveal {reveal_s:8.4f}s '
+                           '{bytes:>13,d} B ({ratio:.1%} of raw)'.format(**result))
+                results.append(result)
+    return results
+
+
+def compare_results(baseline, current, threshold):
+    # Yields (key, metric, baseline value, current value, relative change) for every regression
+    reference = { case_key(r): r for r in baseline['results'] }
+    for result in current['results']:
+        previous = reference.get(case_key(result))
+        if previous is None:
+            continue
+        for metric in METRICS:
+            before, after = previous[metric], result[metric]
+            if before > 0 and (after - before) / before > threshold:
+                yield case_key(result), metric, before, after, (after - before) / before
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--output', required=True, type=click.Path(dir_okay=False), help='JSON file receiving the results')
+@click.option('--engine', 'engines', multiple=True, type=click.Choice(['linear', 'imagemath', 'lut', 'pil']), default=['linear', 'imagemath', 'lut', 'pil'], help='Engines to benchmark, can be repeated. imagemath and lut are the two backends of stegano.py')
+@click.option('--size', 'sizes', multiple=True, type=int, default=SIZES, help='Side of the square base images, can be repeated')
+@click.option('-n', 'bits', multiple=True, type=int, default=[4], help='Number of bits used by the ImageMath engine and the bitplane method, can be repeated')
+@click.option('--repeat', type=int, default=3, help='Number of timed runs per measurement, the median is kept')
+@click.option('--seed', type=int, default=0, help='Seed of the synthetic images')
+@click.option('--workdir', type=click.Path(file_okay=False), default=None, help='Where to store the generated images. Defaults to a temporary directory')
+def run(output, engines, sizes, bits, repeat, seed, workdir):
+    with tempfile.TemporaryDirectory() as tmp:
+        results = run_benchmarks(engines, sorted(sizes), bits, repeat, seed, workdir or tmp)
+    with open(output, 'w') as f:
+        json.dump(dict(environment=environment(seed), results=results), f, indent=2)
+
+
+@cli.command()
+@click.option('--output', required=True, type=click.Path(dir_okay=False), help='JSON file receiving the results')
+@click.option('--mode', 'modes', multiple=True, default=['lossless', 'lossy', 'bitplane-n3'], help='Linear modes to measure, can be repeated')
+@click.option('--size', type=int, default=8192, help='Side of the square base image')
+@click.option('--threads', type=int, default=os.cpu_count(), help='Largest number of threads, powers of two are measured up to it')
+@click.option('--repeat', type=int, default=3, help='Number of timed runs per measurement, the median is kept')
+@click.option('--seed', type=int, default=0, help='Seed of the synthetic images')
+@click.option('--workdir', type=click.Path(file_okay=False), default=None, help='Where to store the generated images. Defaults to a temporary directory')
+def scaling(output, modes, size, threads, repeat, seed, workdir):
+    with tempfile.TemporaryDirectory() as tmp:
+        results = run_scaling(modes, size, threads, repeat, seed, workdir or tmp)
+    with open(output, 'w') as f:
+        json.dump(dict(environment=environment(seed), results=results), f, indent=2)
+
+
+@cli.command()
+@click.option('--output', required=True, type=click.Path(dir_okay=False), help='JSON file receiving the results')
+@click.option('--writer', 'writers', multiple=True, default=None, help='Writers to measure, can be repeated. Defaults to all of them')
+@click.option('--size', 'sizes', multiple=True, type=int, default=[1024, 4096], help='Side of the square base images, can be repeated')
+@click.option('--repeat', type=int, default=3, help='Number of timed runs per measurement, the median is kept')
+@click.option('--seed', type=int, default=0, help='Seed of the synthetic images')
+@click.option('--workdir', type=click.Path(file_okay=False), default=None, help='Where to store the written images. Defaults to a temporary directory')
+def writers(output, writers, sizes, repeat, seed, workdir):
+    from linear_writers import WRITERS
+    with tempfile.TemporaryDirectory() as tmp:
+        results = run_writers(writers or list(WRITERS), sorted(sizes), repeat, seed, workdir or tmp)
+    with open(output, 'w') as f:
+        json.dump(dict(environment=environment(seed), results=results), f, indent=2)
+
+
+@cli.command()
+@click.argument('baseline', type=click.Path(exists=True, dir_okay=False))
+@click.argument('current', type=click.Path(exists=True, dir_okay=False))
+@click.option('--threshold', type=float, default=DEFAULT_THRESHOLD, help='Relative increase flagged as a regression')
+def compare(baseline, current, threshold):
+    with open(baseline) as f:
+        baseline = json.load(f)
+    with open(current) as f:
+        current = json.load(f)
+    regressions = list(compare_results(baseline, current, threshold))
+    for key, metric, before, after, change in regressions:
+        click.echo('REGRESSION {} {}: {:.6g} -> {:.6g} (+{:.1%})'.format('/'.join(map(str, key)), metric, before, after, change))
+    click.echo('{} regression(s) above {:.0%}'.format(len(regressions), threshold))
+    if regressions:
+        exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,210 @@
+from PIL import Image
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import namedtuple
+import csv
+import json
+import logging
+import os
+import time
+from linear_encoding_methods import choose_encoder, read_encoder, revealed_output, reveals_bytes
+from linear_io import open_base
+from linear_writers import writer_for, save_image
+from linear_fit import FIT_METHODS, best_fit
+
+IMAGE_EXTENSIONS = { '.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.gif', '.webp' }
+
+# `secret` is None for reveal jobs
+Job = namedtuple('Job', ['base', 'secret', 'output'])
+JobResult = namedtuple('JobResult', ['job', 'output', 'error', 'read_bytes', 'written_bytes', 'timings'])
+
+
+def _image_files(directory):
+    return sorted(p for p in Path(directory).iterdir() if p.is_file() and p.suffix.lower() in IMAGE_EXTENSIONS)
+
+
+def jobs_from_directories(base_dir, secret_dir, output_dir, suffix):
+    # Bases and secrets are paired by file name (without extension)
+    output_dir = Path(output_dir)
+    bases = { p.stem: p for p in _image_files(base_dir) }
+    if secret_dir is None:
+        return [Job(str(p), None, str(output_dir / '{}_{}.png'.format(stem, suffix))) for stem, p in bases.items()]
+    secrets = { p.stem: p for p in _image_files(secret_dir) }
+    for stem in sorted(bases.keys() ^ secrets.keys()):
+        logging.warning('No matching base/secret pair for {}, skipping it'.format(stem))
+    return [
+        Job(str(bases[stem]), str(secrets[stem]), str(output_dir / '{}_{}.png'.format(stem, suffix)))
+        for stem in sorted(bases.keys() & secrets.keys())
+    ]
+
+
+def jobs_from_manifest(manifest, output_dir, suffix):
+    # A manifest is either a CSV file with a header or a JSON-lines file, both with keys base, secret and output.
+    # Relative paths are resolved against the manifest location, a missing output falls back to `output_dir`.
+    manifest = Path(manifest)
+    root = manifest.parent
+    with open(manifest, newline='') as f:
+        if manifest.suffix.lower() in ('.jsonl', '.json', '.ndjson'):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+
+    def resolve(value):
+        if not value:
+            return None
+        return str(root / value) if not Path(value).is_absolute() else value
+
+    jobs = []
+    for row in rows:
+        base, secret, output = resolve(row.get('base')), resolve(row.get('secret')), resolve(row.get('output'))
+        if output is None:
+            output = str(Path(output_dir) / '{}_{}.png'.format(Path(base).stem, suffix))
+        jobs.append(Job(base, secret, output))
+    return jobs
+
+
+def _init_worker(log_level):
+    # Workers are long lived, logging is configured once per process instead of once per file
+    logging.getLogger().setLevel(log_level)
+
+
+# Stages of a job. Each stage returns its timing so that the summary can tell where time goes.
+def _decode(job, options):
+    start = time.perf_counter()
+    base_image = open_base(job.base)
+    secret_image = None
+    if job.secret is not None and isinstance(base_image, Image.Image):
+        # Reveal only decodes the rows of the base holding the payload, hide needs all of them
+        base_image.load()
+    read_bytes = os.path.getsize(job.base)
+    if job.secret is not None and options.get('use_method') == 'bytes':
+        # Files are read by the encoder itself, chunk by chunk
+        secret_image = job.secret
+        read_bytes += os.path.getsize(job.secret)
+    elif job.secret is not None:
+        secret_image = Image.open(job.secret)
+        secret_image.load()
+        read_bytes += os.path.getsize(job.secret)
+    return base_image, secret_image, read_bytes, time.perf_counter() - start
+
+
+def _hide(base_image, secret_image, options):
+    if options.get('fit', 'none') == 'best':
+        use_method = options['use_method']
+        result = best_fit(base_image, secret_image, tuple(FIT_METHODS) if use_method == 'auto' else (use_method, ))
+        return result.encoder, result.encoder.hide(base_image, result.secret, add_noise=options['fill_with_noise'], engrave_method=True)
+    encoder = choose_encoder(base_image, secret_image, options['use_method'], options.get('compression', 'none'),
+                             options.get('compression_level'), **options.get('encoder_options', dict()))
+    return encoder, encoder.hide(base_image, secret_image, add_noise=options['fill_with_noise'], engrave_method=True)
+
+
+def _reveal(base_image, options):
+    encoder = read_encoder(base_image)
+    if encoder is None:
+        raise ValueError('No hiding method could be detected in the image')
+    if reveals_bytes(encoder):
+        # JPEG and files are written as they were hidden, without being decoded
+        return encoder, encoder.reveal_bytes(base_image)
+    return encoder, encoder.reveal(base_image)
+
+
+def _output(action, encoder, job, options):
+    # Output path and writer of a job. Images go through the writer of the options (see linear_writers.py),
+    # revealed JPEG and files are written as they are, to the path revealed_output gives.
+    output = job.output if action == 'hide' else revealed_output(encoder, job.output)
+    if action == 'reveal' and reveals_bytes(encoder):
+        return output, None
+    writer, output = writer_for(output, options.get('writer'))
+    return output, writer
+
+
+def _encode(image, output, writer):
+    start = time.perf_counter()
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    if writer is None:
+        # Revealed JPEG and files, a memoryview over the revealed bytes
+        with open(output, 'wb') as f:
+            f.write(image)
+    else:
+        save_image(image, output, writer)
+    return os.path.getsize(output), time.perf_counter() - start
+
+
+def process_job(action, job, options):
+    # Decodes, processes and encodes a single job on the calling thread. Returns a JobResult and the encoder used,
+    # errors being reported in the result.
+    try:
+        base_image, secret_image, read_bytes, decode_time = _decode(job, options)
+        start = time.perf_counter()
+        if action == 'hide':
+            encoder, image = _hide(base_image, secret_image, options)
+        else:
+            encoder, image = _reveal(base_image, options)
+        output, writer = _output(action, encoder, job, options)
+        process_time = time.perf_counter() - start
+        written_bytes, encode_time = _encode(image, output, writer)
+    except Exception as e:
+        return JobResult(job, None, '{}: {}'.format(type(e).__name__, e), 0, 0, dict()), None
+    timings = { 'decode': decode_time, action: process_time, 'encode': encode_time }
+    return JobResult(job, output, None, read_bytes, written_bytes, timings), encoder
+
+
+def run_chunk(action, jobs, options):
+    # Runs a few jobs in a worker process, two at a time through `process_job`: while one job is being hidden or
+    # revealed, the other one is decoded or encoded. PIL decoding, numpy operations and zlib all release the GIL so
+    # the jobs do overlap. Results are in the order of `jobs`.
+    with ThreadPoolExecutor(max_workers=2) as stages:
+        return [ result for result, _ in stages.map(lambda job: process_job(action, job, options), jobs) ]
+
+
+def run_batch(action, jobs, options, workers=None, chunk_size=4, log_level=logging.WARNING):
+    # Yields one JobResult per job, in completion order. Failures are reported as results, not raised.
+    workers = workers or os.cpu_count()
+    chunks = [jobs[i:i + chunk_size] for i in range(0, len(jobs), chunk_size)]
+    pending = dict()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(log_level, )) as pool:
+        # Keep a bounded amount of work in flight so that results stream back while the pool stays busy
+        while chunks or pending:
+            while chunks and len(pending) < workers * 2:
+                chunk = chunks.pop(0)
+                pending[pool.submit(run_chunk, action, chunk, options)] = chunk
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk = pending.pop(future)
+                try:
+                    results = future.result()
+                except Exception as e:
+                    # The worker itself died, every job of the chunk is lost
+                    results = [JobResult(job, None, '{}: {}'.format(type(e).__name__, e), 0, 0, dict()) for job in chunk]
+                yield from results
+
+
+class BatchSummary:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.succeeded = 0
+        self.failed = []
+        self.read_bytes = 0
+        self.written_bytes = 0
+        self.timings = dict()
+
+    def add(self, result):
+        self.read_bytes += result.read_bytes
+        self.written_bytes += result.written_bytes
+        for stage, seconds in result.timings.items():
+            self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+        if result.error is None:
+            self.succeeded += 1
+        else:
+            self.failed.append(result)
+
+    def lines(self):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        total = self.succeeded + len(self.failed)
+        megabytes = (self.read_bytes + self.written_bytes) / 1e6
+        yield 'Processed {} images ({} ok, {} failed) in {:.2f}s'.format(total, self.succeeded, len(self.failed), elapsed)
+        yield 'Throughput: {:.2f} images/s, {:.2f} MB/s ({:.1f} MB read, {:.1f} MB written)'.format(
+            self.succeeded / elapsed, megabytes / elapsed, self.read_bytes / 1e6, self.written_bytes / 1e6)
+        if self.timings:
+            yield 'Time spent per stage (summed over workers): {}'.format(
+                ', '.join('{} {:.2f}s'.format(stage, seconds) for stage, seconds in self.timings.items()))
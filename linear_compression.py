@@ -0,0 +1,82 @@
+import numpy as np
+import tempfile
+import zlib
+import bz2
+import lzma
+
+# Compression stage of the payloads, see CompressedEncoder.
+# Codecs are identified in the header by a nibble, the level by another one.
+# Compressed data is spooled to a temporary file past SPOOL_SIZE and decompressed as a stream.
+CODEC_IDS = { 'zlib': 1, 'bz2': 2, 'lzma': 3 }
+CODEC_NAMES = { value: name for name, value in CODEC_IDS.items() }
+DEFAULT_LEVELS = { 'zlib': 6, 'bz2': 9, 'lzma': 6 }
+# Candidates of the `auto` setting, fastest first
+AUTO_CODECS = [ ('zlib', 1), ('zlib', 9), ('bz2', 9), ('lzma', 9) ]
+SPOOL_SIZE = 64 << 20
+
+
+def compressor(codec, level):
+    if codec == 'zlib':
+        return zlib.compressobj(level)
+    if codec == 'bz2':
+        return bz2.BZ2Compressor(max(level, 1))
+    if codec == 'lzma':
+        return lzma.LZMACompressor(preset=level)
+    raise ValueError('Unknown codec {}'.format(codec))
+
+
+def decompressor(codec):
+    if codec == 'zlib':
+        return zlib.decompressobj()
+    if codec == 'bz2':
+        return bz2.BZ2Decompressor()
+    if codec == 'lzma':
+        return lzma.LZMADecompressor()
+    raise ValueError('Unknown codec {}'.format(codec))
+
+
+def compress_chunks(chunks, codec, level, spool_size=SPOOL_SIZE):
+    # Compresses the byte chunks (arrays or bytes) into a file object positioned at its start.
+    # Returns the file object and the number of compressed and raw bytes.
+    spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    engine = compressor(codec, level)
+    raw_size = 0
+    for chunk in chunks:
+        raw_size += chunk.nbytes if isinstance(chunk, np.ndarray) else len(chunk)
+        spool.write(engine.compress(chunk))
+    spool.write(engine.flush())
+    length = spool.tell()
+    spool.seek(0)
+    return spool, length, raw_size
+
+
+class Inflater:
+    # Decompresses a stream of compressed chunks on demand, never holding more than the requested bytes
+    def __init__(self, chunks, codec):
+        self.chunks = iter(chunks)
+        self.codec = codec
+        self.engine = decompressor(codec)
+        self.tail = b''
+
+    def _pull(self, size):
+        if self.codec == 'zlib':
+            data = self.tail or next(self.chunks, b'')
+            out = self.engine.decompress(data, size)
+            self.tail = self.engine.unconsumed_tail
+        else:
+            data = next(self.chunks, b'') if self.engine.needs_input else b''
+            out = self.engine.decompress(data, size)
+        return data, out
+
+    def readinto(self, out):
+        # Fills the flat uint8 array `out` entirely
+        filled = 0
+        while filled < out.size:
+            if self.engine.eof:
+                raise ValueError('The hidden data ends {} bytes too early'.format(out.size - filled))
+            data, chunk = self._pull(out.size - filled)
+            if not len(data) and not chunk:
+                raise ValueError('The hidden data is truncated')
+            out[filled:filled + len(chunk)] = np.frombuffer(chunk, dtype=np.uint8)
+            filled += len(chunk)
+        return filled
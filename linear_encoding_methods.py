@@ -2,52 +2,260 @@ from PIL import Image
 import numpy as np
 import io
 import abc
-from linear_utils import np8_to_number_16, len_to_np8_16, np8_to_number_32, len_to_np8_32
+import inspect
+import zlib
+import json
+from linear_utils import np8_to_number_16, len_to_np8_16, np8_to_number_32, len_to_np8_32, number_to_nibbles, nibbles_to_number
+from linear_io import image_shape, image_dtype, check_base, array_image, iter_bands, iter_chunks, file_length, RawStreamWriter, FILE_CHUNK_SIZE, BAND_ROWS, read_rows
+from linear_payloads import PreparedPayload, prepare
+from linear_compression import CODEC_IDS, CODEC_NAMES, DEFAULT_LEVELS, AUTO_CODECS, compress_chunks, Inflater
+from linear_profile import stage
+from linear_writers import stream_writer
+from linear_scatter import ScatterLayout, BLOCK_SIZE
+from linear_kernels import load_array, lsb_values, clear_lsb, write_nibbles, read_nibbles, split_into, join_into, shift_into, unshift_into, fill_noise, pack_bits, unpack_bits
 
 # TODO: Better method encoding scheme
 METHOD_LOSSLESS = 0x01
 METHOD_LOSSY    = 0x02
+METHOD_BITPLANE = 0x04
+METHOD_BYTES    = 0x05
+METHOD_COMPRESSED = 0x06
+METHOD_TILED = 0x07
+METHOD_MULTI = 0x08
+
+# Secret modes supported by the extended encoders, by number of bands
+SECRET_MODES = { 1: 'L', 3: 'RGB', 4: 'RGBA' }
+# Version of the tiled container, and default size of its tiles (see TiledEncoder)
+TILED_VERSION = 1
+TILE_SIZE = 256
 
 import logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s.%(msecs)03d %(funcName)18s: %(message)s',
-)
 
 class BaseEncoder(abc.ABC):
     value = None
     header_size = -1
+    # Number of LSB of each value used by the payload. The header always uses 4.
+    bits = 4
+    # Number of threads of the kernels, None for the default of linear_kernels.set_threads
+    threads = None
+    # Writer of the images revealed band by band (reveal_to, streaming), see linear_writers.py
+    writer = 'png'
+    # With a key, the hidden data is scattered over the whole base by blocks of `block_size`, see linear_scatter.py
+    key = None
+    block_size = BLOCK_SIZE
+    # Whether the secret is a single image whose hidden size follows its dimensions, see the resize options
+    image_secret = True
 
     @classmethod
     def can_fit(cls, base, secret):
         available_size = cls.available_hidden_size(base)
         needed_size = cls.needed_hidden_size(secret)
-        logging.info(f'Needed size is {needed_size} and avaiable is {available_size}')
-        logging.info(f'Can fit? {needed_size <= available_size}')
-        logging.info(f'File dimensions are:')
-        logging.info(f'Base image: {base.size}')
-        logging.info(f'Secret image: {secret.size}')
+        logging.debug(f'{cls.__name__}: needed size is {needed_size} and available is {available_size}')
         return needed_size <= available_size
 
     @staticmethod
     def available_hidden_size(base):
-        logging.info('Using base class hidden size information')
-        # All pixels can be used
-        return base.width * base.height * 3
+        # Every sample of every band can be used, whatever its type (see sample_bits), frame sources (see
+        # linear_frames.py) know their capacity
+        if hasattr(base, 'capacity'):
+            return base.capacity
+        height, width, bands = image_shape(base)
+        return height * width * bands
 
     @staticmethod
     @abc.abstractmethod
     def needed_hidden_size(secret):
         raise NotImplementedError('Not for the base class')
 
+    # The hidden data is laid out as a flat stream of nibbles: the header, then the payload.
+    # Encoders describe that layout with the methods below, so that it can be written all at once
+    # or band by band (see linear_streaming.py).
+    @abc.abstractmethod
+    def _write_header(self, flat, shape):
+        raise NotImplementedError('Not for the base class')
+
+    @abc.abstractmethod
+    def _read_header(self, flat):
+        # Returns the shape of the payload
+        raise NotImplementedError('Not for the base class')
+
+    @abc.abstractmethod
+    def _payload_end(self, shape):
+        # Index of the first nibble after the payload
+        raise NotImplementedError('Not for the base class')
+
     @abc.abstractmethod
-    def hide(self, base, secret, add_noise, engrave_method):
+    def _write_band(self, flat, band, top, shape, scratch=None):
+        # `band` holds the rows [top, top + len(band)) of a payload of `shape`, `flat` has its LSB cleared
         raise NotImplementedError('Not for the base class')
 
     @abc.abstractmethod
-    def reveal(self, base):
+    def _read_band(self, flat, out, top, shape, scratch=None):
+        # Inverse of `_write_band`, fills `out` with the rows [top, top + len(out)) of the payload
         raise NotImplementedError('Not for the base class')
 
+    @staticmethod
+    def _rgb_secret(secret):
+        # The lossless and lossy layouts hold 3 channels: images are converted to RGB, arrays keep their first 3
+        if isinstance(secret, Image.Image):
+            return secret if secret.mode == 'RGB' else secret.convert('RGB')
+        return secret[:, :, :3]
+
+    def _payload(self, secret):
+        return np.ascontiguousarray(self._rgb_secret(secret))
+
+    def _revealed(self, payload):
+        return Image.fromarray(payload, mode='RGB')
+
+    def _payload_bands(self, secret, band_rows):
+        # Shape of the payload and an iterator over its (top, rows) bands, used when streaming
+        secret = self._rgb_secret(secret)
+        return image_shape(secret), iter_bands(secret, band_rows)
+
+    def _payload_writer(self, output, shape):
+        return stream_writer(self.writer, output, (shape[0], shape[1], 3))
+
+    def _clear(self, flat, start, end, offset=0):
+        # Clears the LSB used in flat[start:end], `offset` being the index of flat[0] in the whole base
+        split = min(max(self.header_size - offset, start), end)
+        clear_lsb(flat, start, split, threads=self.threads)
+        clear_lsb(flat, split, end, self.bits, self.threads)
+
+    def _construct(self, a, b, add_noise=False, out=None, scratch=None):
+        return self._construct_bands(a, b.shape, [(0, b)], add_noise, out, scratch)
+
+    def _construct_bands(self, a, shape, bands, add_noise=False, out=None, scratch=None):
+        # Everything happens in `out`, which can be `a` itself to work fully in place.
+        # `bands` yields the (top, rows) of a payload of `shape`, see `_payload_bands`.
+        end = self._payload_end(shape)
+        assert a.size >= end
+        out = a.copy('C') if out is None else out
+        if out is not a:
+            np.copyto(out, a)
+        flat = lsb_values(out)
+
+        # Discard the LSB from the fake up until the last fake data
+        self._clear(flat, 0, flat.size if add_noise else end)
+        self._write_header(flat, shape)
+        # Put the hidden data in target
+        for top, band in bands:
+            self._write_band(flat, band, top, shape, scratch)
+        if add_noise:
+            fill_noise(flat, end, bits=self.bits, threads=self.threads)
+        return out
+
+    def _construct_scattered(self, a, shape, bands, add_noise=False, engrave_method=True, scratch=None):
+        # Same as _construct_bands in place, the nibble stream being built in the blocks of `a` given by the key.
+        # With noise every block is gathered, so that the noise of the stream fills the blocks it does not use.
+        flat = a.reshape(-1)
+        layout = ScatterLayout(self.key, flat.size, self.block_size)
+        end = self._payload_end(shape)
+        assert end <= layout.capacity, 'Needed size is {} and available is {} with the key'.format(end, layout.capacity)
+        stream = layout.gather(flat, layout.capacity if add_noise else end, self.threads)
+        self._construct_bands(stream, shape, bands, add_noise, out=stream, scratch=scratch)
+        if engrave_method:
+            write_nibbles(lsb_values(stream), 8, [self.value])
+        if add_noise:
+            # Samples past the last block
+            values = lsb_values(a)
+            clear_lsb(values, layout.capacity, values.size, self.bits, self.threads)
+            fill_noise(values, layout.capacity, bits=self.bits, threads=self.threads)
+        layout.scatter(flat, stream, self.threads)
+        return a
+
+    def _reconstruct(self, a, out=None, scratch=None):
+        flat = a.reshape(-1)
+        shape = self._read_header(flat)
+        if out is None:
+            out = np.empty(shape, dtype=np.uint8)
+        self._read_band(flat, out, 0, shape, scratch)
+        return shape, out
+
+    def hide(self, base, secret, add_noise, engrave_method, out=None, scratch=None):
+        with stage('payload') as s:
+            b = self._payload(secret)
+            s.nbytes = b.nbytes
+        return self._hide_bands(base, b.shape, [(0, b)], add_noise, engrave_method, out, scratch)
+
+    def _hide_bands(self, base, shape, bands, add_noise, engrave_method, out=None, scratch=None):
+        # The stages of hide once the payload is prepared, see linear_profile.py
+        with stage('asarray') as s:
+            a = load_array(check_base(base), out)
+            s.nbytes = a.nbytes
+        with stage('construct', a.nbytes):
+            if self.key is not None:
+                fake_data = self._construct_scattered(a, shape, bands, add_noise, engrave_method, scratch)
+            else:
+                fake_data = self._construct_bands(a, shape, bands, add_noise, out=a, scratch=scratch)
+                if engrave_method:
+                    write_nibbles(lsb_values(fake_data), 8, [self.value])
+        with stage('fromarray', fake_data.nbytes):
+            # The base keeps its mode, 16 bits bases with several bands are returned as arrays
+            return array_image(fake_data)
+
+    def _payload_values(self, base, end_of=None):
+        # The values of `base` up to the end of the payload, as a flat array.
+        # The header is read first so that only the rows holding the payload are decoded (or copied).
+        # `end_of(shape)` can end the values before the end of the payload, when only a part of it is needed.
+        end_of = self._payload_end if end_of is None else end_of
+        if self.key is not None:
+            return self._scattered_values(base, end_of)
+        height, width, channels = image_shape(base)
+        row_size = width * channels
+        shape = self._read_header(lsb_values(read_rows(base, -(-self.header_size // row_size))))
+        end = end_of(shape)
+        assert end <= height * row_size, 'The header is corrupted, the payload would not fit in the base'
+        return lsb_values(read_rows(base, -(-end // row_size)))
+
+    def _scattered_values(self, base, end_of):
+        # Same as _payload_values with a key. The whole base is read, the stream being spread over it.
+        flat = _base_values(base)
+        layout = ScatterLayout(self.key, flat.size, self.block_size)
+        shape = self._read_header(lsb_values(layout.gather(flat, self.header_size)))
+        end = end_of(shape)
+        assert end <= layout.capacity, 'The header is corrupted, the payload would not fit in the base'
+        return lsb_values(layout.gather(flat, end, self.threads))
+
+    def reveal(self, base, out=None, scratch=None):
+        # Decoding is lazy, the rows holding the payload are decoded in the asarray stage
+        with stage('asarray') as s:
+            c = self._payload_values(base)
+            s.nbytes = c.nbytes
+        with stage('reconstruct') as s:
+            shape, f = self._reconstruct(c, out, scratch)
+            s.nbytes = f.nbytes
+        with stage('fromarray', f.nbytes):
+            return self._revealed(f)
+
+    def reveal_bytes(self, base):
+        # The payload as a memoryview over the revealed bytes, without decoding it (see reveals_bytes): JPEG are
+        # not opened by PIL, files are not copied into a bytes object
+        with stage('asarray') as s:
+            c = self._payload_values(base)
+            s.nbytes = c.nbytes
+        with stage('reconstruct') as s:
+            shape, f = self._reconstruct(c)
+            s.nbytes = f.nbytes
+        return memoryview(f)
+
+    def _write_payload(self, flat, shape, output, band_rows=BAND_ROWS, scratch=None):
+        # Reads the payload band by band (byte payloads by chunks) and writes it to the file `output`
+        step = band_rows if len(shape) > 1 else FILE_CHUNK_SIZE
+        with self._payload_writer(output, shape) as writer:
+            for top in range(0, shape[0], step):
+                out = np.empty((min(step, shape[0] - top), ) + tuple(shape[1:]), dtype=np.uint8)
+                self._read_band(flat, out, top, shape, scratch)
+                writer.write_rows(out)
+
+    def reveal_to(self, base, output, band_rows=BAND_ROWS):
+        # Same as reveal, the payload being written to `output` as it is read instead of being returned
+        with stage('asarray') as s:
+            flat = self._payload_values(base)
+            s.nbytes = flat.nbytes
+        shape = self._read_header(flat)
+        with stage('write', np.prod(shape, dtype=np.int64)):
+            self._write_payload(flat, shape, output, band_rows)
+
 
 class LosslessEncoder(BaseEncoder):
     value = METHOD_LOSSLESS
@@ -59,85 +267,40 @@ class LosslessEncoder(BaseEncoder):
     @staticmethod
     def needed_hidden_size(secret):
         return secret.width * secret.height * 3 * 2 + LosslessEncoder.header_size
-    
-    def _construct_lossless_with_dims(self, a, b, add_noise=False):
-        # 32 bits are needed to encode the length
-        # Using n = 4 for the LSB, we need 8 entries to encode the length of the message.
-        # We will occupy 9 entries, the last one being unused. Just to get a total of 3 pixels
-        LosslessEncoder.header_size = 9
-        # We need to encode each pixel into the 4 LSB, resulting in twice the size
-        # assert base.width * base.height > secret.width * secret.height * 2
-        # TODO: Remove and change for own can_fit method
-        assert a.size >= LosslessEncoder.header_size + b.size * 2
-
-        hidden_noise = np.zeros(a.size, dtype=np.uint8)
-        fake = a.copy('C')
-        
-        # Discard the LSB from the fake
-        fake = fake & 0xF0
-        
+
+    # 32 bits are needed to encode the length
+    # Using n = 4 for the LSB, we need 8 entries to encode the length of the message.
+    # We will occupy 9 entries, the last one being unused. Just to get a total of 3 pixels
+    def _write_header(self, flat, shape):
         # The 8 first value will be the length of the message, the additional 9th value is not used
-        width_np, height_np = len_to_np8_16(b.shape[0]), len_to_np8_16(b.shape[1])
-        hidden_noise[:4] = width_np
-        hidden_noise[4:8] = height_np
-        
-        red_noise = np.repeat(b[:,:,0], 2, -1).ravel('C')
-        red_noise[0::2] = (red_noise[0::2] & 0xF0) >> 4  # MSB of red
-        red_noise[1::2] = (red_noise[1::2] & 0x0F)  # LSB of red
-        
-        green_noise = np.repeat(b[:,:,1], 2, -1).ravel('C')
-        green_noise[0::2] = (green_noise[0::2] & 0xF0) >> 4  # MSB of green
-        green_noise[1::2] = (green_noise[1::2] & 0x0F)  # LSB of green
-        
-        blue_noise = np.repeat(b[:,:,2], 2, -1).ravel('C')
-        blue_noise[0::2] = (blue_noise[0::2] & 0xF0) >> 4  # MSB of blue
-        blue_noise[1::2] = (blue_noise[1::2] & 0x0F)  # LSB of blue
-        
-        
-        # Put the hidden image data in target
-        offset = LosslessEncoder.header_size
-        start, end = offset, offset + b.size * 2
-        # When raveled, they will be consecutive, i.e all red data, then all green data, then all blue data
-        stacked_arr = np.stack([red_noise, green_noise, blue_noise])
-        hidden_noise[offset:end] = stacked_arr.ravel('C')
-        
-        if add_noise:
-            hidden_noise[end:] = np.random.randint(low=0x00, high=0x0F, size=a.size-end, dtype=np.uint8)
-
-        fake = fake.ravel('C') + hidden_noise
-        return fake.reshape(a.shape)
-    
-    def _reconstruct_lossless_with_dims(self, a):
-        # Get the dimensions
-        flat = (a.ravel('C') & 0x0F)
-        width, height = np8_to_number_16(flat[:4]), np8_to_number_16(flat[4:8])
-        
-        per_channel_n_elem = width * height * 2
-        
-        red_start, red_end = 9, 9 + per_channel_n_elem
-        green_start, green_end = red_end, red_end + per_channel_n_elem
-        blue_start, blue_end = green_end, green_end + per_channel_n_elem
-        rr, rg, rb  = flat[red_start:red_end], flat[green_start:green_end], flat[blue_start:blue_end]
-        output = np.zeros((width, height, 3), dtype=np.uint8)
-        output[:,:,0] = (((rr[0::2]) << 4) + (rr[1::2])).reshape(width, height)
-        output[:,:,1] = (((rg[0::2]) << 4) + (rg[1::2])).reshape(width, height)
-        output[:,:,2] = (((rb[0::2]) << 4) + (rb[1::2])).reshape(width, height)
-        return width, height, output.reshape(width, height, 3)
-
-    def hide(self, base, secret, add_noise, engrave_method):
-        assert LosslessEncoder.can_fit(base, secret)
-        a = np.asarray(base)
-        b = np.asarray(secret)
-        fake_data = self._construct_lossless_with_dims(a, b, add_noise)
-        if engrave_method:
-            fake_data.ravel('C')[8] = LosslessEncoder.value
-        return Image.fromarray(fake_data)
+        write_nibbles(flat, 0, len_to_np8_16(shape[0]))
+        write_nibbles(flat, 4, len_to_np8_16(shape[1]))
+
+    def _read_header(self, flat):
+        header = read_nibbles(flat, 0, 8)
+        return np8_to_number_16(header[:4]), np8_to_number_16(header[4:8]), 3
+
+    def _payload_end(self, shape):
+        # We need to encode each pixel into the 4 LSB, resulting in twice the size
+        return LosslessEncoder.header_size + shape[0] * shape[1] * 3 * 2
 
-    def reveal(self, base):
-        c = np.asarray(base)
-        w, h, f = self._reconstruct_lossless_with_dims(c)
-        i = Image.fromarray(f, mode='RGB')
-        return i
+    def _write_band(self, flat, band, top, shape, scratch=None):
+        # Channels are consecutive, i.e all red data, then all green data, then all blue data.
+        # Within a channel, the MSB of a value come right before its LSB.
+        per_channel_n_elem, row_n_elem = shape[0] * shape[1] * 2, shape[1] * 2
+        for channel in range(3):
+            start = LosslessEncoder.header_size + channel * per_channel_n_elem + top * row_n_elem
+            split_into(flat[start:start + len(band) * row_n_elem], band[:,:,channel], scratch, self.threads)
+
+    def _read_band(self, flat, out, top, shape, scratch=None):
+        per_channel_n_elem, row_n_elem = shape[0] * shape[1] * 2, shape[1] * 2
+        for channel in range(3):
+            start = LosslessEncoder.header_size + channel * per_channel_n_elem + top * row_n_elem
+            join_into(out[:,:,channel], flat[start:start + len(out) * row_n_elem], scratch, self.threads)
+
+    def hide(self, base, secret, add_noise, engrave_method, out=None, scratch=None):
+        assert LosslessEncoder.can_fit(base, secret)
+        return super().hide(base, secret, add_noise, engrave_method, out, scratch)
 
 class LossyEncoder(BaseEncoder):
     value = METHOD_LOSSY
@@ -149,127 +312,775 @@ class LossyEncoder(BaseEncoder):
     def needed_hidden_size(secret):
         return secret.width * secret.height * 3 + LossyEncoder.header_size
 
-    def _construct_loss_with_dims(self, a, b, add_noise):
-        # 32 bits are needed to encode the length
-        # Using n = 4 for the LSB, we need 8 entries to encode the length of the message.
-        # We will occupy 9 entries, the last one being unused. Just to get a total of 3 pixels
-        offset = LossyEncoder.header_size
+    # Same header as the lossless encoder, only the MSB of each value of the secret are kept
+    _write_header = LosslessEncoder._write_header
+    _read_header = LosslessEncoder._read_header
 
-        hidden_noise = np.zeros(a.size, dtype=np.uint8)
-        fake = a.copy('C')
-        
-        
-        # The 8 first value will be the length of the message, the additional 9th value is not used
-        width_np, height_np = len_to_np8_16(b.shape[0]), len_to_np8_16(b.shape[1])
-        hidden_noise[:4] = width_np
-        hidden_noise[4:8] = height_np
-        # Put the hidden image data in target
-        start, end = offset, offset + b.size
-        hidden_noise[offset:end] = (b.ravel('C') & 0xF0) >> 4
-        
-        if add_noise:
-            hidden_noise[end:] = np.random.randint(low=0x00, high=0x0F, size=a.size-end, dtype=np.uint8)
-        
-        # Discard the LSB from the fake up until the last fake data
-        fake[:end] = fake[:end] & 0xF0
-        fake = fake.ravel('C') + hidden_noise
-        return fake.reshape(a.shape)
-
-    def _reconstruct_loss_with_dims(self, a):
-        # Get the dimensions
-        flat = (a.ravel() & 0x0F)
-        width, height = np8_to_number_16(flat[:4]), np8_to_number_16(flat[4:8])
-        n_elems = width * height * 3
-        start, end = 9, 9 + n_elems
-        rr, rg, rb  = flat[start:end:3] << 4, flat[start+1:end+1:3] << 4, flat[start+2:end+2:3] << 4
-        packed = np.stack([rr, rg, rb], axis=-1)
-        return width, height, packed.reshape(width, height, 3)
-    
-    def hide(self, base, secret, add_noise, engrave_method):
+    def _payload_end(self, shape):
+        return LossyEncoder.header_size + shape[0] * shape[1] * 3
+
+    def _write_band(self, flat, band, top, shape, scratch=None):
+        start = LossyEncoder.header_size + top * shape[1] * 3
+        shift_into(flat[start:start + band.size], band, scratch, self.threads)
+
+    def _read_band(self, flat, out, top, shape, scratch=None):
+        start = LossyEncoder.header_size + top * shape[1] * 3
+        unshift_into(out, flat[start:start + out.size], self.threads)
+
+    def hide(self, base, secret, add_noise, engrave_method, out=None, scratch=None):
         assert LossyEncoder.can_fit(base, secret)
-        a = np.asarray(base)
-        b = np.asarray(secret)
-        fake_data = self._construct_loss_with_dims(a, b, add_noise)
-        if engrave_method:
-            fake_data.ravel('C')[8] = LossyEncoder.value
-        return Image.fromarray(fake_data)
-    
-    def reveal(self, base):
-        c = np.asarray(base)
-        w, h, f = self._reconstruct_loss_with_dims(c)
-        i = Image.fromarray(f, mode='RGB')
-        return i
-
-class JpegEncoder(BaseEncoder):
+        return super().hide(base, secret, add_noise, engrave_method, out, scratch)
+
+class ParametrizedEncoder(BaseEncoder):
+    def can_fit(self, base, secret):
+        # Unlike the fixed encoders, the needed size depends on the instance (e.g. its number of bits)
+        available_size = self.available_hidden_size(base)
+        needed_size = self.needed_hidden_size(secret)
+        logging.debug(f'{type(self).__name__}: needed size is {needed_size} and available is {available_size}')
+        return needed_size <= available_size
+
+class JpegEncoder(ParametrizedEncoder):
     value = 0x03
     header_size = 9
 
-    def __init__(self):
+    def __init__(self, quality=None):
         super().__init__()
+        # None keeps the default quality of PIL
+        self.quality = quality
 
-    def needed_hidden_size(secret):
-        b = io.BytesIO()
+    def _encode(self, secret):
         ba = io.BytesIO()
-        secret.save(ba, format='jpeg')
-        memview = ba.getbuffer()
-        return len(memview)
-    def hide(self, base, secret, add_noise, engrave_method):
-        ba = io.BytesIO()
-        secret.save(ba, format='jpeg')
-        memview = ba.getbuffer()
-        z = np.frombuffer(memview, dtype=np.uint8)
-        
-        a = np.asarray(base)
-        b = np.asarray(secret)
-        # 32 bits are needed to encode the length
-        # Using n = 4 for the LSB, we need 8 entries to encode the length of the message.
-        # We will occupy 9 entries, the last one being unused. Just to get a total of 3 pixels
-        offset = self.header_size
-        tot_size = len(memview)
-        hidden_noise = np.zeros(a.size, dtype=np.uint8)
-        fake = a.copy('C')
-        print(len(memview), len(z), tot_size, tot_size * 2)
-        
-        
-        # The 8 first value will be the length of the message, the additional 9th value is not used
-        # width_np, height_np = len_to_np8_16(b.shape[0]), len_to_np8_16(b.shape[1])
-        hidden_noise[:8] = len_to_np8_32(tot_size * 2)
-        # Put the hidden image data in target
-        start, end = offset, offset + tot_size * 2
-        hidden_noise[offset:end:2] = (z & 0xF0) >> 4
-        hidden_noise[offset+1:end+1:2] = z & 0x0F
+        secret.save(ba, format='jpeg', **(dict() if self.quality is None else dict(quality=self.quality)))
+        data = np.frombuffer(ba.getvalue(), dtype=np.uint8)
+        return PreparedPayload(data.shape, data, data.size)
 
-        if add_noise:
-            hidden_noise[end:] = np.random.randint(low=0x00, high=0x0F, size=a.size-end, dtype=np.uint8)
-        
-        # Discard the LSB from the fake up until the last fake data
-        fake[:end] = fake[:end] & 0xF0
-        fake = fake.ravel('C') + hidden_noise
-        if engrave_method:
-            fake[8] = self.value
-        fake_image = Image.fromarray(fake.reshape(a.shape))
-
-        return fake_image
-    def reveal(self, base):
-        c = np.asarray(base)
-        flat = c.ravel('C') & 0x0F
-        to_read = np8_to_number_32(flat[:8])
-
-        start, end = self.header_size, self.header_size + to_read
-        _msb = flat[start:end:2] << 4
-        _lsb = np.zeros_like(_msb, dtype=np.uint8)
-        _lsb[:end-start] = flat[start+1:end+1:2]
-        _f = _msb + _lsb
-        v = io.BytesIO(_f.tobytes())
-        image = Image.open(v)
-        return image
-        raise NotImplementedError('Not for the base class')
+    def _prepare(self, secret):
+        # The secret is JPEG encoded once per quality, for both sizing and hiding
+        return prepare(secret, ('jpeg', self.quality), self._encode)
+
+    def needed_hidden_size(self, secret):
+        return self._prepare(secret).length * 2 + self.header_size
+
+    def _payload(self, secret):
+        return self._prepare(secret).data
+
+    def _revealed(self, payload):
+        return Image.open(io.BytesIO(payload.tobytes()))
+
+    def _payload_bands(self, secret, band_rows):
+        # The JPEG is small compared to the images, it is kept in memory
+        payload = self._payload(secret)
+        return payload.shape, [(0, payload)]
+
+    def _payload_writer(self, output, shape):
+        # No need to decode the JPEG, the bytes are written as they were hidden
+        return RawStreamWriter(output)
+
+    # The payload is a byte stream, its shape being the number of bytes
+    def _write_header(self, flat, shape):
+        # The 8 first value will be the number of nibbles of the message, the additional 9th value is not used
+        write_nibbles(flat, 0, len_to_np8_32(shape[0] * 2))
+
+    def _read_header(self, flat):
+        return np8_to_number_32(read_nibbles(flat, 0, 8)) // 2,
+
+    def _payload_end(self, shape):
+        return self.header_size + shape[0] * 2
+
+    def _write_band(self, flat, band, top, shape, scratch=None):
+        start = self.header_size + top * 2
+        split_into(flat[start:start + band.size * 2], band, scratch, self.threads)
+
+    def _read_band(self, flat, out, top, shape, scratch=None):
+        start = self.header_size + top * 2
+        join_into(out, flat[start:start + out.size * 2], scratch, self.threads)
+
+class ExtendedEncoder(ParametrizedEncoder):
+    # Encoders added after the first three share an extended header:
+    #  - the 8 first values hold the number of nibbles of the extension (32 bits)
+    #  - the 9th value is the method
+    #  - then the extension itself, made of `header_fields` (name, number of nibbles)
+    # The payload follows the extension, in the `bits` LSB of each value.
+    header_fields = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.extension_size = sum(count for _, count in cls.header_fields)
+        cls.header_size = 9 + cls.extension_size
+
+    def _write_fields(self, flat, values):
+        write_nibbles(flat, 0, number_to_nibbles(self.extension_size, 8))
+        position = 9
+        for name, count in self.header_fields:
+            write_nibbles(flat, position, number_to_nibbles(values[name], count))
+            position += count
+
+    def _read_fields(self, flat):
+        extension_size = nibbles_to_number(read_nibbles(flat, 0, 8))
+        if extension_size != self.extension_size:
+            raise ValueError('Unsupported header: extension of {} nibbles, expected {}'.format(extension_size, self.extension_size))
+        values, position = dict(), 9
+        for name, count in self.header_fields:
+            values[name] = nibbles_to_number(read_nibbles(flat, position, count))
+            position += count
+        return values
+
+
+class BitPlaneEncoder(ExtendedEncoder):
+    # Hides the raw samples of the secret (L, RGB or RGBA) in the `bits` LSB of the base, 1 <= bits <= 8.
+    # The number of bits is part of the header so that reveal picks it up.
+    value = METHOD_BITPLANE
+    header_fields = (('bits', 1), ('height', 8), ('width', 8), ('bands', 1))
+
+    def __init__(self, bits=4):
+        super().__init__()
+        assert 1 <= bits <= 8, 'Between 1 and 8 bits can be used, not {}'.format(bits)
+        self.bits = bits
+
+    @staticmethod
+    def _secret_image(secret):
+        if isinstance(secret, Image.Image) and secret.mode not in SECRET_MODES.values():
+            return secret.convert('RGB')
+        return secret
+
+    @staticmethod
+    def _secret_shape(secret):
+        # Shape of `_secret_image(secret)`, without converting it
+        height, width, bands = image_shape(secret)
+        if isinstance(secret, Image.Image) and secret.mode not in SECRET_MODES.values():
+            bands = 3
+        return height, width, bands
+
+    def needed_hidden_size(self, secret):
+        return self._payload_end(self._secret_shape(secret))
+
+    def _payload(self, secret):
+        a = np.asarray(self._secret_image(secret))
+        return a.reshape(a.shape[0], a.shape[1], -1)
+
+    def _revealed(self, payload):
+        mode = SECRET_MODES[payload.shape[2]]
+        return Image.fromarray(payload[:,:,0] if mode == 'L' else payload, mode=mode)
+
+    def _payload_bands(self, secret, band_rows):
+        secret = self._secret_image(secret)
+        return image_shape(secret), iter_bands(secret, band_rows)
+
+    def _payload_writer(self, output, shape):
+        return stream_writer(self.writer, output, shape)
+
+    def _write_header(self, flat, shape):
+        self._write_fields(flat, dict(bits=self.bits - 1, height=shape[0], width=shape[1], bands=shape[2]))
+
+    def _read_header(self, flat):
+        values = self._read_fields(flat)
+        self.bits = values['bits'] + 1
+        return values['height'], values['width'], values['bands']
+
+    def _payload_end(self, shape):
+        return self.header_size + -(-shape[0] * shape[1] * shape[2] * 8 // self.bits)
+
+    def _write_band(self, flat, band, top, shape, scratch=None):
+        row_size = shape[1] * shape[2]
+        pack_bits(flat, self.header_size, np.ascontiguousarray(band), self.bits, top * row_size * 8, threads=self.threads)
+
+    def _read_band(self, flat, out, top, shape, scratch=None):
+        row_size = shape[1] * shape[2]
+        unpack_bits(flat, self.header_size, out, self.bits, top * row_size * 8, threads=self.threads)
+
+    def hide(self, base, secret, add_noise, engrave_method, out=None, scratch=None):
+        assert self.can_fit(base, secret)
+        return super().hide(base, secret, add_noise, engrave_method, out, scratch)
 
-MODES = [ LosslessEncoder, LossyEncoder, JpegEncoder ]
+
+class BytesEncoder(ExtendedEncoder):
+    # Hides any file as a byte stream in the `bits` LSB of the base.
+    # Secrets are paths, bytes-like objects or seekable binary file objects, read chunk by chunk straight into
+    # the base. The length has 64 bits so that secrets (and bases) of several GB can be used.
+    value = METHOD_BYTES
+    header_fields = (('bits', 1), ('length', 16))
+    image_secret = False
+
+    def __init__(self, bits=4):
+        super().__init__()
+        assert 1 <= bits <= 8, 'Between 1 and 8 bits can be used, not {}'.format(bits)
+        self.bits = bits
+
+    def needed_hidden_size(self, secret):
+        return self._payload_end((file_length(secret), ))
+
+    def _payload_bands(self, secret, band_rows=None):
+        # The file is not read at once, whatever the mode
+        return (file_length(secret), ), iter_chunks(secret)
+
+    def _revealed(self, payload):
+        return payload.tobytes()
+
+    def _payload_writer(self, output, shape):
+        return RawStreamWriter(output)
+
+    def _write_header(self, flat, shape):
+        self._write_fields(flat, dict(bits=self.bits - 1, length=shape[0]))
+
+    def _read_header(self, flat):
+        values = self._read_fields(flat)
+        self.bits = values['bits'] + 1
+        return values['length'],
+
+    def _payload_end(self, shape):
+        return self.header_size + -(-shape[0] * 8 // self.bits)
+
+    def _write_band(self, flat, band, top, shape, scratch=None):
+        pack_bits(flat, self.header_size, band, self.bits, top * 8, threads=self.threads)
+
+    def _read_band(self, flat, out, top, shape, scratch=None):
+        unpack_bits(flat, self.header_size, out, self.bits, top * 8, threads=self.threads)
+
+    def hide(self, base, secret, add_noise, engrave_method, out=None, scratch=None):
+        assert self.can_fit(base, secret)
+        # The file is read as it is written, in the construct stage
+        with stage('payload'):
+            shape, chunks = self._payload_bands(secret)
+        return self._hide_bands(base, shape, chunks, add_noise, engrave_method, out, scratch)
+
+    def reveal_into(self, base, file, chunk_size=FILE_CHUNK_SIZE):
+        # Writes the hidden bytes to the binary file object `file` chunk by chunk, returns their number
+        flat = self._payload_values(base)
+        length, = self._read_header(flat)
+        buffer = np.empty(min(chunk_size, length), dtype=np.uint8)
+        for top in range(0, length, chunk_size):
+            chunk = buffer[:min(chunk_size, length - top)]
+            self._read_band(flat, chunk, top, (length, ))
+            file.write(memoryview(chunk))
+        return length
+
+
+class CompressedEncoder(ExtendedEncoder):
+    # Compresses what another mode would hide (the samples of the secret, only their MSB for the lossy mode,
+    # or the bytes of a file) and hides the compressed stream in the `bits` LSB of the base.
+    # The wrapped mode, the codec and its level are part of the header. The compressed stream is only known
+    # once the secret has been compressed, which happens once per secret (see linear_payloads.py).
+    value = METHOD_COMPRESSED
+    header_fields = (('bits', 1), ('codec', 1), ('level', 1), ('source', 1), ('height', 8), ('width', 8), ('bands', 1),
+                     ('size', 16), ('length', 16))
+    sources = (METHOD_LOSSLESS, METHOD_LOSSY, METHOD_BITPLANE, METHOD_BYTES)
+    # The compressed size does not follow the dimensions of the secret
+    image_secret = False
+
+    def __init__(self, source=LosslessEncoder, codec='zlib', level=None, bits=4):
+        super().__init__()
+        assert source.value in self.sources, 'The {} mode cannot be compressed'.format(source.__name__)
+        assert codec in CODEC_IDS, 'Unknown codec {}'.format(codec)
+        assert 1 <= bits <= 8, 'Between 1 and 8 bits can be used, not {}'.format(bits)
+        self.source = source
+        self.codec = codec
+        self.level = DEFAULT_LEVELS[codec] if level is None else level
+        self.bits = bits
+        # Compressed length of the payload, known after `_prepare` or `_read_header`
+        self.length = None
+        self._inflater = None
+
+    @property
+    def _is_file(self):
+        return self.source is BytesEncoder
+
+    def _source_bands(self, secret):
+        # Shape of the uncompressed payload and its byte chunks
+        if self._is_file:
+            return (file_length(secret), ), (chunk for _, chunk in iter_chunks(secret))
+        secret = BitPlaneEncoder._secret_image(secret)
+        bands = (rows for _, rows in iter_bands(secret))
+        if self.source is LossyEncoder:
+            bands = (rows >> 4 for rows in bands)
+        return image_shape(secret), bands
+
+    def _compress(self, secret):
+        shape, chunks = self._source_bands(secret)
+        spool, length, _ = compress_chunks(chunks, self.codec, self.level)
+        logging.info('Payload of {} bytes compressed to {} bytes with {} (level {})'.format(
+            int(np.prod(shape, dtype=np.int64)), length, self.codec, self.level))
+        return PreparedPayload(shape, spool, length)
+
+    def _prepare(self, secret):
+        # The secret is compressed once for a given source, codec and level, for both sizing and hiding
+        payload = prepare(secret, ('compressed', self.source.value, self.codec, self.level), self._compress)
+        self.length = payload.length
+        return payload.shape, payload.data
+
+    def needed_hidden_size(self, secret):
+        shape, _ = self._prepare(secret)
+        return self._payload_end(shape)
+
+    def _payload_bands(self, secret, band_rows=None):
+        # Bands are chunks of the compressed stream, `top` being their offset in it
+        shape, spool = self._prepare(secret)
+        spool.seek(0)
+        return shape, iter_chunks(spool)
+
+    def _revealed(self, payload):
+        if self._is_file:
+            return payload.tobytes()
+        return BitPlaneEncoder._revealed(self, payload)
+
+    def _payload_writer(self, output, shape):
+        if self._is_file:
+            return RawStreamWriter(output)
+        return stream_writer(self.writer, output, shape)
+
+    def _write_header(self, flat, shape):
+        height, width, bands = (0, 0, 0) if self._is_file else shape
+        self._write_fields(flat, dict(bits=self.bits - 1, codec=CODEC_IDS[self.codec], level=self.level,
+                                      source=self.source.value, height=height, width=width, bands=bands,
+                                      size=int(np.prod(shape, dtype=np.int64)), length=self.length))
+
+    def _read_header(self, flat):
+        values = self._read_fields(flat)
+        if values['codec'] not in CODEC_NAMES or values['source'] not in self.sources:
+            raise ValueError('Unsupported header: codec {} and source {}'.format(values['codec'], values['source']))
+        self.bits = values['bits'] + 1
+        self.codec, self.level = CODEC_NAMES[values['codec']], values['level']
+        self.source = next(m for m in MODES if m.value == values['source'])
+        self.length = values['length']
+        self._inflater = None
+        if self._is_file:
+            return values['size'],
+        return values['height'], values['width'], values['bands']
+
+    def _payload_end(self, shape):
+        return self.header_size + -(-self.length * 8 // self.bits)
+
+    def _write_band(self, flat, band, top, shape, scratch=None):
+        pack_bits(flat, self.header_size, band, self.bits, top * 8, threads=self.threads)
+
+    def _compressed_chunks(self, flat, chunk_size=FILE_CHUNK_SIZE):
+        for offset in range(0, self.length, chunk_size):
+            chunk = np.empty(min(chunk_size, self.length - offset), dtype=np.uint8)
+            unpack_bits(flat, self.header_size, chunk, self.bits, offset * 8)
+            yield chunk
+
+    def _read_band(self, flat, out, top, shape, scratch=None):
+        # Bands have to be read in order, from the top: the payload is decompressed as a stream
+        if top == 0 or self._inflater is None:
+            self._inflater = Inflater(self._compressed_chunks(flat), self.codec)
+        self._inflater.readinto(out.reshape(-1))
+        if self.source is LossyEncoder:
+            np.left_shift(out, 4, out=out)
+
+    def hide(self, base, secret, add_noise, engrave_method, out=None, scratch=None):
+        assert self.can_fit(base, secret)
+        with stage('payload') as s:
+            shape, chunks = self._payload_bands(secret)
+            s.nbytes = self.length
+        return self._hide_bands(base, shape, chunks, add_noise, engrave_method, out, scratch)
+
+
+class TiledEncoder(ExtendedEncoder):
+    # Versioned container hiding the raw samples of the secret (L, RGB or RGBA) as independent tiles, so that a
+    # region can be revealed from the tiles it covers only, and a corrupted tile is found without decoding the others.
+    # Sizes have 32 bits, past the 65535 pixels per side of the lossless and lossy headers.
+    #  - the header ends with the CRC32 of its fields, which rejects noise (or a wrong key) before anything is read
+    #  - the payload starts with the table of the CRC32 of every tile (4 bytes each), followed by the tiles
+    # Tiles are `tile` x `tile` pixels (less on the right and bottom edges), stored row of tiles by row of tiles,
+    # each one row by row. They are not compressed, so their offsets follow from the shape.
+    value = METHOD_TILED
+    header_fields = (('version', 1), ('bits', 1), ('tile', 4), ('height', 8), ('width', 8), ('bands', 1), ('crc', 8))
+
+    def __init__(self, bits=4, tile=TILE_SIZE):
+        super().__init__()
+        assert 1 <= bits <= 8, 'Between 1 and 8 bits can be used, not {}'.format(bits)
+        assert 1 <= tile <= 0xFFFF, 'Tiles have between 1 and 65535 pixels per side, not {}'.format(tile)
+        self.bits = bits
+        self.tile = tile
+
+    def needed_hidden_size(self, secret):
+        return self._payload_end(BitPlaneEncoder._secret_shape(secret))
+
+    def _payload(self, secret):
+        a = np.asarray(BitPlaneEncoder._secret_image(secret))
+        return a.reshape(a.shape[0], a.shape[1], -1)
+
+    def _revealed(self, payload):
+        return BitPlaneEncoder._revealed(self, payload)
+
+    def _payload_bands(self, secret, band_rows):
+        # Bands are whole rows of tiles
+        secret = BitPlaneEncoder._secret_image(secret)
+        return image_shape(secret), iter_bands(secret, -(-band_rows // self.tile) * self.tile)
+
+    def _payload_writer(self, output, shape):
+        return stream_writer(self.writer, output, shape)
+
+    def _fields_crc(self, values):
+        nibbles = [ number_to_nibbles(values[name], count) for name, count in self.header_fields if name != 'crc' ]
+        return zlib.crc32(np.concatenate(nibbles).tobytes())
+
+    def _write_header(self, flat, shape):
+        values = dict(version=TILED_VERSION, bits=self.bits - 1, tile=self.tile, height=shape[0], width=shape[1], bands=shape[2])
+        self._write_fields(flat, dict(values, crc=self._fields_crc(values)))
+
+    def _read_header(self, flat):
+        values = self._read_fields(flat)
+        if values['crc'] != self._fields_crc(values):
+            raise ValueError('Corrupted header: CRC mismatch')
+        if values['version'] != TILED_VERSION:
+            raise ValueError('Unsupported header: tiled container version {}, expected {}'.format(values['version'], TILED_VERSION))
+        if values['tile'] == 0 or values['bands'] not in SECRET_MODES:
+            raise ValueError('Unsupported header: tiles of {} pixels and {} bands'.format(values['tile'], values['bands']))
+        self.bits, self.tile = values['bits'] + 1, values['tile']
+        return values['height'], values['width'], values['bands']
+
+    def _grid(self, shape):
+        # Number of rows and columns of tiles
+        return -(-shape[0] // self.tile), -(-shape[1] // self.tile)
+
+    def _tile_box(self, shape, row, column):
+        # (top, bottom, left, right) of a tile in the secret
+        top, left = row * self.tile, column * self.tile
+        return top, min(top + self.tile, shape[0]), left, min(left + self.tile, shape[1])
+
+    def _tile_offset(self, shape, row, column):
+        # Offset of a tile in the payload, in bytes. The rows of tiles above it all have `tile` rows.
+        rows, columns = self._grid(shape)
+        top, bottom, left, _ = self._tile_box(shape, row, column)
+        return rows * columns * 4 + (top * shape[1] + (bottom - top) * left) * shape[2]
+
+    def _tile_end(self, shape, row, column):
+        # Index of the first nibble after a tile
+        top, bottom, left, right = self._tile_box(shape, row, column)
+        size = (bottom - top) * (right - left) * shape[2]
+        return self.header_size + -(-(self._tile_offset(shape, row, column) + size) * 8 // self.bits)
+
+    def _payload_end(self, shape):
+        rows, columns = self._grid(shape)
+        return self._tile_end(shape, rows - 1, columns - 1) if rows and columns else self.header_size
+
+    def _write_band(self, flat, band, top, shape, scratch=None):
+        # `band` is made of whole rows of tiles, see _payload_bands
+        assert top % self.tile == 0 and (len(band) % self.tile == 0 or top + len(band) == shape[0])
+        columns = self._grid(shape)[1]
+        for row in range(top // self.tile, -(-(top + len(band)) // self.tile)):
+            for column in range(columns):
+                y0, y1, x0, x1 = self._tile_box(shape, row, column)
+                data = np.ascontiguousarray(band[y0 - top:y1 - top, x0:x1])
+                crc = np.array([ zlib.crc32(data) ], dtype='>u4').view(np.uint8)
+                pack_bits(flat, self.header_size, crc, self.bits, (row * columns + column) * 32, threads=self.threads)
+                pack_bits(flat, self.header_size, data, self.bits, self._tile_offset(shape, row, column) * 8, threads=self.threads)
+
+    def _read_tile(self, flat, shape, row, column):
+        # The samples of a tile, checked against its CRC
+        y0, y1, x0, x1 = self._tile_box(shape, row, column)
+        tile = np.empty((y1 - y0, x1 - x0, shape[2]), dtype=np.uint8)
+        unpack_bits(flat, self.header_size, tile, self.bits, self._tile_offset(shape, row, column) * 8, threads=self.threads)
+        crc = np.empty(4, dtype=np.uint8)
+        unpack_bits(flat, self.header_size, crc, self.bits, (row * self._grid(shape)[1] + column) * 32)
+        if zlib.crc32(tile) != int(crc.view('>u4')[0]):
+            raise ValueError('Tile ({}, {}) is corrupted, rows {} to {} and columns {} to {} of the secret'.format(row, column, y0, y1, x0, x1))
+        return tile
+
+    def _read_region(self, flat, shape, out, top, left):
+        # Fills `out` with the pixels of the secret from (top, left), from the tiles it covers only
+        bottom, right = top + out.shape[0], left + out.shape[1]
+        for row in range(top // self.tile, -(-bottom // self.tile)):
+            for column in range(left // self.tile, -(-right // self.tile)):
+                y0, y1, x0, x1 = self._tile_box(shape, row, column)
+                tile = self._read_tile(flat, shape, row, column)
+                ys, ye, xs, xe = max(top, y0), min(bottom, y1), max(left, x0), min(right, x1)
+                out[ys - top:ye - top, xs - left:xe - left] = tile[ys - y0:ye - y0, xs - x0:xe - x0]
+        return out
+
+    def _read_band(self, flat, out, top, shape, scratch=None):
+        self._read_region(flat, shape, out, top, 0)
+
+    def _write_payload(self, flat, shape, output, band_rows=BAND_ROWS, scratch=None):
+        # Bands of whole rows of tiles, so that every tile is decoded once
+        super()._write_payload(flat, shape, output, -(-band_rows // self.tile) * self.tile, scratch)
+
+    def _region_end(self, shape, region):
+        # End of the values holding the tiles covered by `region`, the bottom right one coming last
+        left, top, width, height = region
+        if width <= 0 or height <= 0 or left < 0 or top < 0 or left + width > shape[1] or top + height > shape[0]:
+            raise ValueError('Region {} is not within the {}x{} secret'.format(region, shape[1], shape[0]))
+        return self._tile_end(shape, (top + height - 1) // self.tile, (left + width - 1) // self.tile)
+
+    def reveal_region(self, base, region):
+        # Same as reveal for the `region` (left, top, width, height) of the secret. Only the values up to its last
+        # tile are read, and only the tiles it covers are decoded and checked.
+        with stage('asarray') as s:
+            flat = self._payload_values(base, lambda shape: self._region_end(shape, region))
+            s.nbytes = flat.nbytes
+        shape = self._read_header(flat)
+        left, top, width, height = region
+        with stage('reconstruct') as s:
+            out = self._read_region(flat, shape, np.empty((height, width, shape[2]), dtype=np.uint8), top, left)
+            s.nbytes = out.nbytes
+        with stage('fromarray', out.nbytes):
+            return self._revealed(out)
+
+    def hide(self, base, secret, add_noise, engrave_method, out=None, scratch=None):
+        assert self.can_fit(base, secret)
+        return super().hide(base, secret, add_noise, engrave_method, out, scratch)
+
+
+class MultiEncoder(ExtendedEncoder):
+    # Hides several secrets in one pass: images (their samples, as the bitplane method) and files (their bytes).
+    # Secrets are (name, secret) pairs or a dict, images being PIL images or arrays and files anything the bytes
+    # method hides. The payload starts with a directory index, JSON listing the name, kind, shape (images only),
+    # offset and length of each entry, followed by the entries back to back, all in the `bits` LSB of the base.
+    # The index is read on its own, so that entries can be listed, and revealed one by one without unpacking the
+    # bytes of the others.
+    value = METHOD_MULTI
+    header_fields = (('bits', 1), ('index', 8), ('length', 16))
+    image_secret = False
+
+    def __init__(self, bits=4):
+        super().__init__()
+        assert 1 <= bits <= 8, 'Between 1 and 8 bits can be used, not {}'.format(bits)
+        self.bits = bits
+        # Length of the index in bytes, known after `_payload_bands` or `_read_header`
+        self.index_length = None
+
+    @staticmethod
+    def _entries(secrets):
+        entries = list(secrets.items()) if isinstance(secrets, dict) else list(secrets)
+        names = [ name for name, _ in entries ]
+        if len(set(names)) != len(names):
+            raise ValueError('Entry names must be unique')
+        return entries
+
+    @staticmethod
+    def _is_image(secret):
+        return isinstance(secret, (Image.Image, np.ndarray))
+
+    def _index(self, secrets):
+        # The index as bytes, and the number of bytes of the entries
+        records, offset = [], 0
+        for name, secret in self._entries(secrets):
+            if self._is_image(secret):
+                shape = BitPlaneEncoder._secret_shape(secret)
+                assert shape[2] in SECRET_MODES, 'Images of {} bands cannot be hidden'.format(shape[2])
+                record = dict(name=name, kind='image', shape=list(shape), length=int(np.prod(shape, dtype=np.int64)))
+            else:
+                record = dict(name=name, kind='file', length=file_length(secret))
+            records.append(dict(record, offset=offset))
+            offset += record['length']
+        return json.dumps(records).encode(), offset
+
+    def _chunks(self, secret):
+        if self._is_image(secret):
+            for _, rows in iter_bands(BitPlaneEncoder._secret_image(secret)):
+                yield rows.reshape(-1)
+        else:
+            for _, chunk in iter_chunks(secret):
+                yield chunk
+
+    def needed_hidden_size(self, secrets):
+        index, length = self._index(secrets)
+        return self._payload_end((len(index) + length, ))
+
+    def _payload_bands(self, secrets, band_rows=None):
+        # Bands are the index then the chunks of every entry, `top` being their offset in the payload
+        index, length = self._index(secrets)
+        self.index_length = len(index)
+
+        def bands():
+            yield 0, np.frombuffer(index, dtype=np.uint8)
+            top = len(index)
+            for _, secret in self._entries(secrets):
+                for chunk in self._chunks(secret):
+                    yield top, chunk
+                    top += chunk.size
+        return (len(index) + length, ), bands()
+
+    def _write_header(self, flat, shape):
+        self._write_fields(flat, dict(bits=self.bits - 1, index=self.index_length, length=shape[0]))
+
+    def _read_header(self, flat):
+        values = self._read_fields(flat)
+        if values['index'] > values['length']:
+            raise ValueError('Corrupted header: index of {} bytes in a payload of {}'.format(values['index'], values['length']))
+        self.bits = values['bits'] + 1
+        self.index_length = values['index']
+        return values['length'],
+
+    def _bytes_end(self, length):
+        # Index of the first nibble after the `length` first bytes of the payload
+        return self.header_size + -(-length * 8 // self.bits)
+
+    def _payload_end(self, shape):
+        return self._bytes_end(shape[0])
+
+    def _write_band(self, flat, band, top, shape, scratch=None):
+        pack_bits(flat, self.header_size, band, self.bits, top * 8, threads=self.threads)
+
+    def _read_band(self, flat, out, top, shape, scratch=None):
+        unpack_bits(flat, self.header_size, out, self.bits, top * 8, threads=self.threads)
+
+    def entries(self, base):
+        # The directory index of `base`, as a list of dicts. Only the values holding the index are read.
+        flat = self._payload_values(base, lambda shape: self._bytes_end(self.index_length))
+        index = np.empty(self.index_length, dtype=np.uint8)
+        self._read_band(flat, index, 0, None)
+        try:
+            return json.loads(index.tobytes())
+        except ValueError:
+            raise ValueError('Corrupted index of {} bytes'.format(self.index_length))
+
+    def reveal_entry(self, base, name, entries=None):
+        # The image or the bytes of the entry `name`. Only the values up to its end are read, and only its own
+        # bytes are unpacked. `entries` spares reading the index again.
+        entry = next((e for e in entries or self.entries(base) if e['name'] == name), None)
+        if entry is None:
+            raise ValueError('No entry named {}'.format(name))
+        start = self.index_length + entry['offset']
+        with stage('asarray') as s:
+            flat = self._payload_values(base, lambda shape: self._bytes_end(start + entry['length']))
+            s.nbytes = flat.nbytes
+        with stage('reconstruct', entry['length']):
+            out = np.empty(entry['shape'] if entry['kind'] == 'image' else entry['length'], dtype=np.uint8)
+            self._read_band(flat, out, start, None)
+        if entry['kind'] == 'image':
+            with stage('fromarray', out.nbytes):
+                return BitPlaneEncoder._revealed(self, out)
+        return out.tobytes()
+
+    def reveal(self, base, out=None, scratch=None):
+        raise ValueError('Several secrets are hidden, they are listed and revealed one by one (see entries and reveal_entry)')
+
+    def hide(self, base, secrets, add_noise, engrave_method, out=None, scratch=None):
+        assert self.can_fit(base, secrets)
+        # Entries are read as they are written, in the construct stage
+        with stage('payload'):
+            shape, chunks = self._payload_bands(secrets)
+        return self._hide_bands(base, shape, chunks, add_noise, engrave_method, out, scratch)
+
+
+MODES = [ LosslessEncoder, LossyEncoder, JpegEncoder, BitPlaneEncoder, BytesEncoder, CompressedEncoder, TiledEncoder, MultiEncoder ]
+METHODS = { 'lossless': LosslessEncoder, 'lossy': LossyEncoder, 'jpeg': JpegEncoder, 'bitplane': BitPlaneEncoder, 'bytes': BytesEncoder, 'tiled': TiledEncoder }
+COMPRESSIONS = [ 'none', 'auto' ] + list(CODEC_IDS)
+# Enough samples for the header of any method
+HEADER_SIZE = max(mode.header_size for mode in MODES)
+
+def make_encoder(mode, compression='none', compression_level=None, threads=None, key=None, block_size=BLOCK_SIZE, **options):
+    # Options an encoder does not support (e.g. bits for the fixed 4 bits encoders) are ignored, as are None ones.
+    # With a codec, the payload of `mode` is compressed by a CompressedEncoder.
+    if compression not in ('none', None):
+        assert compression != 'auto', 'The auto compression needs the images, use choose_encoder'
+        encoder = CompressedEncoder(mode, compression, compression_level, bits=options.get('bits') or 4)
+    else:
+        accepted = inspect.signature(mode.__init__).parameters
+        encoder = mode(**{ name: value for name, value in options.items() if name in accepted and value is not None })
+    encoder.threads = threads
+    encoder.key, encoder.block_size = key, block_size
+    return encoder
+
+def choose_mode(base, secret, use_method='auto'):
+    # Forced methods are used as is, the encoder itself will complain if the secret does not fit
+    if use_method != 'auto':
+        return METHODS[use_method]
+    if max(image_shape(secret)[:2]) > 0xFFFF:
+        # Past the 16 bits sizes of the lossless and lossy headers
+        return TiledEncoder
+    if LosslessEncoder.can_fit(base, secret):
+        return LosslessEncoder
+    elif LossyEncoder.can_fit(base, secret):
+        return LossyEncoder
+    raise ValueError('Base image is not big enough to hide even when using lossy. No resize option specified')
+
+def sample_bits(base):
+    # Size in bits of the samples of `base`
+    return 8 * image_dtype(base).itemsize
+
+def default_bits(base):
+    # Number of LSB used by the bitplane, bytes and tiled methods when not given: 4, or the whole low byte of
+    # 16 bits samples, which stays below the noise floor of most 16 bits images
+    return 4 if sample_bits(base) <= 8 else 8
+
+def choose_encoder(base, secret, use_method='auto', compression='none', compression_level=None, **options):
+    # Same as choose_mode with a compression stage. The `auto` compression first tries without compression,
+    # then the codecs from the fastest to the strongest, and keeps the first one that makes the secret fit.
+    # Bits which are not given follow the samples of the base, see `default_bits`.
+    if options.get('bits') is None:
+        options['bits'] = default_bits(base)
+    if compression == 'none':
+        if use_method == 'auto' and sample_bits(base) > 8 and isinstance(secret, Image.Image):
+            # A byte of the secret per 16 bits sample, twice what the lossless method stores, the secret as it is
+            encoder = make_encoder(BitPlaneEncoder, **options)
+            if encoder.can_fit(base, secret):
+                return encoder
+        return make_encoder(choose_mode(base, secret, use_method), **options)
+    modes = [ LosslessEncoder, LossyEncoder ] if use_method == 'auto' else [ METHODS[use_method] ]
+    codecs = AUTO_CODECS if compression == 'auto' else [ (compression, compression_level) ]
+    for mode in modes:
+        if compression == 'auto':
+            encoder = make_encoder(mode, **options)
+            if encoder.can_fit(base, secret):
+                return encoder
+        for codec, level in codecs:
+            encoder = make_encoder(mode, codec, level, **options)
+            if encoder.can_fit(base, secret):
+                logging.info('Compressing the {} payload with {} (level {})'.format(mode.__name__, codec, encoder.level))
+                return encoder
+    if use_method != 'auto' and compression != 'auto':
+        # Like forced methods, the encoder will complain
+        return encoder
+    raise ValueError('Base image is not big enough to hide the secret, even compressed')
+
+def _base_values(image):
+    # All the samples of `image` as a flat array, arrays being used as they are
+    if isinstance(image, np.ndarray):
+        return image.reshape(-1)
+    return load_array(image).reshape(-1)
+
+def _header_values(image, header_size, key=None, block_size=BLOCK_SIZE):
+    # Only the rows holding the `header_size` first samples are decoded, unless the data is scattered by `key`
+    if key is not None:
+        flat = _base_values(image)
+        return lsb_values(ScatterLayout(key, flat.size, block_size).gather(flat, header_size))
+    height, width, channels = image_shape(image)
+    return lsb_values(read_rows(image, -(-header_size // (width * channels))))
+
+def method_from_header(values):
+    method_value = values[8] & 0x0F
+    return next((m for m in MODES if m.value == method_value), None)
 
 def compute_method_used(image):
-    _arr = np.asarray(image, dtype=np.uint8)
-    method_value = _arr.ravel('C')[8] & 0x0F
-    del _arr
-    method = next((m for m in MODES if m.value == method_value), None)
-    return method
+    return method_from_header(_header_values(image, 9))
+
+def encoder_from_header(values):
+    # The encoder described by the header `values`, with the header read, or None
+    method = method_from_header(values)
+    if method is None:
+        return None
+    encoder = method()
+    encoder._read_header(values)
+    return encoder
+
+def read_encoder(image, key=None, block_size=BLOCK_SIZE):
+    # The encoder that hid data in `image`, with its header read. Only the rows holding the header are decoded,
+    # unless a `key` scattered the data. Without the right key, nothing is found.
+    encoder = encoder_from_header(_header_values(image, HEADER_SIZE, key, block_size))
+    if encoder is not None:
+        encoder.key, encoder.block_size = key, block_size
+    return encoder
+
+def reveals_file(encoder):
+    # Whether `encoder` (a class or an instance with its header read) reveals the bytes of a file
+    method = encoder if isinstance(encoder, type) else type(encoder)
+    return method == BytesEncoder or getattr(encoder, 'source', None) == BytesEncoder
+
+def reveals_bytes(encoder):
+    # Whether `encoder` (a class or an instance with its header read) reveals a byte stream, a JPEG or a file,
+    # which is written as it was hidden instead of going through an image writer
+    method = encoder if isinstance(encoder, type) else type(encoder)
+    return method == JpegEncoder or reveals_file(encoder)
+
+def revealed_output(method, output):
+    # Returns the output path that should be used to store what `method` revealed.
+    # `method` is an encoder class or an instance with its header read.
+    if (method == JpegEncoder or isinstance(method, JpegEncoder)) and output.endswith('.png'):
+        output = '{}.jpg'.format(output[:-4])
+        logging.info('Original image was jpeg encoded, saving its bytes as {}'.format(output))
+    elif reveals_file(method) and output.endswith('.png'):
+        output = '{}.bin'.format(output[:-4])
+        logging.info('A file was hidden, saving its bytes as {}'.format(output))
+    return output
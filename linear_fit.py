@@ -0,0 +1,172 @@
+from PIL import Image
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import threading
+import logging
+import io
+import os
+from linear_encoding_methods import BaseEncoder, LosslessEncoder, LossyEncoder, JpegEncoder
+
+# Finds how to hide a secret that does not fit as is: the method, the downscale of the secret and the JPEG
+# quality are searched together for the best fidelity (PSNR against the original secret) within the capacity
+# of the base.
+#  - lossless and lossy: the largest secret width that fits is found by bisection, sizes being known upfront
+#  - jpeg: for each scale of SCALES, from the largest, the highest quality that fits is found by a bisection
+#    evaluating several qualities in parallel per round. Fidelity being unimodal in the scale, the search stops
+#    once it decreases, or once the best quality fits.
+# Every trial encode is cached, so that the search takes a handful of encodes.
+FIT_METHODS = { 'lossless': LosslessEncoder, 'lossy': LossyEncoder, 'jpeg': JpegEncoder }
+SCALES = (1.0, 0.8, 0.6, 0.45, 0.33, 0.25, 0.15, 0.1)
+QUALITY_RANGE = (5, 95)
+RESAMPLE = Image.LANCZOS
+
+FitResult = namedtuple('FitResult', ['encoder', 'secret', 'scale', 'quality', 'psnr', 'needed', 'available'])
+
+
+def psnr(reference, candidate):
+    difference = reference.astype(np.float64) - candidate.astype(np.float64)
+    mse = np.mean(difference * difference)
+    return float('inf') if mse == 0 else 10 * np.log10(255.0 ** 2 / mse)
+
+
+class FitSearch:
+    def __init__(self, base, secret, methods=tuple(FIT_METHODS), workers=None):
+        self.secret = secret.convert('RGB') if secret.mode != 'RGB' else secret
+        self.reference = np.asarray(self.secret)
+        self.methods = methods
+        self.available = BaseEncoder.available_hidden_size(base)
+        self.workers = workers or os.cpu_count()
+        self.lock = threading.Lock()
+        self.resized = dict()
+        self.encodes = dict()
+
+    def _size(self, width):
+        height = max(1, round(self.secret.height * width / self.secret.width))
+        return width, height
+
+    def _resized(self, width):
+        # Downscaled secrets are shared by all the trials at the same width
+        with self.lock:
+            image = self.resized.get(width)
+        if image is None:
+            image = self.secret if width == self.secret.width else self.secret.resize(self._size(width), RESAMPLE)
+            with self.lock:
+                image = self.resized.setdefault(width, image)
+        return image
+
+    def _jpeg(self, width, quality):
+        # Cached trial encode, returns the JPEG bytes
+        key = (width, quality)
+        with self.lock:
+            data = self.encodes.get(key)
+        if data is None:
+            data = JpegEncoder(quality)._prepare(self._resized(width)).data
+            with self.lock:
+                self.encodes[key] = data
+        return data
+
+    def _fidelity(self, image):
+        if image.size != self.secret.size:
+            image = image.resize(self.secret.size, Image.BICUBIC)
+        return psnr(self.reference, np.asarray(image))
+
+    @staticmethod
+    def _bisect(low, high, fits):
+        # Largest value in [low, high] for which `fits` holds, `fits` being monotonic. None if even `low` fails.
+        if not fits(low):
+            return None
+        while low < high:
+            middle = (low + high + 1) // 2
+            if fits(middle):
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    def _parallel_bisect(self, low, high, fits, pool):
+        # Same as _bisect, each round evaluating up to `workers` points of the interval at once
+        if fits(high):
+            return high
+        if not fits(low):
+            return None
+        # fits(low) and not fits(high)
+        while high - low > 1:
+            count = min(self.workers, high - low - 1)
+            points = sorted({ low + (high - low) * (i + 1) // (count + 1) for i in range(count) })
+            for point, result in zip(points, list(pool.map(fits, points))):
+                if result:
+                    low = point
+                else:
+                    high = point
+                    break
+        return low
+
+    def _raw_candidate(self, method):
+        # Secret sizes of the lossless and lossy encoders only depend on the dimensions
+        per_pixel = 3 * 2 if method is LosslessEncoder else 3
+        fits = lambda width: method.header_size + self._size(width)[0] * self._size(width)[1] * per_pixel <= self.available
+        width = self._bisect(1, self.secret.width, fits)
+        if width is None:
+            return None
+        image = self._resized(width)
+        revealed = image if method is LosslessEncoder else Image.fromarray(np.asarray(image) & 0xF0)
+        needed = method.header_size + width * image.height * per_pixel
+        return FitResult(method(), image, width / self.secret.width, None, self._fidelity(revealed), needed, self.available)
+
+    def _jpeg_candidate(self, scale, pool):
+        width = max(1, round(self.secret.width * scale))
+        fits = lambda quality: JpegEncoder.header_size + self._jpeg(width, quality).size * 2 <= self.available
+        quality = self._parallel_bisect(QUALITY_RANGE[0], QUALITY_RANGE[1], fits, pool)
+        if quality is None:
+            return None
+        data = self._jpeg(width, quality)
+        revealed = Image.open(io.BytesIO(data.tobytes()))
+        needed = JpegEncoder.header_size + data.size * 2
+        return FitResult(JpegEncoder(quality), self._resized(width), width / self.secret.width, quality,
+                         self._fidelity(revealed), needed, self.available)
+
+    def _jpeg_candidates(self, pool):
+        best = None
+        for scale in SCALES:
+            candidate = self._jpeg_candidate(scale, pool)
+            if candidate is None:
+                continue
+            if best is not None and candidate.psnr < best.psnr:
+                break
+            best = candidate
+            yield candidate
+            if candidate.quality == QUALITY_RANGE[1]:
+                # Smaller scales can only lose details
+                break
+
+    def candidates(self):
+        raw = [ FIT_METHODS[m] for m in ('lossless', 'lossy') if m in self.methods ]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            results = [ r for r in pool.map(self._raw_candidate, raw) if r is not None ]
+            if any(r.psnr == float('inf') for r in results):
+                # Lossless at full scale cannot be beaten
+                return results
+            if 'jpeg' in self.methods:
+                results += list(self._jpeg_candidates(pool))
+        return results
+
+    def best(self):
+        candidates = self.candidates()
+        for c in candidates:
+            logging.debug('Fit candidate {} scale {:.2f} quality {}: PSNR {:.2f} dB'.format(
+                type(c.encoder).__name__, c.scale, c.quality, c.psnr))
+        if not candidates:
+            raise ValueError('The secret does not fit in the base with any method, scale and quality')
+        return max(candidates, key=lambda c: c.psnr)
+
+
+def best_fit(base, secret, methods=tuple(FIT_METHODS), workers=None):
+    # Returns the FitResult with the best fidelity. `encoder.hide(base, result.secret, ...)` hides it,
+    # the JPEG of the chosen candidate being already in the payload cache.
+    search = FitSearch(base, secret, methods, workers)
+    result = search.best()
+    logging.info('Best fit: {} with the secret scaled by {:.2f}{}, PSNR {:.2f} dB ({} trial JPEG encodes)'.format(
+        type(result.encoder).__name__, result.scale,
+        '' if result.quality is None else ' at quality {}'.format(result.quality), result.psnr, len(search.encodes)))
+    return result
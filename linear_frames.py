@@ -0,0 +1,255 @@
+from PIL import Image, TiffImagePlugin
+from pathlib import Path
+import numpy as np
+import tempfile
+import logging
+import zlib
+import re
+from linear_io import BAND_ROWS, PNG_COLOR_TYPES, ApngStreamWriter, image_shape
+from linear_writers import WRITERS, save_image, writer_for
+from linear_encoding_methods import revealed_output, reveals_bytes
+from linear_kernels import clear_lsb, fill_noise, read_nibbles, write_nibbles
+from linear_utils import number_to_nibbles, nibbles_to_number
+from linear_streaming import _build_stream, _detect_encoder, _scratch_stream
+from linear_batch import IMAGE_EXTENSIONS
+
+# Hiding across the frames of an animated image (APNG, GIF, multi-page TIFF...) or of a numbered image sequence.
+# The nibble stream of the encoder (header then payload, see linear_streaming.py) is built in a scratch file and
+# split over the frames in order, each frame starting with a frame header (FRAME_FIELDS, in the 4 LSB of its first
+# FRAME_HEADER_SIZE values) giving its position, the number of frames, and the offset and length of its part of the
+# stream. Frames are decoded, filled and written one at a time: memory is bounded by the largest frame.
+# Reveal puts every part back at its offset, so frames read out of order (e.g. a renamed sequence) still work.
+FRAME_FIELDS = (('frame', 8), ('frames', 8), ('offset', 16), ('length', 16), ('total', 16), ('crc', 8))
+FRAME_HEADER_SIZE = sum(count for _, count in FRAME_FIELDS)
+DEFAULT_DURATION = 100
+# Formats the frames can be written to, animated GIF being lossy (palettes)
+FRAME_FORMATS = { '.png': 'apng', '.apng': 'apng', '.tif': 'tiff', '.tiff': 'tiff' }
+
+
+def _natural_key(path):
+    # frame2 before frame10
+    return [ int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', path.name) ]
+
+
+def _frame_mode(image):
+    # Mode all the frames are converted to: the 8 bits mode of the first frame, with alpha when it is transparent
+    if image.mode in PNG_COLOR_TYPES:
+        return image.mode
+    if 'A' in image.getbands() or 'transparency' in image.info:
+        return 'RGBA'
+    return 'RGB'
+
+
+class FrameSource:
+    # Frames of an animated image, or of the images of a directory in natural order, decoded one at a time.
+    # Sizes are read upfront from the headers, so that the capacity is known before anything is decoded.
+    def __init__(self, path):
+        self.path = Path(path)
+        if self.path.is_dir():
+            self.paths = sorted((p for p in self.path.iterdir() if p.is_file() and p.suffix.lower() in IMAGE_EXTENSIONS), key=_natural_key)
+            if not self.paths:
+                raise ValueError('No image found in {}'.format(path))
+            with Image.open(self.paths[0]) as first:
+                self.mode = _frame_mode(first)
+            sizes = []
+            for p in self.paths:
+                with Image.open(p) as image:
+                    sizes.append(image.size)
+        else:
+            self.paths = None
+            with Image.open(self.path) as image:
+                self.mode = _frame_mode(image)
+                sizes = [ image.size ] * getattr(image, 'n_frames', 1)
+        bands = PNG_COLOR_TYPES[self.mode][1]
+        self.shapes = [ (height, width, bands) for width, height in sizes ]
+
+    def __len__(self):
+        return len(self.shapes)
+
+    @property
+    def capacity(self):
+        # Number of values available to the nibble stream, see BaseEncoder.available_hidden_size
+        return sum(max(h * w * c - FRAME_HEADER_SIZE, 0) for h, w, c in self.shapes)
+
+    def names(self):
+        # File names of the frames of a sequence
+        return [ p.name for p in self.paths ] if self.paths is not None else None
+
+    def __iter__(self):
+        # Yields (frame, duration) where frame is a writable (height, width, bands) array
+        if self.paths is not None:
+            for p in self.paths:
+                with Image.open(p) as image:
+                    frame = np.array(image.convert(self.mode), dtype=np.uint8)
+                yield frame.reshape(image_shape(frame)), DEFAULT_DURATION
+            return
+        with Image.open(self.path) as image:
+            for index in range(len(self)):
+                image.seek(index)
+                frame = np.array(image.convert(self.mode), dtype=np.uint8)
+                yield frame.reshape(image_shape(frame)), image.info.get('duration', DEFAULT_DURATION)
+
+
+def frame_format(output):
+    # Format of the frames written to `output`: an animated PNG, a TIFF stack or a directory of images
+    suffix = Path(output).suffix.lower()
+    if not suffix:
+        return 'sequence'
+    if suffix not in FRAME_FORMATS:
+        raise ValueError('Frames are written to .png (APNG), .tif or to a directory, not {}'.format(suffix))
+    return FRAME_FORMATS[suffix]
+
+
+class _ApngFrames:
+    def __init__(self, output, source, writer):
+        height, width, _ = source.shapes[0]
+        if any(shape != source.shapes[0] for shape in source.shapes):
+            raise ValueError('Animated PNG frames need the same size, write the frames to a directory instead')
+        if WRITERS[writer].png is None:
+            raise ValueError('Animated PNG are written with the PNG writers, not {}'.format(writer))
+        self.out = ApngStreamWriter(output, width, height, len(source), source.mode, **WRITERS[writer].png)
+
+    def write_frame(self, index, frame, duration, band_rows):
+        self.out.begin_frame(duration)
+        for top in range(0, len(frame), band_rows):
+            self.out.write_rows(frame[top:top + band_rows])
+
+    def close(self):
+        self.out.close()
+
+
+class _TiffFrames:
+    def __init__(self, output, source, writer):
+        self.file = open(output, 'w+b')
+        self.out = TiffImagePlugin.AppendingTiffWriter(self.file, new=True)
+
+    def write_frame(self, index, frame, duration, band_rows):
+        Image.fromarray(frame.squeeze(axis=2) if frame.shape[2] == 1 else frame).save(self.out, format='TIFF')
+        self.out.newFrame()
+
+    def close(self):
+        self.out.close()
+        self.file.close()
+
+
+class _SequenceFrames:
+    # One image per frame, named after the frames of a sequence, numbered otherwise
+    def __init__(self, output, source, writer):
+        self.directory, self.writer = Path(output), writer
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.names = source.names() or [ 'frame_{:05d}.png'.format(index) for index in range(len(source)) ]
+
+    def write_frame(self, index, frame, duration, band_rows):
+        path = self.directory / Path(self.names[index]).with_suffix('.png')
+        save_image(frame.squeeze(axis=2) if frame.shape[2] == 1 else frame, path, self.writer, band_rows)
+
+    def close(self):
+        pass
+
+
+FRAME_WRITERS = { 'apng': _ApngFrames, 'tiff': _TiffFrames, 'sequence': _SequenceFrames }
+
+
+def _fields_crc(values):
+    nibbles = [ number_to_nibbles(values[name], count) for name, count in FRAME_FIELDS if name != 'crc' ]
+    return zlib.crc32(np.concatenate(nibbles).tobytes())
+
+
+def _write_frame_header(flat, values):
+    clear_lsb(flat, 0, FRAME_HEADER_SIZE)
+    values = dict(values, crc=_fields_crc(values))
+    position = 0
+    for name, count in FRAME_FIELDS:
+        write_nibbles(flat, position, number_to_nibbles(values[name], count))
+        position += count
+
+
+def _read_frame_header(flat):
+    if flat.size < FRAME_HEADER_SIZE:
+        raise ValueError('Frames of {} values cannot hold a frame header'.format(flat.size))
+    values, position = dict(), 0
+    for name, count in FRAME_FIELDS:
+        values[name] = nibbles_to_number(read_nibbles(flat, position, count))
+        position += count
+    if values['crc'] != _fields_crc(values):
+        raise ValueError('No frame header found, the frames do not hold hidden data or were re-encoded')
+    return values
+
+
+def _frame_parts(source, total):
+    # (offset, length) of the part of the stream of every frame, the frames being filled in order
+    parts, offset = [], 0
+    for height, width, bands in source.shapes:
+        length = min(max(height * width * bands - FRAME_HEADER_SIZE, 0), total - offset)
+        parts.append((offset, length))
+        offset += length
+    return parts
+
+
+def frames_hide(encoder, source, secret, output, add_noise=False, band_rows=BAND_ROWS, scratch_dir=None, writer='png'):
+    # `source` is a FrameSource or its path, the frames are written to `output` (see `frame_format`)
+    source = source if isinstance(source, FrameSource) else FrameSource(source)
+    if any(h * w * c < FRAME_HEADER_SIZE for h, w, c in source.shapes):
+        raise ValueError('Frames need at least {} values for their header'.format(FRAME_HEADER_SIZE))
+
+    with tempfile.TemporaryFile(dir=scratch_dir) as scratch_file:
+        stream = _build_stream(encoder, secret, scratch_file, source.capacity, True, band_rows)
+        total = stream.size
+        parts = _frame_parts(source, total)
+        logging.info('Payload of {} nibbles spread over {} frames'.format(total, sum(1 for _, length in parts if length)))
+
+        out = FRAME_WRITERS[frame_format(output)](output, source, writer)
+        try:
+            for index, (frame, duration) in enumerate(source):
+                flat = frame.reshape(-1)
+                offset, length = parts[index]
+                _write_frame_header(flat, dict(frame=index, frames=len(source), offset=offset, length=length, total=total))
+                used = flat[FRAME_HEADER_SIZE:FRAME_HEADER_SIZE + length]
+                if length:
+                    encoder._clear(used, 0, length, offset)
+                    np.bitwise_or(used, stream[offset:offset + length], out=used)
+                if add_noise:
+                    # Past the stream, every value uses `bits`
+                    encoder._clear(flat, FRAME_HEADER_SIZE + length, flat.size, total)
+                    fill_noise(flat, FRAME_HEADER_SIZE + length, bits=encoder.bits, threads=encoder.threads)
+                out.write_frame(index, frame, duration, band_rows)
+        finally:
+            out.close()
+        del stream
+
+
+def frames_reveal(source, output, band_rows=BAND_ROWS, scratch_dir=None, writer=None):
+    # Frames are read until the whole stream is back. The extension of `output` follows the payload found (see
+    # revealed_output and writer_for), returns the encoder and the path written.
+    source = source if isinstance(source, FrameSource) else FrameSource(source)
+
+    with tempfile.TemporaryFile(dir=scratch_dir) as scratch_file:
+        stream, total, received = None, None, 0
+        for index, (frame, _) in enumerate(source):
+            flat = frame.reshape(-1)
+            values = _read_frame_header(flat)
+            if stream is None:
+                total = values['total']
+                stream = _scratch_stream(scratch_file, total)
+            if values['total'] != total or values['offset'] + values['length'] > total:
+                raise ValueError('Frame {} belongs to another payload'.format(index))
+            if values['frame'] != index:
+                logging.warning('Frame {} was hidden as frame {}'.format(index, values['frame']))
+            offset, length = values['offset'], values['length']
+            # Values are copied as is, the encoders only look at the LSB they use
+            np.copyto(stream[offset:offset + length], flat[FRAME_HEADER_SIZE:FRAME_HEADER_SIZE + length])
+            received += length
+            if received >= total:
+                break
+        if received != total:
+            raise ValueError('Only {} nibbles out of {} were found, {} frames were hidden and {} read'.format(received, total, values['frames'], len(source)))
+        logging.info('Payload of {} nibbles read from the frames'.format(total))
+
+        encoder = _detect_encoder(stream)
+        shape = encoder._read_header(stream)
+        output = revealed_output(encoder, str(output))
+        if not reveals_bytes(encoder):
+            encoder.writer, output = writer_for(output, writer)
+        encoder._write_payload(stream, shape, output, band_rows)
+        del stream
+    return encoder, output
@@ -0,0 +1,83 @@
+from PIL import Image
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import logging
+import os
+from linear_io import image_shape, image_dtype, open_base
+from linear_encoding_methods import METHODS, CompressedEncoder, JpegEncoder, TiledEncoder, MultiEncoder, TILED_VERSION, HEADER_SIZE, _header_values, encoder_from_header
+
+# Reports what is hidden in images from their header only: nothing past the rows holding the header is decoded.
+METHOD_NAMES = { mode: name for name, mode in METHODS.items() }
+METHOD_NAMES[CompressedEncoder] = 'compressed'
+METHOD_NAMES[MultiEncoder] = 'packed'
+
+
+def inspect_image(image):
+    # Returns a dict describing the data hidden in `image` (a PIL image or an array), see `inspect_file`
+    height, width, channels = image_shape(image)
+    report = dict(width=width, height=height, bands=channels, sample_bits=8 * image_dtype(image).itemsize,
+                  capacity=height * width * channels)
+    values = _header_values(image, HEADER_SIZE)
+    encoder = encoder_from_header(values)
+    if encoder is None:
+        report['method'] = None
+        return report
+    shape = encoder._read_header(values)
+    end = encoder._payload_end(shape)
+    report.update(method=METHOD_NAMES[type(encoder)], bits=encoder.bits, shape=[int(v) for v in shape],
+                  payload_bytes=int(np.prod(shape, dtype=np.int64)), used_values=int(end),
+                  # A header pointing past the end of the base is most likely noise
+                  fits=bool(end <= report['capacity']))
+    if isinstance(encoder, JpegEncoder):
+        report['shape'] = None
+    if isinstance(encoder, TiledEncoder):
+        rows, columns = encoder._grid(shape)
+        report.update(version=TILED_VERSION, tile=encoder.tile, tiles=rows * columns)
+    if isinstance(encoder, MultiEncoder):
+        # The entries themselves are listed by reveal --list, which reads the index
+        report['index_bytes'] = int(encoder.index_length)
+    if isinstance(encoder, CompressedEncoder):
+        report.update(source=METHOD_NAMES[encoder.source], codec=encoder.codec, level=encoder.level,
+                      compressed_bytes=int(encoder.length))
+    return report
+
+
+def inspect_file(path):
+    # Never raises: unreadable files and corrupted headers are reported in `error`
+    report = dict(path=str(path))
+    try:
+        image = open_base(path)
+        try:
+            report.update(inspect_image(image))
+        finally:
+            if isinstance(image, Image.Image):
+                image.close()
+    except Exception as e:
+        report['error'] = '{}: {}'.format(type(e).__name__, e)
+    return report
+
+
+def _init_worker(log_level):
+    logging.getLogger().setLevel(log_level)
+
+
+def inspect_files(paths, workers=None, chunk_size=64, log_level=logging.WARNING):
+    # Yields the reports of `paths` in order. Files are spread over worker processes by chunks,
+    # which keeps the per file overhead low on large corpora.
+    paths = list(paths)
+    workers = workers or os.cpu_count()
+    if workers == 1 or len(paths) <= 1:
+        yield from map(inspect_file, paths)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(log_level, )) as pool:
+        yield from pool.map(inspect_file, paths, chunksize=chunk_size)
+
+
+def expand_paths(paths, extensions):
+    # Directories are replaced by the files they contain (recursively) having one of `extensions`
+    for path in map(Path, paths):
+        if path.is_dir():
+            yield from sorted(p for p in path.rglob('*') if p.is_file() and p.suffix.lower() in extensions)
+        else:
+            yield path
@@ -0,0 +1,331 @@
+from PIL import Image, ImageFile
+import numpy as np
+import struct
+import zlib
+import os
+import io
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Color type and number of samples per pixel for the 8 bits modes we write
+PNG_COLOR_TYPES = { 'L': (0, 1), 'RGB': (2, 3), 'RGBA': (6, 4) }
+# Unsigned samples the encoders can hide in, see linear_kernels.lsb_values. 16 bits images are single band in
+# Pillow (I;16), wider bases (e.g. 16 bits RGB) are numpy arrays.
+SAMPLE_DTYPES = ( np.dtype(np.uint8), np.dtype('<u2'), np.dtype('>u2') )
+# Type of the samples of the PIL modes, as numpy.asarray decodes them
+MODE_DTYPES = { '1': np.dtype(bool), 'I': np.dtype('<i4'), 'F': np.dtype('<f4'), 'I;16': np.dtype('<u2'),
+                'I;16L': np.dtype('<u2'), 'I;16B': np.dtype('>u2'), 'I;16N': np.dtype('=u2') }
+MODE_DTYPES.update((mode, np.dtype(np.uint8)) for mode in ('L', 'P', 'LA', 'PA', 'La', 'RGB', 'RGBA', 'RGBa', 'RGBX',
+                                                           'CMYK', 'YCbCr', 'LAB', 'HSV'))
+# PNG filter types we can apply to whole bands at once
+PNG_FILTERS = { 'none': 0, 'sub': 1, 'up': 2 }
+IDAT_SIZE = 1 << 20
+BAND_ROWS = 256
+FILE_CHUNK_SIZE = 1 << 20
+
+
+def image_shape(image):
+    # (height, width, bands) of a PIL image or an array, without decoding it
+    if isinstance(image, np.ndarray):
+        return image.shape[0], image.shape[1], image.shape[2] if image.ndim > 2 else 1
+    return image.height, image.width, len(image.getbands())
+
+
+def image_dtype(image):
+    # Type of the samples of a PIL image or an array, without decoding it
+    if isinstance(image, np.ndarray):
+        return image.dtype
+    if image.mode not in MODE_DTYPES:
+        raise ValueError('Images of mode {} are not supported'.format(image.mode))
+    return MODE_DTYPES[image.mode]
+
+
+def check_base(image):
+    # Bases are made of unsigned 8 or 16 bits samples, in any number of bands
+    if image_dtype(image) not in SAMPLE_DTYPES:
+        raise ValueError('Bases need 8 or 16 bits unsigned samples, not {}'.format(getattr(image, 'mode', image_dtype(image))))
+    return image
+
+
+def array_image(array):
+    # `array` as a PIL image when Pillow has a mode for it, as is otherwise (16 bits images with several bands)
+    if array.dtype.itemsize > 1 and array.ndim > 2:
+        return array
+    return Image.fromarray(array)
+
+
+def iter_bands(image, band_rows=BAND_ROWS):
+    # Yields (top, rows) where rows is a C-contiguous array of at most `band_rows` rows of `image`.
+    # Arrays (including np.memmap) are sliced, PIL images are cropped.
+    height, width, _ = image_shape(image)
+    for top in range(0, height, band_rows):
+        bottom = min(top + band_rows, height)
+        if isinstance(image, np.ndarray):
+            yield top, np.ascontiguousarray(image[top:bottom])
+        else:
+            yield top, np.asarray(image.crop((0, top, width, bottom)))
+
+
+def file_length(source):
+    # Number of bytes left in `source`: a path, a bytes-like object or a seekable binary file object
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return memoryview(source).nbytes
+    if isinstance(source, (str, os.PathLike)):
+        return os.path.getsize(source)
+    position = source.tell()
+    length = source.seek(0, io.SEEK_END) - position
+    source.seek(position)
+    return length
+
+
+def iter_chunks(source, chunk_size=FILE_CHUNK_SIZE):
+    # Yields (offset, chunk) over the bytes of `source` (see `file_length`).
+    # Files are read with readinto in a single buffer: a chunk is only valid until the next one is requested.
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        data = np.frombuffer(source, dtype=np.uint8)
+        for offset in range(0, data.size, chunk_size):
+            yield offset, data[offset:offset + chunk_size]
+        return
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            yield from iter_chunks(f, chunk_size)
+        return
+    buffer = np.empty(chunk_size, dtype=np.uint8)
+    view, offset = memoryview(buffer), 0
+    while True:
+        read = source.readinto(view)
+        if not read:
+            return
+        yield offset, buffer[:read]
+        offset += read
+
+
+def _prefix_tile(image, rows):
+    # A fresh handle on the file of `image` decoding only its `rows` first rows, or None when that is not possible.
+    # Non interlaced PNG are decoded row after row by the zip decoder, which stops once the (shrunk) tile is full.
+    # This relies on the internals of Pillow (`_size` and the tile extents), checked here and in `_prefix_rows`.
+    if not isinstance(image, ImageFile.ImageFile) or image.format != 'PNG' or not getattr(image, 'filename', None):
+        return None
+    if image.info.get('interlace') or len(image.tile) != 1 or image.tile[0][0] != 'zip':
+        return None
+    prefix = Image.open(image.filename)
+    tile, extents = prefix.tile[0], (0, 0, prefix.width, rows)
+    if not hasattr(prefix, '_size'):
+        prefix.close()
+        return None
+    prefix._size = (prefix.width, rows)
+    # Tiles are named tuples in recent Pillow versions
+    prefix.tile = [tile._replace(extents=extents) if hasattr(tile, '_replace') else (tile[0], extents) + tuple(tile[2:])]
+    if prefix.size != (image.width, rows):
+        # `size` does not read `_size` in this Pillow version
+        prefix.close()
+        return None
+    return prefix
+
+
+def _prefix_rows(image, rows):
+    # The `rows` first rows of `image` decoded through `_prefix_tile`, or None when the shrunk tile cannot be decoded
+    prefix = _prefix_tile(image, rows)
+    if prefix is None:
+        return None
+    try:
+        with prefix:
+            array = np.asarray(prefix)
+    except (AttributeError, TypeError, ValueError, OSError):
+        return None
+    return array if array.shape[:2] == (rows, image.width) else None
+
+
+def read_rows(image, rows):
+    # The `rows` first rows of `image` as an array, without decoding the rest of PNG files which are not loaded yet
+    height, width, _ = image_shape(image)
+    rows = min(rows, height)
+    if isinstance(image, np.ndarray):
+        return np.asarray(image[:rows])
+    prefix = _prefix_rows(image, rows) if getattr(image, 'im', None) is None else None
+    if prefix is not None:
+        return prefix
+    return np.asarray(image.crop((0, 0, width, rows)))
+
+
+def open_base(path):
+    # Raw numpy arrays are memory-mapped instead of being read
+    if str(path).endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    return Image.open(path)
+
+
+class PngStreamWriter:
+    # Writes a non interlaced 8 bits PNG row band by row band, so that the full image never has to be in memory.
+    # Rows are written unfiltered by default: the LSB we touch are close to noise and filtering barely helps.
+    # `filter` is one of PNG_FILTERS, applied to every row, and `strategy` the zlib strategy (e.g. zlib.Z_RLE).
+    # 16 bits grayscale images (`depth`) are written too, their samples big endian. Pillow reads 16 bits color PNG
+    # as 8 bits, which would lose the LSB, so they are refused.
+    def __init__(self, path, width, height, mode='RGB', compress_level=6, filter='none', strategy=zlib.Z_DEFAULT_STRATEGY, depth=8):
+        self.color_type, self.samples = PNG_COLOR_TYPES[mode]
+        if depth not in (8, 16) or (depth == 16 and self.samples != 1):
+            raise ValueError('{} bits {} PNG cannot be read back losslessly, use npy'.format(depth, mode))
+        self.depth = depth
+        # Bytes per pixel, the distance of the sub filter
+        self.pixel_size = self.samples * depth // 8
+        self.width, self.height = width, height
+        self.filter = PNG_FILTERS[filter]
+        self.compress_level, self.strategy = compress_level, strategy
+        self._start_image()
+        self.pending = []
+        self.pending_size = 0
+        self.file = open(path, 'wb')
+        self.file.write(PNG_SIGNATURE)
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, depth, self.color_type, 0, 0, 0))
+
+    def _start_image(self):
+        # The row above the first one is made of zeros, every image is a zlib stream of its own
+        self.rows_written = 0
+        self.previous = np.zeros(self.width * self.pixel_size, dtype=np.uint8)
+        self.compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, zlib.MAX_WBITS, 8, self.strategy)
+
+    def _chunk(self, kind, data):
+        self.file.write(struct.pack('>I', len(data)))
+        self.file.write(kind)
+        self.file.write(data)
+        self.file.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(kind)) & 0xFFFFFFFF))
+
+    def _compressed(self, data):
+        if data:
+            self.pending.append(data)
+            self.pending_size += len(data)
+        if self.pending_size >= IDAT_SIZE:
+            self._flush_idat()
+
+    def _flush_idat(self):
+        if self.pending:
+            self._chunk(b'IDAT', b''.join(self.pending))
+            self.pending, self.pending_size = [], 0
+
+    def write_rows(self, rows):
+        if self.depth == 16:
+            rows = np.ascontiguousarray(rows, dtype='>u2').view(np.uint8)
+        rows = rows.reshape(len(rows), self.width * self.pixel_size)
+        assert self.rows_written + len(rows) <= self.height
+        # Every row starts with its filter type, 0 being None. Differences wrap around as PNG expects.
+        filtered = np.empty((len(rows), rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = self.filter
+        if self.filter == PNG_FILTERS['sub']:
+            size = self.pixel_size
+            filtered[:, 1:1 + size] = rows[:, :size]
+            np.subtract(rows[:, size:], rows[:, :-size], out=filtered[:, 1 + size:])
+        elif self.filter == PNG_FILTERS['up']:
+            np.subtract(rows[0], self.previous, out=filtered[0, 1:])
+            np.subtract(rows[1:], rows[:-1], out=filtered[1:, 1:])
+            self.previous = rows[-1].copy()
+        else:
+            filtered[:, 1:] = rows
+        self._compressed(self.compressor.compress(filtered))
+        self.rows_written += len(rows)
+
+    def close(self):
+        if self.file.closed:
+            return
+        try:
+            assert self.rows_written == self.height, 'Only {} rows out of {} were written'.format(self.rows_written, self.height)
+            self._compressed(self.compressor.flush())
+            self._flush_idat()
+            self._chunk(b'IEND', b'')
+        finally:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+
+class ApngStreamWriter(PngStreamWriter):
+    # Animated PNG of `frames` frames, each written row band by row band after `begin_frame`. Frames cover the whole
+    # canvas and replace the previous one (no disposal, source blending), so that decoders give them back as written.
+    # The first frame is the default image (IDAT), the others go to fdAT chunks.
+    def __init__(self, path, width, height, frames, mode='RGB', **options):
+        super().__init__(path, width, height, mode, **options)
+        self._chunk(b'acTL', struct.pack('>II', frames, 0))
+        self.frames = frames
+        self.frame = -1
+        self.sequence = 0
+
+    def _end_frame(self):
+        assert self.rows_written == self.height, 'Only {} rows out of {} were written'.format(self.rows_written, self.height)
+        self._compressed(self.compressor.flush())
+        self._flush_idat()
+
+    def begin_frame(self, duration=100):
+        # Ends the current frame and starts the next one, shown for `duration` ms
+        if self.frame >= 0:
+            self._end_frame()
+            self._start_image()
+        self.frame += 1
+        assert self.frame < self.frames, 'Only {} frames were announced'.format(self.frames)
+        self._chunk(b'fcTL', struct.pack('>IIIIIHHBB', self.sequence, self.width, self.height, 0, 0, int(duration), 1000, 0, 0))
+        self.sequence += 1
+
+    def _flush_idat(self):
+        if self.pending and self.frame > 0:
+            self._chunk(b'fdAT', struct.pack('>I', self.sequence) + b''.join(self.pending))
+            self.sequence += 1
+            self.pending, self.pending_size = [], 0
+        super()._flush_idat()
+
+    def close(self):
+        if not self.file.closed and self.frame != self.frames - 1:
+            self.file.close()
+            raise AssertionError('Only {} frames out of {} were written'.format(self.frame + 1, self.frames))
+        super().close()
+
+
+class RawStreamWriter:
+    # Counterpart of PngStreamWriter for byte payloads, written as is
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+
+    def write_rows(self, rows):
+        self.file.write(memoryview(np.ascontiguousarray(rows)).cast('B'))
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class NpyStreamWriter:
+    # Writes rows band by band to a .npy file through a memory map, for raw hand-offs between pipeline stages.
+    # Single band images are stored as 2D arrays, as np.asarray gives them.
+    def __init__(self, path, width, height, bands=3, dtype=np.uint8):
+        shape = (height, width) if bands == 1 else (height, width, bands)
+        self.array = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+        self.rows_written = 0
+
+    def write_rows(self, rows):
+        top = self.rows_written
+        self.array[top:top + len(rows)] = rows.reshape((len(rows), ) + self.array.shape[1:])
+        self.rows_written += len(rows)
+
+    def close(self):
+        if self.array is None:
+            return
+        assert self.rows_written == len(self.array), 'Only {} rows out of {} were written'.format(self.rows_written, len(self.array))
+        self.array.flush()
+        self.array = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.array = None
@@ -0,0 +1,307 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import threading
+import sys
+from linear_io import image_dtype
+
+# In-place kernels for the linear encoders.
+# They work on flat uint8 views of a single writable output buffer and only ever allocate a `scratch` buffer
+# of CHUNK_SIZE elements, which callers can supply and reuse between calls.
+# Nibbles are interleaved with strided views (`dst[0::2]`, `dst[1::2]`) instead of repeat/stack copies.
+# Work is split in chunks which can be processed by a pool of `threads` threads (numpy releases the GIL),
+# each thread having its own scratch buffer. Chunks do not depend on the number of threads, so neither does
+# the output. Bases with wider samples (16 bits) are worked on through the view of their low bytes, see lsb_values.
+LSB_MASK = 0x0F
+MSB_MASK = 0xF0
+CHUNK_SIZE = 1 << 20
+LOAD_BAND_ROWS = 256
+
+# Number of threads used when the kernels are not given one, see `set_threads`
+THREADS = 1
+_pools = dict()
+_local = threading.local()
+
+
+def set_threads(threads):
+    global THREADS
+    THREADS = max(1, int(threads))
+
+
+def _pool(threads):
+    if threads not in _pools:
+        _pools[threads] = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='kernels')
+    return _pools[threads]
+
+
+def scratch_buffer(scratch=None, size=CHUNK_SIZE):
+    if scratch is None or scratch.size < size:
+        return np.empty(size, dtype=np.uint8)
+    return scratch
+
+
+def _thread_scratch(size):
+    scratch = getattr(_local, 'scratch', None)
+    if scratch is None or scratch.size < size:
+        scratch = _local.scratch = np.empty(size, dtype=np.uint8)
+    return scratch
+
+
+def _run(function, chunks, threads=None, scratch=None):
+    # Calls function(chunk, scratch) for every chunk, on the calling thread or on a pool of `threads` threads
+    threads = THREADS if threads is None else threads
+    size = CHUNK_SIZE if scratch is None else scratch.size
+    chunks = list(chunks)
+    if threads <= 1 or len(chunks) <= 1:
+        scratch = scratch_buffer(scratch, size)
+        for chunk in chunks:
+            function(chunk, scratch)
+        return
+    for _ in _pool(threads).map(lambda chunk: function(chunk, _thread_scratch(size)), chunks):
+        pass
+
+
+def _row_chunks(shape, chunk_size=CHUNK_SIZE):
+    # Splits the first axis of `shape` so that every chunk holds at most `chunk_size` elements (at least one row)
+    row_size = int(np.prod(shape[1:], dtype=np.int64)) if len(shape) > 1 else 1
+    step = max(1, chunk_size // max(row_size, 1))
+    for start in range(0, shape[0], step):
+        yield slice(start, min(start + step, shape[0]))
+
+
+def _scratch_view(scratch, shape):
+    return scratch[:int(np.prod(shape, dtype=np.int64))].reshape(shape)
+
+
+def load_array(image, out=None, band_rows=LOAD_BAND_ROWS):
+    # Returns the samples of `image` in a writable C-contiguous array, `out` if given.
+    # PIL images are copied band by band so that no full size temporary is created on the way.
+    if isinstance(image, np.ndarray):
+        if out is None:
+            return image.copy('C')
+        np.copyto(out, image)
+        return out
+    bands = len(image.getbands())
+    shape = (image.height, image.width, bands) if bands > 1 else (image.height, image.width)
+    if out is None:
+        out = np.empty(shape, dtype=image_dtype(image))
+    for top in range(0, image.height, band_rows):
+        bottom = min(top + band_rows, image.height)
+        out[top:bottom] = np.asarray(image.crop((0, top, image.width, bottom)))
+    return out
+
+
+def lsb_values(a):
+    # The flat uint8 view the kernels work on: `a` itself for 8 bits samples, the low byte of every sample for
+    # wider ones. The view is strided and writes go to `a`, so `a` has to be C-contiguous.
+    flat = a.reshape(-1)
+    if a.dtype.itemsize == 1:
+        return flat
+    assert a.flags.c_contiguous, 'The samples of wide bases are written in place, the array has to be C-contiguous'
+    little = a.dtype.byteorder == '<' or (a.dtype.byteorder in '=|' and sys.byteorder == 'little')
+    low = 0 if little else a.dtype.itemsize - 1
+    return flat.view(np.uint8)[low::a.dtype.itemsize]
+
+
+def lsb_mask(bits):
+    return (1 << bits) - 1
+
+
+def clear_lsb(flat, start=0, end=None, bits=4, threads=None):
+    view = flat[start:end]
+    mask = 0xFF ^ lsb_mask(bits)
+    def clear(rows, scratch):
+        np.bitwise_and(view[rows], mask, out=view[rows])
+    _run(clear, _row_chunks(view.shape), threads)
+
+
+def write_nibbles(flat, start, nibbles):
+    # Small writes such as headers, the LSB of the destination are replaced
+    view = flat[start:start + len(nibbles)]
+    view[...] = (view & MSB_MASK) | (np.asarray(nibbles, dtype=np.uint8) & LSB_MASK)
+
+
+def read_nibbles(flat, start, count):
+    return flat[start:start + count] & LSB_MASK
+
+
+def split_into(dst, src, scratch=None, threads=None):
+    # dst[0::2] |= src >> 4 and dst[1::2] |= src & 0x0F, `dst` being a flat view with cleared LSB
+    # and twice as many elements as `src`. `src` can be any (strided) view, e.g. a single channel.
+    msb, lsb = dst[0::2].reshape(src.shape), dst[1::2].reshape(src.shape)
+    def split(rows, scratch):
+        chunk = src[rows]
+        tmp = _scratch_view(scratch, chunk.shape)
+        np.right_shift(chunk, 4, out=tmp)
+        np.bitwise_or(msb[rows], tmp, out=msb[rows])
+        np.bitwise_and(chunk, LSB_MASK, out=tmp)
+        np.bitwise_or(lsb[rows], tmp, out=lsb[rows])
+    scratch = scratch_buffer(scratch)
+    _run(split, _row_chunks(src.shape, scratch.size), threads, scratch)
+
+
+def join_into(out, src, scratch=None, threads=None):
+    # out = (src[0::2] << 4) | (src[1::2] & 0x0F), the inverse of `split_into`. `out` can be a strided view.
+    msb, lsb = src[0::2].reshape(out.shape), src[1::2].reshape(out.shape)
+    def join(rows, scratch):
+        tmp = _scratch_view(scratch, out[rows].shape)
+        np.left_shift(msb[rows], 4, out=out[rows])
+        np.bitwise_and(lsb[rows], LSB_MASK, out=tmp)
+        np.bitwise_or(out[rows], tmp, out=out[rows])
+    scratch = scratch_buffer(scratch)
+    _run(join, _row_chunks(out.shape, scratch.size), threads, scratch)
+
+
+def shift_into(dst, src, scratch=None, threads=None):
+    # dst |= src >> 4, only the MSB of `src` are kept. `dst` is a flat view with cleared LSB.
+    src = src.reshape(-1)
+    def shift(rows, scratch):
+        tmp = _scratch_view(scratch, src[rows].shape)
+        np.right_shift(src[rows], 4, out=tmp)
+        np.bitwise_or(dst[rows], tmp, out=dst[rows])
+    scratch = scratch_buffer(scratch)
+    _run(shift, _row_chunks(src.shape, scratch.size), threads, scratch)
+
+
+def unshift_into(out, src, threads=None):
+    # out = src << 4, the inverse of `shift_into`
+    out, src = out.reshape(-1), src.reshape(-1)
+    def unshift(rows, scratch):
+        np.left_shift(src[rows], 4, out=out[rows])
+    _run(unshift, _row_chunks(out.shape), threads)
+
+
+def _noise_generator(state, position):
+    # The bit generator of the calling thread, moved to `position` draws into the random stream of `state`
+    generator = getattr(_local, 'noise', None)
+    if generator is None:
+        generator = _local.noise = np.random.PCG64()
+    generator.state = state
+    generator.advance(position)
+    return generator
+
+
+def fill_noise(flat, start, end=None, bits=4, chunk_size=CHUNK_SIZE, threads=None):
+    # Random LSB on top of cleared samples. Noise is generated chunk by chunk to bound the memory used.
+    # The chunks share one random stream, seeded from the global numpy state (np.random.seed makes it reproducible),
+    # each 64 bits draw giving 8 samples. A chunk moves the generator of its thread to its part of the stream instead
+    # of seeding a generator, so that the noise depends neither on the number of threads nor on the chunks.
+    view = flat[start:end]
+    state = np.random.PCG64(np.random.randint(0, 1 << 31)).state
+    mask = lsb_mask(bits)
+    def noise(rows, scratch):
+        chunk = view[rows]
+        skip = rows.start % 8
+        draws = _noise_generator(state, rows.start // 8).random_raw(-(-(skip + chunk.size) // 8))
+        values = draws.view(np.uint8)[skip:skip + chunk.size]
+        np.bitwise_and(values, mask, out=values)
+        np.bitwise_or(chunk, values, out=chunk)
+    _run(noise, _row_chunks(view.shape, chunk_size), threads)
+
+
+# Bit-plane packing: a byte stream, read MSB first, is spread over the `bits` LSB of consecutive samples.
+# `bit_offset` is the position of the first bit of `data` in that stream, which lets a payload be written
+# in bands. A sample shared by two bands gets its bits OR-ed by both.
+# The bulk is done by groups of `bits` bytes, i.e. exactly 8 samples, through a uint64 per group.
+# Group misaligned heads and tails (less than `bits` bytes) go through np.unpackbits/np.packbits.
+def _aligned_head(bit_offset, bits, size):
+    # Number of leading bytes to handle before the stream position falls on a sample boundary
+    for head in range(min(bits, size) + 1):
+        if (bit_offset + head * 8) % bits == 0:
+            return head
+    return size
+
+
+def _group_chunks(size, bits, chunk_size):
+    step = max(bits, chunk_size // 8 // bits * bits)
+    for low in range(0, size, step):
+        yield low, min(low + step, size)
+
+
+def _pack_unaligned(flat, start, data, bits, bit_offset):
+    position = bit_offset
+    first, lead = start + position // bits, position % bits
+    stream = np.unpackbits(data)
+    count = -(-(lead + stream.size) // bits)
+    # One row of `bits` bits per sample, packbits pads them on the right
+    lanes = np.zeros((count, bits), dtype=np.uint8)
+    lanes.reshape(-1)[lead:lead + stream.size] = stream
+    values = np.packbits(lanes, axis=1).reshape(-1) >> (8 - bits)
+    np.bitwise_or(flat[first:first + count], values, out=flat[first:first + count])
+
+
+def _unpack_unaligned(flat, start, out, bits, bit_offset):
+    first, lead = start + bit_offset // bits, bit_offset % bits
+    count = -(-(lead + out.size * 8) // bits)
+    planes = np.unpackbits(flat[first:first + count].reshape(-1, 1), axis=1)[:, 8 - bits:]
+    out[...] = np.packbits(planes.reshape(-1)[lead:lead + out.size * 8])
+
+
+def pack_bits(flat, start, data, bits, bit_offset=0, chunk_size=CHUNK_SIZE, threads=None):
+    # flat[start:] |= the bit stream of `data`, `flat` having its `bits` LSB cleared
+    data = data.reshape(-1)
+    if bits == 4 and bit_offset % 4 == 0:
+        first = start + bit_offset // 4
+        split_into(flat[first:first + data.size * 2], data, threads=threads)
+        return
+    if bits == 8 and bit_offset % 8 == 0:
+        first = start + bit_offset // 8
+        view = flat[first:first + data.size]
+        def copy(rows, scratch):
+            np.bitwise_or(view[rows], data[rows], out=view[rows])
+        _run(copy, _row_chunks(data.shape, chunk_size), threads)
+        return
+    head = _aligned_head(bit_offset, bits, data.size)
+    if head:
+        _pack_unaligned(flat, start, data[:head], bits, bit_offset)
+    body = (data.size - head) // bits * bits
+    mask = np.uint64(lsb_mask(bits))
+    def pack(chunk, scratch):
+        low, high = chunk
+        groups = data[head + low:head + high].reshape(-1, bits)
+        first = start + (bit_offset + (head + low) * 8) // bits
+        packed = np.zeros(len(groups), dtype=np.uint64)
+        for i in range(bits):
+            packed <<= np.uint64(8)
+            packed |= groups[:, i]
+        samples = flat[first:first + len(groups) * 8].reshape(-1, 8)
+        for j in range(8):
+            values = ((packed >> np.uint64(bits * (7 - j))) & mask).astype(np.uint8)
+            np.bitwise_or(samples[:, j], values, out=samples[:, j])
+    _run(pack, _group_chunks(body, bits, chunk_size), threads)
+    if head + body < data.size:
+        _pack_unaligned(flat, start, data[head + body:], bits, bit_offset + (head + body) * 8)
+
+
+def unpack_bits(flat, start, out, bits, bit_offset=0, chunk_size=CHUNK_SIZE, threads=None):
+    # Inverse of `pack_bits`, fills the bytes of `out`
+    out = out.reshape(-1)
+    if bits == 4 and bit_offset % 4 == 0:
+        first = start + bit_offset // 4
+        join_into(out, flat[first:first + out.size * 2], threads=threads)
+        return
+    if bits == 8 and bit_offset % 8 == 0:
+        first = start + bit_offset // 8
+        view = flat[first:first + out.size]
+        def copy(rows, scratch):
+            np.copyto(out[rows], view[rows])
+        _run(copy, _row_chunks(out.shape, chunk_size), threads)
+        return
+    head = _aligned_head(bit_offset, bits, out.size)
+    if head:
+        _unpack_unaligned(flat, start, out[:head], bits, bit_offset)
+    body = (out.size - head) // bits * bits
+    mask = np.uint64(lsb_mask(bits))
+    def unpack(chunk, scratch):
+        low, high = chunk
+        groups = out[head + low:head + high].reshape(-1, bits)
+        first = start + (bit_offset + (head + low) * 8) // bits
+        samples = flat[first:first + len(groups) * 8].reshape(-1, 8)
+        packed = np.zeros(len(groups), dtype=np.uint64)
+        for j in range(8):
+            packed <<= np.uint64(bits)
+            packed |= samples[:, j].astype(np.uint64) & mask
+        for i in range(bits):
+            groups[:, i] = packed >> np.uint64(8 * (bits - 1 - i))
+    _run(unpack, _group_chunks(body, bits, chunk_size), threads)
+    if head + body < out.size:
+        _unpack_unaligned(flat, start, out[head + body:], bits, bit_offset + (head + body) * 8)
@@ -0,0 +1,110 @@
+from PIL import Image
+from collections import OrderedDict
+import numpy as np
+import threading
+import weakref
+import hashlib
+import os
+from linear_io import iter_bands
+
+# Payloads that are expensive to compute (JPEG encoding, compression) are prepared once per secret and shared
+# by the sizing (`needed_hidden_size`, `can_fit`) and hiding paths of the encoders, through a bounded LRU cache.
+# Secrets are keyed by content: images and bytes by a hash, files by path, size and modification time.
+# Other objects (e.g. file objects) are keyed by identity, the cache keeping them alive while they are cached.
+CACHE_ENTRIES = 32
+CACHE_BYTES = 256 << 20
+
+
+class PreparedPayload:
+    # What an encoder hides for a secret: the `shape` of the payload and its `data`, an array or a file object
+    # positioned anywhere (users seek it first), of `length` bytes
+    def __init__(self, shape, data, length):
+        self.shape = shape
+        self.data = data
+        self.length = length
+        # Secrets keyed by identity are kept alive by their payload, so that their id is not reused
+        self.secret = None
+
+
+class PayloadCache:
+    def __init__(self, max_entries=CACHE_ENTRIES, max_bytes=CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # Content hashes are computed once per image object. Images and arrays cannot be hashed, they are keyed by
+        # id and their entry is dropped when they are collected, before their id can be reused.
+        self.digests = dict()
+
+    def _digest(self, secret):
+        digest = self.digests.get(id(secret))
+        if digest is not None:
+            return digest
+        h = hashlib.blake2b(digest_size=16)
+        if isinstance(secret, Image.Image):
+            h.update('{} {}'.format(secret.mode, secret.size).encode())
+            for _, rows in iter_bands(secret):
+                h.update(np.ascontiguousarray(rows).data)
+        else:
+            h.update('{} {}'.format(secret.dtype, secret.shape).encode())
+            h.update(np.ascontiguousarray(secret).data)
+        digest = h.hexdigest()
+        try:
+            weakref.finalize(secret, self.digests.pop, id(secret), None)
+        except TypeError:
+            # Not weakly referenceable, the hash cannot be kept
+            return digest
+        self.digests[id(secret)] = digest
+        return digest
+
+    def secret_key(self, secret):
+        if isinstance(secret, (Image.Image, np.ndarray)):
+            return 'image', self._digest(secret)
+        if isinstance(secret, (bytes, bytearray, memoryview)):
+            return 'bytes', hashlib.blake2b(secret, digest_size=16).hexdigest()
+        if isinstance(secret, (str, os.PathLike)):
+            stat = os.stat(secret)
+            return 'path', os.path.abspath(secret), stat.st_size, stat.st_mtime_ns
+        return 'object', id(secret)
+
+    def get(self, secret, params, build):
+        # The prepared payload of `secret` for the encoding `params` (a hashable tuple), `build(secret)` being
+        # called on a miss
+        key = (self.secret_key(secret), params)
+        with self.lock:
+            payload = self.entries.get(key)
+            if payload is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return payload
+        payload = build(secret)
+        if key[0][0] == 'object':
+            payload.secret = secret
+        with self.lock:
+            self.misses += 1
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.nbytes -= previous.length
+            self.entries[key] = payload
+            self.nbytes += payload.length
+            while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.nbytes > self.max_bytes):
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= evicted.length
+        return payload
+
+    def clear(self):
+        # Forgets the payloads and the content hashes, as in a new process
+        with self.lock:
+            self.entries.clear()
+            self.digests.clear()
+            self.nbytes = 0
+
+
+payload_cache = PayloadCache()
+
+
+def prepare(secret, params, build):
+    return payload_cache.get(secret, params, build)
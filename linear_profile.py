@@ -0,0 +1,116 @@
+import threading
+import time
+import json
+
+# Lightweight instrumentation of the hide and reveal pipelines. The pipeline marks its stages with
+#     with stage('construct', nbytes) as s:
+#         ...
+# and every stage is reported as (name, seconds, nbytes) to the registered hooks, e.g. a metrics exporter:
+#     add_hook(lambda name, seconds, nbytes: histogram(name).observe(seconds))
+# or collected by a Profile:
+#     with Profile() as profile:
+#         encoder.hide(...)
+#     profile.report()
+# Without hooks, `stage` returns a shared no-op context, so that instrumentation costs a function call per stage.
+# Stages are: decode, asarray, payload, construct, fromarray and save for hide, decode, asarray, reconstruct,
+# fromarray (or write, when revealing to a file) and save for reveal. Hooks are called from the thread running
+# the stage.
+_hooks = []
+_lock = threading.Lock()
+
+
+class _NullStage:
+    nbytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __setattr__(self, name, value):
+        # Stages may report their size once known, which is dropped here
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    __slots__ = ('name', 'nbytes', 'start')
+
+    def __init__(self, name, nbytes):
+        self.name = name
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start, self.nbytes)
+        return False
+
+
+def stage(name, nbytes=0):
+    # Context timing the stage `name`. `nbytes` is the size of the data it produces, it can be set on the
+    # returned object within the stage when it is only known then.
+    if not _hooks:
+        return _NULL_STAGE
+    return _Stage(name, nbytes)
+
+
+def record(name, seconds, nbytes=0):
+    for hook in list(_hooks):
+        hook(name, seconds, nbytes)
+
+
+def add_hook(hook):
+    # `hook(name, seconds, nbytes)` is called at the end of each stage
+    with _lock:
+        _hooks.append(hook)
+
+
+def remove_hook(hook):
+    with _lock:
+        _hooks.remove(hook)
+
+
+def enabled():
+    return bool(_hooks)
+
+
+class Profile:
+    # Collects the stages run while it is active, summed by name
+    def __init__(self):
+        self.stages = dict()
+        self.lock = threading.Lock()
+        self.wall = 0.0
+
+    def __call__(self, name, seconds, nbytes):
+        with self.lock:
+            entry = self.stages.setdefault(name, dict(count=0, seconds=0.0, bytes=0))
+            entry['count'] += 1
+            entry['seconds'] += seconds
+            entry['bytes'] += int(nbytes)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        add_hook(self)
+        return self
+
+    def __exit__(self, *exc):
+        remove_hook(self)
+        self.wall += time.perf_counter() - self.start
+        return False
+
+    def report(self):
+        # Stages in the order they first ran, with their share of the wall time
+        with self.lock:
+            stages = { name: dict(entry, share=entry['seconds'] / self.wall if self.wall else 0.0)
+                       for name, entry in self.stages.items() }
+        return dict(wall_s=self.wall, stages=stages)
+
+    def dump(self, file):
+        json.dump(self.report(), file, indent=2)
+        file.write('\n')
@@ -0,0 +1,77 @@
+import numpy as np
+import hashlib
+from linear_kernels import _run, CHUNK_SIZE
+
+# Keyed layout of the nibble stream (header then payload) over the whole base, instead of its first samples.
+# The base is cut in blocks of `block_size` samples. The stream fills the blocks in an order drawn from the key,
+# and within every block, runs of RUN_SIZE samples are taken in an order also drawn from the key. Both permutations
+# are generated by numpy from a seed derived from the key, and applied with fancy indexing chunk by chunk:
+# the encoders build the stream in a gathered copy of the blocks it uses, which is scattered back afterwards.
+# Moving runs (as uint64) instead of single samples keeps the gather and the scatter within a few copies of the
+# base. Block sizes which are not a multiple of RUN_SIZE move single samples, a block size of 1 permutes all the
+# samples of the base, at the cost of a permutation as large as the base. Wide samples (16 bits) are moved whole,
+# the encoders only touching their low bytes.
+BLOCK_SIZE = 4096
+RUN_SIZE = 8
+
+
+def key_seed(key):
+    # Seed of the permutations of `key`, a str or bytes
+    data = key.encode() if isinstance(key, str) else bytes(key)
+    digest = hashlib.blake2b(data, digest_size=32, person=b'linear-scatter').digest()
+    return np.random.SeedSequence(np.frombuffer(digest, dtype=np.uint32).tolist())
+
+
+class ScatterLayout:
+    def __init__(self, key, size, block_size=BLOCK_SIZE):
+        # `size` is the number of samples of the base. The samples past the last whole block are never used.
+        self.block_size = block_size
+        self.blocks = size // block_size
+        self.capacity = self.blocks * block_size
+        self.run = RUN_SIZE if block_size % RUN_SIZE == 0 else 1
+        self.runs = block_size // self.run
+        rng = np.random.default_rng(key_seed(key))
+        self.order = rng.permutation(self.blocks)
+        self.inner = rng.permutation(self.runs)
+
+    def _used_blocks(self, count):
+        used = -(-count // self.block_size)
+        assert used <= self.blocks, 'Needed size is {} and available is {} with the key'.format(count, self.capacity)
+        return used
+
+    def _chunks(self, used):
+        step = max(1, CHUNK_SIZE // self.block_size)
+        return [ (first, min(first + step, used)) for first in range(0, used, step) ]
+
+    def _runs(self, flat):
+        # `flat` as an array of runs, moved at once: as uint64 when they are 8 bytes, as opaque records otherwise
+        size = self.run * flat.itemsize
+        kind = { 1: np.uint8, 2: np.uint16, 8: np.uint64 }.get(size, np.dtype((np.void, size)))
+        return flat[:flat.size - flat.size % self.run].view(kind)
+
+    def _indices(self, first, last):
+        # Positions in the base, in runs, of the stream runs of the blocks [first, last)
+        return (self.order[first:last, None] * self.runs + self.inner).reshape(-1)
+
+    def gather(self, flat, count, threads=None):
+        # The samples of `flat` holding the `count` first stream samples, in stream order, rounded up to whole blocks
+        used = self._used_blocks(count)
+        out = np.empty(used * self.block_size, dtype=flat.dtype)
+        source, target = self._runs(flat), self._runs(out)
+
+        def gather_chunk(chunk, scratch):
+            first, last = chunk
+            # Indices are in range by construction, 'clip' spares numpy a bounds check into a buffered copy
+            np.take(source, self._indices(first, last), out=target[first * self.runs:last * self.runs], mode='clip')
+        _run(gather_chunk, self._chunks(used), threads)
+        return out
+
+    def scatter(self, flat, stream, threads=None):
+        # Inverse of `gather`, `stream` being made of whole blocks
+        used = self._used_blocks(stream.size)
+        source, target = self._runs(stream), self._runs(flat)
+
+        def scatter_chunk(chunk, scratch):
+            first, last = chunk
+            target[self._indices(first, last)] = source[first * self.runs:last * self.runs]
+        _run(scatter_chunk, self._chunks(used), threads)
@@ -0,0 +1,354 @@
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit, parse_qsl, urlencode
+import http.client
+import asyncio
+import tempfile
+import logging
+import socket
+import shutil
+import json
+import os
+from linear_batch import Job, process_job
+from linear_inspect import inspect_file
+
+# A local service keeping warm worker processes, so that small images are not dominated by the interpreter,
+# numpy and PIL startup. It speaks a minimal HTTP/1.1 over TCP or a Unix socket:
+#  - POST /hide?base_length=N[&use_method=..&bits=..&compression=..&compression_level=..&fill_with_noise=1]
+#    the body being the base file followed by the secret file (N bytes of base), answers the PNG
+#  - POST /reveal, the body being the image, answers what was hidden (X-Extension tells its kind)
+#  - POST /inspect, the body being the image, answers the JSON report of linear_inspect
+#  - GET /status, answers the number of running and queued jobs
+# Bodies are streamed: requests are spooled to files as they arrive, workers read and write files, and
+# responses are sent back in chunks. At most `workers + queue_size` jobs are accepted, others get a 503.
+IO_CHUNK_SIZE = 1 << 20
+MAX_HEADER_LINES = 100
+# Seconds spent discarding the rest of a refused upload, so that the client gets to read the error
+LINGER = 2.0
+REASONS = { 200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+            422: 'Unprocessable Entity', 500: 'Internal Server Error', 503: 'Service Unavailable', 504: 'Gateway Timeout' }
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+# Jobs run in the worker processes, on files
+def _init_worker(log_level):
+    logging.getLogger().setLevel(log_level)
+
+
+def hide_job(base, secret, output, options):
+    result, encoder = process_job('hide', Job(base, secret, output), options)
+    if result.error is not None:
+        raise ValueError(result.error)
+    return dict(output=result.output, method=type(encoder).__name__, timings=result.timings)
+
+
+def reveal_job(base, output):
+    result, encoder = process_job('reveal', Job(base, None, output), dict())
+    if result.error is not None:
+        raise ValueError(result.error)
+    return dict(output=result.output, method=type(encoder).__name__, timings=result.timings)
+
+
+def _hide_options(query):
+    options = dict(use_method=query.get('use_method', 'auto'), fill_with_noise=query.get('fill_with_noise', '0') in ('1', 'true'),
+                   compression=query.get('compression', 'none'), encoder_options=dict(bits=int(query['bits']) if 'bits' in query else None))
+    if 'compression_level' in query:
+        options['compression_level'] = int(query['compression_level'])
+    return options
+
+
+class SteganoServer:
+    def __init__(self, workers=None, queue_size=16, timeout=60.0, max_body=1 << 34, tmp_dir=None, log_level=logging.WARNING):
+        self.workers = workers or os.cpu_count()
+        self.capacity = self.workers + queue_size
+        self.timeout = timeout
+        self.max_body = max_body
+        self.tmp_dir = tmp_dir
+        self.pending = 0
+        self.abandoned = set()
+        # Submitted jobs not done yet, cancelled on shutdown if they did not start
+        self.jobs = set()
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker, initargs=(log_level, ))
+
+    def warm_up(self):
+        # Starts the worker processes (and their imports) before the first request
+        list(self.pool.map(_init_worker, [logging.getLogger().level] * self.workers))
+
+    # HTTP plumbing
+    async def _read_head(self, reader):
+        request_line = (await reader.readline()).decode('latin-1').strip()
+        if not request_line:
+            return None
+        try:
+            method, target, _ = request_line.split(' ', 2)
+        except ValueError:
+            raise HttpError(400, 'Malformed request line')
+        headers = dict()
+        for _ in range(MAX_HEADER_LINES):
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise HttpError(400, 'Too many headers')
+        return method.upper(), target, headers
+
+    async def _body_chunks(self, reader, headers):
+        # Yields the request body as it arrives, without holding it in memory
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            total = 0
+            while True:
+                size = int((await reader.readline()).split(b';')[0].strip(), 16)
+                if size == 0:
+                    await reader.readline()
+                    return
+                total += size
+                if total > self.max_body:
+                    raise HttpError(413, 'Body larger than {} bytes'.format(self.max_body))
+                yield await reader.readexactly(size)
+                await reader.readline()
+        length = int(headers.get('content-length', 0))
+        if length > self.max_body:
+            raise HttpError(413, 'Body larger than {} bytes'.format(self.max_body))
+        while length > 0:
+            chunk = await reader.read(min(IO_CHUNK_SIZE, length))
+            if not chunk:
+                raise HttpError(400, 'Body shorter than its Content-Length')
+            length -= len(chunk)
+            yield chunk
+
+    async def _spool(self, reader, headers, paths, split=None):
+        # Writes the body to paths[0], or to paths[0] then paths[1] after `split` bytes
+        files = [ open(path, 'wb') for path in paths ]
+        try:
+            current, remaining = 0, split
+            async for chunk in self._body_chunks(reader, headers):
+                while chunk:
+                    if remaining is not None and current == 0 and len(chunk) >= remaining:
+                        files[0].write(chunk[:remaining])
+                        chunk, current, remaining = chunk[remaining:], 1, None
+                        continue
+                    files[current].write(chunk)
+                    if remaining is not None:
+                        remaining -= len(chunk)
+                    chunk = b''
+            if remaining:
+                raise HttpError(400, 'Body shorter than base_length')
+        finally:
+            for f in files:
+                f.close()
+
+    async def _respond(self, writer, status, headers=None, body=b'', path=None):
+        headers = dict(headers or dict(), Connection='close')
+        if path is not None:
+            headers['Transfer-Encoding'] = 'chunked'
+        else:
+            headers['Content-Length'] = str(len(body))
+        head = 'HTTP/1.1 {} {}\r\n'.format(status, REASONS.get(status, '')) + \
+            ''.join('{}: {}\r\n'.format(name, value) for name, value in headers.items()) + '\r\n'
+        writer.write(head.encode('latin-1'))
+        if path is None:
+            writer.write(body)
+            await writer.drain()
+            return
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(IO_CHUNK_SIZE)
+                if not chunk:
+                    break
+                writer.write(b'%x\r\n' % len(chunk) + chunk + b'\r\n')
+                # Waits for the client to keep up
+                await writer.drain()
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+    async def _drain(self, reader):
+        while await reader.read(IO_CHUNK_SIZE):
+            pass
+
+    async def _discard(self, reader, writer):
+        # Closing with unread data resets the connection, often before the client read the response
+        try:
+            if writer.can_write_eof():
+                writer.write_eof()
+            await asyncio.wait_for(self._drain(reader), LINGER)
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+
+    async def _respond_json(self, writer, status, value):
+        await self._respond(writer, status, { 'Content-Type': 'application/json' }, json.dumps(value).encode() + b'\n')
+
+    # Jobs
+    def _release_abandoned(self, future, workdir):
+        # Nobody waits for the result anymore, the slot and the files can go
+        self.pending -= 1
+        if not future.cancelled():
+            future.exception()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    async def _run(self, workdir, function, *args):
+        # Runs a job in the slot taken by `_handle`
+        job = self.pool.submit(function, *args)
+        self.jobs.add(job)
+        job.add_done_callback(self.jobs.discard)
+        future = asyncio.wrap_future(job)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            # The worker cannot be interrupted: its slot and its files are released when it is done
+            self.abandoned.add(workdir)
+            future.add_done_callback(lambda f: self._release_abandoned(f, workdir))
+            raise HttpError(504, 'The job did not finish within {}s'.format(self.timeout))
+        except Exception as e:
+            raise HttpError(422, str(e))
+
+    async def _handle(self, reader, writer, method, target, headers, workdir):
+        url = urlsplit(target)
+        query = dict(parse_qsl(url.query))
+        if url.path == '/status':
+            return await self._respond_json(writer, 200, dict(workers=self.workers, pending=self.pending, capacity=self.capacity))
+        if url.path not in ('/hide', '/reveal', '/inspect'):
+            raise HttpError(404, 'Unknown endpoint {}'.format(url.path))
+        if method != 'POST':
+            raise HttpError(405, 'Use POST')
+        if self.pending >= self.capacity:
+            # Backpressure: the body is not even read
+            raise HttpError(503, 'Too many pending jobs')
+        if url.path == '/hide' and 'base_length' not in query:
+            raise HttpError(400, 'base_length is required')
+        # The slot is taken before the body is read, so that concurrent uploads cannot all pass the check above
+        self.pending += 1
+        try:
+            base = os.path.join(workdir, 'base')
+            if url.path == '/hide':
+                secret = os.path.join(workdir, 'secret')
+                await self._spool(reader, headers, [base, secret], int(query['base_length']))
+                result = await self._run(workdir, hide_job, base, secret, os.path.join(workdir, 'output.png'), _hide_options(query))
+            elif url.path == '/reveal':
+                await self._spool(reader, headers, [base])
+                result = await self._run(workdir, reveal_job, base, os.path.join(workdir, 'output.png'))
+            else:
+                await self._spool(reader, headers, [base])
+                result = await self._run(workdir, inspect_file, base)
+        finally:
+            # Abandoned jobs keep their slot until their worker is done, see _run
+            if workdir not in self.abandoned:
+                self.pending -= 1
+        if url.path == '/inspect':
+            result.pop('path', None)
+            return await self._respond_json(writer, 200, result)
+        extension = os.path.splitext(result['output'])[1]
+        await self._respond(writer, 200, { 'Content-Type': 'application/octet-stream', 'X-Method': result['method'],
+                                           'X-Extension': extension }, path=result['output'])
+
+    async def handle_connection(self, reader, writer):
+        workdir = tempfile.mkdtemp(prefix='stegano-', dir=self.tmp_dir)
+        try:
+            head = await self._read_head(reader)
+            if head is not None:
+                method, target, headers = head
+                logging.info('{} {}'.format(method, target))
+                await self._handle(reader, writer, method, target, headers, workdir)
+        except HttpError as e:
+            logging.info('Request failed with {}: {}'.format(e.status, e))
+            await self._respond_json(writer, e.status, dict(error=str(e)))
+            await self._discard(reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logging.exception('Unexpected error')
+            await self._respond_json(writer, 500, dict(error='{}: {}'.format(type(e).__name__, e)))
+        finally:
+            if workdir in self.abandoned:
+                self.abandoned.discard(workdir)
+            else:
+                shutil.rmtree(workdir, ignore_errors=True)
+            writer.close()
+
+    def close(self):
+        # Jobs still queued are dropped, the running ones finish
+        for job in list(self.jobs):
+            job.cancel()
+        self.pool.shutdown()
+
+    async def serve(self, host='127.0.0.1', port=8765, unix_socket=None):
+        self.warm_up()
+        if unix_socket is not None:
+            server = await asyncio.start_unix_server(self.handle_connection, path=unix_socket)
+            logging.info('Listening on unix:{}'.format(unix_socket))
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port)
+            logging.info('Listening on http://{}:{}'.format(host, port))
+        async with server:
+            await server.serve_forever()
+
+
+def serve(host='127.0.0.1', port=8765, unix_socket=None, **options):
+    server = SteganoServer(**options)
+    try:
+        asyncio.run(server.serve(host, port, unix_socket))
+    finally:
+        server.close()
+
+
+# Client
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def _connection(server, timeout):
+    # `server` is http://host:port or unix:/path/of/the/socket
+    if server.startswith('unix:'):
+        return UnixHTTPConnection(server[len('unix:'):], timeout)
+    url = urlsplit(server)
+    return http.client.HTTPConnection(url.hostname, url.port or 80, timeout=timeout)
+
+
+def _file_chunks(paths):
+    for path in paths:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(IO_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+
+def request(server, endpoint, paths=(), query=None, output=None, timeout=None):
+    # Sends the files `paths` as the body of `endpoint`. The response body is streamed to `output` when given,
+    # returned otherwise. Returns (status, headers, body or None).
+    connection = _connection(server, timeout)
+    try:
+        target = endpoint + ('?' + urlencode(query) if query else '')
+        length = sum(os.path.getsize(path) for path in paths)
+        try:
+            connection.request('POST' if paths else 'GET', target, body=_file_chunks(paths) if paths else None,
+                               headers={ 'Content-Length': str(length) })
+        except (BrokenPipeError, ConnectionResetError):
+            # The server may refuse a request (503) before reading its body, its answer is still there
+            if connection.sock is None:
+                raise
+        response = connection.getresponse()
+        headers = dict((name.lower(), value) for name, value in response.getheaders())
+        if output is None or response.status != 200:
+            return response.status, headers, response.read()
+        with open(output, 'wb') as f:
+            while True:
+                chunk = response.read(IO_CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+        return response.status, headers, None
+    finally:
+        connection.close()
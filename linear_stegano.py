@@ -4,14 +4,22 @@ from pathlib import Path
 import datetime
 import click
 import math
+import json
 import logging
-from linear_encoding_methods import MODES, LossyEncoder, LosslessEncoder, BaseEncoder, METHOD_LOSSLESS, METHOD_LOSSY, compute_method_used, JpegEncoder
-from linear_utils import len_to_np8_16, np8_to_number_16
-
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s.%(msecs)03d %(funcName)18s: %(message)s',
-)
+import os
+from contextlib import contextmanager
+from linear_encoding_methods import default_bits, TILE_SIZE, TiledEncoder, MultiEncoder, MODES, LossyEncoder, BaseEncoder, CompressedEncoder, choose_encoder, read_encoder, revealed_output, reveals_bytes, make_encoder, METHODS, COMPRESSIONS
+from linear_io import BAND_ROWS, open_base, image_dtype, image_shape
+from linear_kernels import set_threads
+from linear_streaming import stream_hide, stream_reveal
+from linear_frames import FrameSource, frames_hide, frames_reveal, frame_format
+from linear_batch import BatchSummary, jobs_from_directories, jobs_from_manifest, run_batch, IMAGE_EXTENSIONS
+from linear_inspect import expand_paths, inspect_files
+from linear_fit import FIT_METHODS, best_fit
+from linear_server import serve as run_server, request
+from linear_profile import Profile, stage
+from linear_writers import WRITERS, writer_for, save_image, can_stream
+from linear_scatter import BLOCK_SIZE as SCATTER_BLOCK
 
 def filename_if_missing(input_file_path, suffix):
     bn = input_file_path.stem
@@ -40,52 +48,156 @@ def check_supported_modes(base, secret):
     b_w, b_h = base.size
     s_w, s_h = secret.size
     supported_modes = []
-    return [mode for mode in MODES if mode.can_fit(base, secret)]
+    return [mode for mode in MODES if mode.image_secret and mode().can_fit(base, secret)]
 
 @click.group()
-def cli():
-    pass
+@click.option('--log-level', type=click.Choice(['debug', 'info', 'warning', 'error'], case_sensitive=False), default='info', help='Verbosity of the logs')
+def cli(log_level):
+    logging.basicConfig(
+        level=log_level.upper(),
+        format='%(asctime)s.%(msecs)03d %(funcName)18s: %(message)s',
+    )
+
+@contextmanager
+def profiled(output):
+    # Writes the stages run within as JSON to `output`, see linear_profile.py
+    if output is None:
+        yield
+        return
+    with Profile() as profile:
+        yield
+    profile.dump(output)
+
+def _open_image(path):
+    with stage('decode') as s:
+        image = open_base(path)
+        if isinstance(image, Image.Image):
+            image.load()
+        s.nbytes = os.path.getsize(path)
+    return image
+
+def _save(image, output, writer):
+    # Images go through `writer` (see linear_writers.py)
+    with stage('save') as s:
+        save_image(image, output, writer)
+        s.nbytes = os.path.getsize(output)
+
+def _check_writer(writer, stream):
+    if stream and not can_stream(writer):
+        raise click.UsageError('--stream writes PNG or npy files, {} cannot be written band by band'.format(writer))
 
 # TODO: non-harcoded version of encoding methods
+def _log_params(ctx):
+    for name, value in ctx.params.items():
+        if name == 'key' and value is not None:
+            value = '<hidden>'
+        logging.info('Using parameter {}: {}'.format(name, value))
+
+def _parse_region(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        region = tuple(int(v) for v in value.split(','))
+    except ValueError:
+        region = ()
+    if len(region) != 4:
+        raise click.BadParameter('expected x,y,w,h, not {}'.format(value))
+    return region
+
+def _check_pack(pack, use_method, fit, compression):
+    # Packed files are entries of a directory, named after the files
+    if use_method != 'auto' or fit != 'none' or compression != 'none':
+        raise click.UsageError('--pack hides files as they are, without --use-method, --fit or --compression')
+    names = [ Path(path).name for path in pack ]
+    duplicates = sorted({ name for name in names if names.count(name) > 1 })
+    if duplicates:
+        raise click.UsageError('Packed files need distinct names: {}'.format(', '.join(duplicates)))
+
+def _check_key(key, stream):
+    # The scattered stream spans the whole base, which the band by band pipeline cannot follow
+    if stream and key is not None:
+        raise click.UsageError('--key scatters the data over the whole base and cannot be used with --stream')
+
 @cli.command()
 @click.option('--base', required=True, type=click.Path(exists=True, dir_okay=False), help='Image that will hide another image')
-@click.option('--secret', required=True, type=click.Path(exists=True, dir_okay=False), help='Image that will be hidden')
+@click.option('--secret', required=False, type=click.Path(exists=True, dir_okay=False), help='Image that will be hidden')
+@click.option('--secret-file', required=False, type=click.Path(exists=True, dir_okay=False), help='Any file that will be hidden as is, instead of an image. Implies --use-method bytes')
+@click.option('--pack', multiple=True, type=click.Path(exists=True, dir_okay=False), help='File hidden as is under its name, can be repeated to hide several files (images included) in one pass. See reveal --list and --entry')
 @click.option('--output', required=False, type=click.Path(), help='Output image')
 @click.option('--base-resize', required=False, type=float, default=1.0, help='Resize to apply to input image regardless of options specified.')
 @click.option('--secret-resize', required=False, type=float, default=1.0, help='Resize to apply to input image regardless of options specified.')
 @click.option('--base-resize-lossless', is_flag=True, type=bool, help='Resize the input image (bigger) so that lossless secret can be hidden. No resize is done if the data would already fit.')
 @click.option('--secret-resize-lossless', is_flag=True, type=bool, help='Resize the input image (smaller) so that lossless secret can be hidden. No resize is done if the data would already fit.')
-@click.option('--use-method', type=click.Choice(['auto', 'lossy', 'lossless', 'jpeg'], case_sensitive=False),  default='auto', help='Force a method of steganography over the automatically chosen one.')
+@click.option('--use-method', type=click.Choice(['auto'] + list(METHODS), case_sensitive=False),  default='auto', help='Force a method of steganography over the automatically chosen one.')
+@click.option('--fit', type=click.Choice(['none', 'best'], case_sensitive=False), default='none', help='best searches the method (or within the forced one), secret downscale and JPEG quality with the best fidelity that fits the base')
+@click.option('--bits', type=click.IntRange(1, 8), default=None, help='Number of LSB used by the bitplane, bytes and tiled methods. Defaults to 4, 8 on 16 bits bases')
+@click.option('--tile-size', type=click.IntRange(1, 0xFFFF), default=TILE_SIZE, help='Side in pixels of the tiles of the tiled method, the unit of partial reveals and corruption checks')
+@click.option('--compression', type=click.Choice(COMPRESSIONS, case_sensitive=False), default='none', help='Compress the secret before hiding it. auto picks the fastest codec making it fit.')
+@click.option('--compression-level', type=click.IntRange(0, 9), default=None, help='Level of the codec given by --compression')
 @click.option('--fill-with-noise/--no-noise', default=False, help='If the leftover space should contain noise')
+@click.option('--stream', is_flag=True, type=bool, help='Process the base band by band with a scratch file, for images too big for memory. Bases can also be .npy files.')
+@click.option('--band-rows', type=int, default=BAND_ROWS, help='Number of rows per band when streaming')
+@click.option('--threads', type=click.IntRange(1), default=1, help='Number of threads used by the encoding kernels')
+@click.option('--writer', type=click.Choice(list(WRITERS), case_sensitive=False), default=None, help='Output format and PNG preset. Defaults to the format of the output extension. The extension is changed to match the writer')
+@click.option('--profile', 'profile_output', required=False, type=click.File('w'), help='Write the time spent and bytes processed by each stage as JSON to this file (- for the standard output)')
+@click.option('--key', required=False, envvar='STEGANO_KEY', help='Scatter the hidden data over the whole base in an order drawn from this key, which is then needed to reveal it. Defaults to $STEGANO_KEY')
+@click.option('--scatter-block', type=click.IntRange(1), default=SCATTER_BLOCK, help='Number of samples moved together when scattering with --key, the same value is needed to reveal')
 @click.pass_context
-def hide(ctx, base, secret, output, base_resize_lossless, use_method, secret_resize_lossless, base_resize, secret_resize, fill_with_noise):
-    for param in ctx.params.items():
-        logging.info('Using parameter {}: {}'.format(*param))
+def hide(ctx, base, secret, secret_file, pack, output, base_resize_lossless, use_method, fit, bits, tile_size, compression, compression_level, secret_resize_lossless, base_resize, secret_resize, fill_with_noise, stream, band_rows, threads, writer, profile_output, key, scatter_block):
+    _log_params(ctx)
+    ctx.with_resource(profiled(profile_output))
+    set_threads(threads)
+    if (secret is not None) + (secret_file is not None) + bool(pack) != 1:
+        raise click.UsageError('Exactly one of --secret, --secret-file and --pack is required')
+    if secret_file is not None:
+        if use_method not in ('auto', 'bytes'):
+            raise click.UsageError('--secret-file can only be hidden with the bytes method')
+        use_method, secret = 'bytes', secret_file
+    if pack:
+        _check_pack(pack, use_method, fit, compression)
     if output is None:
-        output = filename_if_missing(Path(secret), 'hidden')
-    
-    base_image, secret_image = Image.open(base), Image.open(secret)
+        output = filename_if_missing(Path(base), 'packed') if pack else filename_if_missing(Path(secret), 'hidden')
+    writer, output = writer_for(output, writer)
+    _check_writer(writer, stream)
+    _check_key(key, stream)
+
+    base_image = open_base(base) if stream else _open_image(base)
+    bits = default_bits(base_image) if bits is None else bits
+    if image_dtype(base_image).itemsize > 1 and image_shape(base_image)[2] > 1 and writer != 'npy':
+        # The mode of the base is kept, only npy holds 16 bits samples in several bands
+        logging.info('16 bits base with several bands, writing npy')
+        writer, output = writer_for(output, 'npy')
+    # Files hidden by the bytes method (or packed) are read by the encoder, chunk by chunk
+    if pack:
+        secret_image = [ (Path(path).name, path) for path in pack ]
+    else:
+        secret_image = secret if use_method == 'bytes' else _open_image(secret)
     if base_resize != 1.0:
         assert base_resize > 0
         b_w, b_h = calculate_scaled_dimensions(base_image.width, base_image.height, base_resize)
         logging.info('Rescaling base image to size ({}, {}). Scale of {}'.format(b_w, b_h, base_resize))
         base_image = base_image.resize((b_w, b_h))
-    if secret_resize != 1.0:
+    if secret_resize != 1.0 and use_method != 'bytes' and not pack:
         assert secret_resize > 0
         s_w, s_h = calculate_scaled_dimensions(secret_image.width, secret_image.height, secret_resize)
         logging.info('Rescaling secret image to size ({}, {}). Scale of {}'.format(s_w, s_h, secret_resize))
         secret_image = secret_image.resize((s_w, s_h))
 
-    modes = check_supported_modes(base_image, secret_image)
-    mode = None
-    if use_method != 'auto':
+    encoder = None
+    if pack:
+        encoder = make_encoder(MultiEncoder, bits=bits)
+    elif fit == 'best':
+        if use_method not in ['auto'] + list(FIT_METHODS):
+            raise click.UsageError('--fit best works with the {} methods'.format(', '.join(FIT_METHODS)))
+        result = best_fit(base_image, secret_image, tuple(FIT_METHODS) if use_method == 'auto' else (use_method, ))
+        encoder, secret_image = result.encoder, result.secret
+    elif use_method != 'auto':
         logging.info(f'Using the forced method {use_method}')
-        if use_method == 'lossy': method = LossyEncoder
-        elif use_method == 'lossless': method = LosslessEncoder
-        elif use_method == 'jpeg': method = JpegEncoder
+        encoder = choose_encoder(base_image, secret_image, use_method, compression, compression_level, bits=bits, tile=tile_size)
     # We should resize if needed
     elif base_resize_lossless or secret_resize_lossless:
         # Check if we need to even resize one of the images
+        modes = check_supported_modes(base_image, secret_image)
         if LossyEncoder not in modes:
             required_scale = calculate_scale_factor(base_image, secret_image, LossyEncoder)
             assert required_scale > 1.0
@@ -99,17 +211,15 @@ def hide(ctx, base, secret, output, base_resize_lossless, use_method, secret_res
                 logging.info('Creating a new resized secret image of size ({0:d}, {0:d}) to fit lossless (scale of {0:.2f}).'.format(nw, nh, 1.0 / required_scale))
                 secret_image = secret_image.resize((nw, nh))
 
-        mode = LossyEncoder
+        encoder = make_encoder(LossyEncoder, 'none' if compression == 'auto' else compression, compression_level)
     else:
-        if LossyEncoder in modes:
-            mode = LossyEncoder
-        elif LossyEncoder in modes:
-            mode = LossyEncoder
-        else:
-            raise ValueError('Base image is not big enough to hide even when using lossy. No resize option specified')
+        encoder = choose_encoder(base_image, secret_image, 'auto', compression, compression_level, bits=bits, tile=tile_size)
 
-    logging.info('Using n = {} with method {} - filling with noise'.format(4, mode))
-    encoder = mode()
+    encoder.key, encoder.block_size = key, scatter_block
+    logging.info('Using n = {} with method {} - filling with noise'.format(encoder.bits, type(encoder)))
+    if stream:
+        stream_hide(encoder, base_image, secret_image, output, add_noise=fill_with_noise, band_rows=band_rows, writer=writer)
+        return
     try:
         merged_image = encoder.hide(base_image, secret_image, add_noise=fill_with_noise, engrave_method=True)
     except AssertionError as e:
@@ -117,30 +227,301 @@ def hide(ctx, base, secret, output, base_resize_lossless, use_method, secret_res
         logging.error(e)
         exit(1)
     else:
-        merged_image.save(output)
+        _save(merged_image, output, writer)
 
 @cli.command()
 @click.option('--base', required=True, type=click.Path(exists=True, dir_okay=False), help='Image containing secret')
 @click.option('--output', required=False, type=click.Path(), help='Output image')
+@click.option('--stream', is_flag=True, type=bool, help='Only read the bands of the base holding the secret and write it band by band. Bases can also be .npy files.')
+@click.option('--band-rows', type=int, default=BAND_ROWS, help='Number of rows per band when streaming')
+@click.option('--threads', type=click.IntRange(1), default=1, help='Number of threads used by the decoding kernels')
+@click.option('--writer', type=click.Choice(list(WRITERS), case_sensitive=False), default=None, help='Format of revealed images and PNG preset. Defaults to the format of the output extension, JPEG and files being written as is. The extension is changed to match the writer')
+@click.option('--profile', 'profile_output', required=False, type=click.File('w'), help='Write the time spent and bytes processed by each stage as JSON to this file (- for the standard output)')
+@click.option('--key', required=False, envvar='STEGANO_KEY', help='Scatter the hidden data over the whole base in an order drawn from this key, which is then needed to reveal it. Defaults to $STEGANO_KEY')
+@click.option('--scatter-block', type=click.IntRange(1), default=SCATTER_BLOCK, help='Number of samples moved together when scattering with --key, the same value is needed to reveal')
+@click.option('--region', required=False, callback=_parse_region, help='Only reveal the x,y,w,h rectangle of the secret. Needs the tiled method, only the tiles it covers are read')
+@click.option('--list', 'list_entries', is_flag=True, type=bool, help='List the files packed with hide --pack, one JSON line each')
+@click.option('--entry', 'entries', multiple=True, help='Only reveal this packed file, can be repeated. The others are not read')
 @click.pass_context
-def reveal(ctx, base, output):
-    for param in ctx.params.items():
-        logging.info('Using parameter {}: {}'.format(*param))
+def reveal(ctx, base, output, stream, band_rows, threads, writer, profile_output, key, scatter_block, region, list_entries, entries):
+    _log_params(ctx)
+    ctx.with_resource(profiled(profile_output))
+    set_threads(threads)
+    _check_key(key, stream)
+    if stream and region is not None:
+        raise click.UsageError('--region already reads the tiles it needs only and cannot be used with --stream')
+    base_image = open_base(base)
+    if key is not None and isinstance(base_image, Image.Image):
+        # The header and the payload are both spread over the whole base, which is decoded once for both
+        with stage('decode'):
+            base_image = np.asarray(base_image)
+    try:
+        encoder = read_encoder(base_image, key, scatter_block)
+    except ValueError as e:
+        raise click.ClickException('{} (was the data hidden with another --key?)'.format(e))
+    if encoder is None:
+        raise click.ClickException('No hiding method could be detected in the image')
+    if isinstance(encoder, MultiEncoder):
+        if stream or region is not None:
+            raise click.UsageError('Packed files are revealed one by one, without --stream or --region')
+        _reveal_entries(encoder, base_image, output or '{}_revealed'.format(Path(base).stem), writer, list_entries, entries)
+        return
+    if list_entries or entries:
+        raise click.ClickException('--list and --entry need files hidden with hide --pack')
     if output is None:
         output = filename_if_missing(Path(base), 'revealed')
-    base_image = Image.open(base)
-    method = compute_method_used(base_image)
-    if method is not None:
-        encoder = method()
-        unmerged_image = encoder.reveal(base_image)
-    kwargs = dict()
-    if method == JpegEncoder:
-        kwargs['quality'] = 100
-        kwargs['optimize'] = True
-        if output.endswith('.png'):
-            output = '{}.jpg'.format(output[:-4])
-            logging.info('Original image was jpeg encoded, saving as {}'.format(output))
-    unmerged_image.save(output, **kwargs)
+    output = revealed_output(encoder, output)
+    if not reveals_bytes(encoder):
+        # Revealed images go through the writer, JPEG and files are written as they were hidden
+        encoder.writer, output = writer_for(output, writer)
+        _check_writer(encoder.writer, stream)
+    if stream:
+        stream_reveal(base_image, output, encoder, band_rows=band_rows)
+        return
+    if region is not None and not isinstance(encoder, TiledEncoder):
+        raise click.ClickException('--region needs data hidden with the tiled method')
+    try:
+        if region is not None:
+            unmerged_image = encoder.reveal_region(base_image, region)
+        elif reveals_bytes(encoder) or (isinstance(encoder, CompressedEncoder) and can_stream(encoder.writer)):
+            # JPEG and files are written byte for byte as they are read, never decoded, decompressed images band
+            # by band
+            encoder.reveal_to(base_image, output, band_rows)
+            return
+        else:
+            unmerged_image = encoder.reveal(base_image)
+    except AssertionError as e:
+        # Noise read as a header, typically a missing or wrong --key
+        raise click.ClickException('{} (was the data hidden with another --key?)'.format(e))
+    except ValueError as e:
+        # Corrupted tiles, regions out of the secret
+        raise click.ClickException(str(e))
+    _save(unmerged_image, output, encoder.writer)
+
+def _reveal_entries(encoder, base_image, directory, writer, list_entries, names):
+    # Packed files are written in `directory` under their names, images through the writer
+    try:
+        index = encoder.entries(base_image)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    if list_entries:
+        for entry in index:
+            click.echo(json.dumps(entry))
+        return
+    missing = set(names) - { entry['name'] for entry in index }
+    if missing:
+        raise click.ClickException('No packed file named {}'.format(', '.join(sorted(missing))))
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    for entry in index:
+        if names and entry['name'] not in names:
+            continue
+        # Names come from the base, they cannot point out of the directory
+        output = str(Path(directory) / Path(entry['name']).name)
+        revealed = encoder.reveal_entry(base_image, entry['name'], index)
+        if isinstance(revealed, bytes):
+            with stage('save', len(revealed)), open(output, 'wb') as f:
+                f.write(revealed)
+        else:
+            image_writer, output = writer_for(output, writer)
+            _save(revealed, output, image_writer)
+        logging.info('Revealed {} to {}'.format(entry['name'], output))
+
+@cli.command('hide-frames')
+@click.option('--base', required=True, type=click.Path(exists=True), help='Animated image (APNG, GIF, multi-page TIFF...) or directory of images whose frames will hide the secret')
+@click.option('--secret', required=False, type=click.Path(exists=True, dir_okay=False), help='Image that will be hidden')
+@click.option('--secret-file', required=False, type=click.Path(exists=True, dir_okay=False), help='Any file that will be hidden as is, instead of an image. Implies --use-method bytes')
+@click.option('--output', required=False, type=click.Path(), help='Animated PNG (.png), TIFF stack (.tif) or directory of PNG frames')
+@click.option('--use-method', type=click.Choice(['auto'] + list(METHODS), case_sensitive=False),  default='auto', help='Force a method of steganography over the automatically chosen one.')
+@click.option('--bits', type=click.IntRange(1, 8), default=None, help='Number of LSB used by the bitplane, bytes and tiled methods. Defaults to 4, 8 on 16 bits bases')
+@click.option('--tile-size', type=click.IntRange(1, 0xFFFF), default=TILE_SIZE, help='Side in pixels of the tiles of the tiled method, the unit of partial reveals and corruption checks')
+@click.option('--compression', type=click.Choice(COMPRESSIONS, case_sensitive=False), default='none', help='Compress the secret before hiding it. auto picks the fastest codec making it fit.')
+@click.option('--compression-level', type=click.IntRange(0, 9), default=None, help='Level of the codec given by --compression')
+@click.option('--fill-with-noise/--no-noise', default=False, help='If the leftover space should contain noise')
+@click.option('--band-rows', type=int, default=BAND_ROWS, help='Number of rows per band when writing the frames')
+@click.option('--threads', type=click.IntRange(1), default=1, help='Number of threads used by the encoding kernels')
+@click.option('--writer', type=click.Choice(list(WRITERS), case_sensitive=False), default='png', help='PNG preset of animated PNG, format of the frames written to a directory')
+@click.pass_context
+def hide_frames(ctx, base, secret, secret_file, output, use_method, bits, tile_size, compression, compression_level, fill_with_noise, band_rows, threads, writer):
+    _log_params(ctx)
+    set_threads(threads)
+    if (secret is not None) + (secret_file is not None) != 1:
+        raise click.UsageError('Exactly one of --secret and --secret-file is required')
+    if secret_file is not None:
+        if use_method not in ('auto', 'bytes'):
+            raise click.UsageError('--secret-file can only be hidden with the bytes method')
+        use_method, secret = 'bytes', secret_file
+    if output is None:
+        output = '{}_hidden'.format(Path(base).name) if Path(base).is_dir() else filename_if_missing(Path(secret), 'hidden')
+    try:
+        frame_format(output)
+        source = FrameSource(base)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    logging.info('{} frames of mode {}, {} values available'.format(len(source), source.mode, source.capacity))
+
+    secret_image = secret if use_method == 'bytes' else _open_image(secret)
+    try:
+        encoder = choose_encoder(source, secret_image, use_method, compression, compression_level, bits=bits, tile=tile_size)
+        frames_hide(encoder, source, secret_image, output, add_noise=fill_with_noise, band_rows=band_rows, writer=writer)
+    except (AssertionError, ValueError) as e:
+        raise click.ClickException(str(e))
+    logging.info('Secret hidden with method {} in {}'.format(type(encoder).__name__, output))
+
+@cli.command('reveal-frames')
+@click.option('--base', required=True, type=click.Path(exists=True), help='Animated image or directory of frames containing a secret, see hide-frames')
+@click.option('--output', required=False, type=click.Path(), help='Output image')
+@click.option('--band-rows', type=int, default=BAND_ROWS, help='Number of rows per band when writing the secret')
+@click.option('--threads', type=click.IntRange(1), default=1, help='Number of threads used by the decoding kernels')
+@click.option('--writer', type=click.Choice(list(WRITERS), case_sensitive=False), default=None, help='Format of revealed images and PNG preset. Defaults to the format of the output extension, JPEG and files being written as is. The extension is changed to match the writer')
+@click.pass_context
+def reveal_frames(ctx, base, output, band_rows, threads, writer):
+    _log_params(ctx)
+    set_threads(threads)
+    if output is None:
+        output = filename_if_missing(Path(base), 'revealed')
+    try:
+        _, output = frames_reveal(base, output, band_rows=band_rows, writer=writer)
+    except (AssertionError, ValueError) as e:
+        raise click.ClickException(str(e))
+    logging.info('Secret revealed to {}'.format(output))
+
+def _collect_jobs(base_dir, secret_dir, manifest, output_dir, suffix):
+    if manifest is not None:
+        return jobs_from_manifest(manifest, output_dir, suffix)
+    if base_dir is None:
+        raise click.UsageError('Either --base-dir or --manifest is required')
+    return jobs_from_directories(base_dir, secret_dir, output_dir, suffix)
+
+
+def _run_batch(action, jobs, options, workers, chunk_size):
+    summary = BatchSummary()
+    for result in run_batch(action, jobs, options, workers=workers, chunk_size=chunk_size):
+        summary.add(result)
+        if result.error is not None:
+            logging.error('Failed on {}: {}'.format(result.job.base, result.error))
+    for line in summary.lines():
+        click.echo(line)
+    if summary.failed:
+        exit(1)
+
+@cli.command('hide-batch')
+@click.option('--base-dir', required=False, type=click.Path(exists=True, file_okay=False), help='Directory of images that will hide the secrets')
+@click.option('--secret-dir', required=False, type=click.Path(exists=True, file_okay=False), help='Directory of images that will be hidden, paired with the bases by file name')
+@click.option('--manifest', required=False, type=click.Path(exists=True, dir_okay=False), help='CSV or JSON-lines file with base, secret and output entries')
+@click.option('--output-dir', required=False, type=click.Path(file_okay=False), default='.', help='Directory for outputs not specified by the manifest')
+@click.option('--use-method', type=click.Choice(['auto'] + list(METHODS), case_sensitive=False),  default='auto', help='Force a method of steganography over the automatically chosen one.')
+@click.option('--fit', type=click.Choice(['none', 'best'], case_sensitive=False), default='none', help='best searches the method (or within the forced one), secret downscale and JPEG quality with the best fidelity that fits the base')
+@click.option('--bits', type=click.IntRange(1, 8), default=None, help='Number of LSB used by the bitplane, bytes and tiled methods. Defaults to 4, 8 on 16 bits bases')
+@click.option('--tile-size', type=click.IntRange(1, 0xFFFF), default=TILE_SIZE, help='Side in pixels of the tiles of the tiled method, the unit of partial reveals and corruption checks')
+@click.option('--compression', type=click.Choice(COMPRESSIONS, case_sensitive=False), default='none', help='Compress the secrets before hiding them. auto picks the fastest codec making each fit.')
+@click.option('--compression-level', type=click.IntRange(0, 9), default=None, help='Level of the codec given by --compression')
+@click.option('--fill-with-noise/--no-noise', default=False, help='If the leftover space should contain noise')
+@click.option('--writer', type=click.Choice(list(WRITERS), case_sensitive=False), default=None, help='Output format and PNG preset. Defaults to the format of the output extension. The extension is changed to match the writer')
+@click.option('--workers', type=int, default=None, help='Number of worker processes. Defaults to the number of CPUs.')
+@click.option('--chunk-size', type=int, default=4, help='Number of files pipelined together by a worker')
+def hide_batch(base_dir, secret_dir, manifest, output_dir, use_method, fit, bits, tile_size, compression, compression_level, fill_with_noise, writer, workers, chunk_size):
+    if manifest is None and secret_dir is None:
+        raise click.UsageError('Either --secret-dir or --manifest is required')
+    if fit == 'best' and use_method not in ['auto'] + list(FIT_METHODS):
+        raise click.UsageError('--fit best works with the {} methods'.format(', '.join(FIT_METHODS)))
+    jobs = _collect_jobs(base_dir, secret_dir, manifest, output_dir, 'hidden')
+    options = dict(use_method=use_method, fit=fit, fill_with_noise=fill_with_noise, compression=compression,
+                   compression_level=compression_level, writer=writer, encoder_options=dict(bits=bits, tile=tile_size))
+    _run_batch('hide', jobs, options, workers, chunk_size)
+
+@cli.command('reveal-batch')
+@click.option('--base-dir', required=False, type=click.Path(exists=True, file_okay=False), help='Directory of images containing secrets')
+@click.option('--manifest', required=False, type=click.Path(exists=True, dir_okay=False), help='CSV or JSON-lines file with base and output entries')
+@click.option('--output-dir', required=False, type=click.Path(file_okay=False), default='.', help='Directory for outputs not specified by the manifest')
+@click.option('--writer', type=click.Choice(list(WRITERS), case_sensitive=False), default=None, help='Format of revealed images and PNG preset. Defaults to the format of the output extension. The extension is changed to match the writer')
+@click.option('--workers', type=int, default=None, help='Number of worker processes. Defaults to the number of CPUs.')
+@click.option('--chunk-size', type=int, default=4, help='Number of files pipelined together by a worker')
+def reveal_batch(base_dir, manifest, output_dir, writer, workers, chunk_size):
+    jobs = _collect_jobs(base_dir, None, manifest, output_dir, 'revealed')
+    _run_batch('reveal', jobs, dict(writer=writer), workers, chunk_size)
+
+@cli.command()
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('--output', required=False, type=click.File('w'), default='-', help='JSON-lines file receiving one report per image. Defaults to the standard output')
+@click.option('--workers', type=int, default=None, help='Number of worker processes. Defaults to the number of CPUs.')
+@click.option('--chunk-size', type=int, default=64, help='Number of files sent to a worker at once')
+def inspect(paths, output, workers, chunk_size):
+    # Only the header of each image is decoded
+    files = list(expand_paths(paths, IMAGE_EXTENSIONS | { '.npy' }))
+    for report in inspect_files(files, workers=workers, chunk_size=chunk_size):
+        output.write(json.dumps(report) + '\n')
+
+@cli.command()
+@click.option('--host', default='127.0.0.1', help='Address to listen on')
+@click.option('--port', type=int, default=8765, help='TCP port to listen on')
+@click.option('--unix-socket', required=False, type=click.Path(), help='Listen on this Unix socket instead of TCP')
+@click.option('--workers', type=int, default=None, help='Number of warm worker processes. Defaults to the number of CPUs.')
+@click.option('--queue-size', type=click.IntRange(0), default=16, help='Number of jobs waiting for a worker before requests are refused with a 503')
+@click.option('--timeout', type=float, default=60.0, help='Seconds a job may take before the request fails with a 504')
+@click.option('--tmp-dir', required=False, type=click.Path(file_okay=False), help='Directory spooling the request and response bodies')
+def serve(host, port, unix_socket, workers, queue_size, timeout, tmp_dir):
+    # Workers log at the level of the server
+    run_server(host, port, unix_socket, workers=workers, queue_size=queue_size, timeout=timeout, tmp_dir=tmp_dir,
+               log_level=logging.getLogger().level)
+
+@cli.group()
+@click.option('--server', default='http://127.0.0.1:8765', help='Address of the server, http://host:port or unix:/path/to/socket')
+@click.option('--timeout', type=float, default=None, help='Seconds to wait for the server')
+@click.pass_context
+def client(ctx, server, timeout):
+    ctx.obj = dict(server=server, timeout=timeout)
+
+def _check_response(status, body):
+    if status != 200:
+        message = json.loads(body).get('error', '') if body else ''
+        raise click.ClickException('The server answered {}: {}'.format(status, message))
+
+@client.command('hide')
+@click.option('--base', required=True, type=click.Path(exists=True, dir_okay=False), help='Image that will hide the secret')
+@click.option('--secret', required=True, type=click.Path(exists=True, dir_okay=False), help='Image (or file with --use-method bytes) that will be hidden')
+@click.option('--output', required=False, type=click.Path(), help='Output image')
+@click.option('--use-method', type=click.Choice(['auto'] + list(METHODS), case_sensitive=False),  default='auto', help='Force a method of steganography over the automatically chosen one.')
+@click.option('--bits', type=click.IntRange(1, 8), default=None, help='Number of LSB used by the bitplane, bytes and tiled methods. Defaults to 4, 8 on 16 bits bases')
+@click.option('--compression', type=click.Choice(COMPRESSIONS, case_sensitive=False), default='none', help='Compress the secret before hiding it')
+@click.option('--compression-level', type=click.IntRange(0, 9), default=None, help='Level of the codec given by --compression')
+@click.option('--fill-with-noise/--no-noise', default=False, help='If the leftover space should contain noise')
+@click.pass_obj
+def client_hide(obj, base, secret, output, use_method, bits, compression, compression_level, fill_with_noise):
+    if output is None:
+        output = filename_if_missing(Path(secret), 'hidden')
+    query = dict(base_length=Path(base).stat().st_size, use_method=use_method, compression=compression,
+                 fill_with_noise=int(fill_with_noise))
+    if bits is not None:
+        query['bits'] = bits
+    if compression_level is not None:
+        query['compression_level'] = compression_level
+    status, headers, body = request(obj['server'], '/hide', [base, secret], query, output, obj['timeout'])
+    _check_response(status, body)
+    logging.info('Hidden with {} into {}'.format(headers.get('x-method'), output))
+
+@client.command('reveal')
+@click.option('--base', required=True, type=click.Path(exists=True, dir_okay=False), help='Image containing secret')
+@click.option('--output', required=False, type=click.Path(), help='Output file. Its extension is replaced by the one of the revealed data')
+@click.pass_obj
+def client_reveal(obj, base, output):
+    if output is None:
+        output = filename_if_missing(Path(base), 'revealed')
+    partial = output + '.part'
+    status, headers, body = request(obj['server'], '/reveal', [base], output=partial, timeout=obj['timeout'])
+    _check_response(status, body)
+    # The server tells what was hidden: .png, .jpg or .bin for files
+    output = str(Path(output).with_suffix(headers.get('x-extension', Path(output).suffix)))
+    Path(partial).replace(output)
+    logging.info('Revealed with {} into {}'.format(headers.get('x-method'), output))
+
+@client.command('inspect')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.pass_obj
+def client_inspect(obj, paths):
+    for path in paths:
+        status, _, body = request(obj['server'], '/inspect', [path], timeout=obj['timeout'])
+        _check_response(status, body)
+        click.echo(json.dumps(dict(path=path, **json.loads(body))))
 
 if __name__ == "__main__":
     cli()
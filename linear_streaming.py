@@ -0,0 +1,98 @@
+import numpy as np
+import tempfile
+import logging
+from linear_io import BAND_ROWS, image_shape, image_dtype, check_base, iter_bands, read_rows
+from linear_writers import stream_writer
+from linear_kernels import LSB_MASK, fill_noise, lsb_values, scratch_buffer, write_nibbles
+from linear_encoding_methods import MODES, HEADER_SIZE
+
+# Streaming versions of BaseEncoder.hide and BaseEncoder.reveal.
+# The nibble stream (header then payload) lives in a np.memmap scratch file and the base is processed
+# band by band, so memory stays bounded by `band_rows` whatever the size of the images.
+
+
+def _scratch_stream(scratch_file, size):
+    return np.memmap(scratch_file, dtype=np.uint8, mode='w+', shape=(size, ))
+
+
+def _build_stream(encoder, secret, scratch_file, capacity, engrave_method=True, band_rows=BAND_ROWS):
+    # Writes the nibble stream of `secret` to a scratch memmap of its length, `capacity` being the number of values
+    # available to hold it
+    shape, payload_bands = encoder._payload_bands(secret, band_rows)
+    end = encoder._payload_end(shape)
+    assert capacity >= end, 'Needed size is {} and available is {}'.format(end, capacity)
+    scratch = scratch_buffer()
+    # The scratch file starts zeroed, i.e. with cleared LSB
+    stream = _scratch_stream(scratch_file, end)
+    encoder._write_header(stream, shape)
+    for top, band in payload_bands:
+        encoder._write_band(stream, band, top, shape, scratch)
+    if engrave_method:
+        write_nibbles(stream, 8, [encoder.value])
+    logging.info('Payload of {} nibbles written to the scratch file'.format(end))
+    return stream
+
+
+def _detect_encoder(flat):
+    # Encoder of the method engraved in the header starting at flat[0], `flat` holding at least 9 values
+    method_value = flat[8] & LSB_MASK
+    method = next((m for m in MODES if m.value == method_value), None)
+    if method is None:
+        raise ValueError('No hiding method could be detected in the image')
+    return method()
+
+
+def stream_hide(encoder, base, secret, output, add_noise=False, engrave_method=True, band_rows=BAND_ROWS, scratch_dir=None, writer='png'):
+    height, width, channels = image_shape(check_base(base))
+
+    with tempfile.TemporaryFile(dir=scratch_dir) as scratch_file:
+        stream = _build_stream(encoder, secret, scratch_file, height * width * channels, engrave_method, band_rows)
+        end = stream.size
+
+        with stream_writer(writer, output, (height, width, channels), image_dtype(base)) as out:
+            for top, rows in iter_bands(base, band_rows):
+                # Samples keep their type, only their low bytes are touched
+                rows = np.array(rows)
+                flat = lsb_values(rows)
+                first = top * width * channels
+                # Samples of the band holding the header or the payload
+                used = min(max(end - first, 0), flat.size)
+                if used:
+                    encoder._clear(flat, 0, used, first)
+                    np.bitwise_or(flat[:used], stream[first:first + used], out=flat[:used])
+                if add_noise and used < flat.size:
+                    encoder._clear(flat, used, flat.size, first)
+                    fill_noise(flat, used, bits=encoder.bits, threads=encoder.threads)
+                out.write_rows(rows)
+        del stream
+
+
+def stream_reveal(base, output, encoder=None, band_rows=BAND_ROWS, scratch_dir=None):
+    # Only the bands holding the payload are read
+    height, width, channels = image_shape(base)
+    bands = iter_bands(base, band_rows)
+    scratch = scratch_buffer()
+
+    # The header can span several bands (narrow bases, small bands), it is read from the rows holding it first
+    header = lsb_values(read_rows(base, -(-HEADER_SIZE // (width * channels))))
+    if encoder is None:
+        encoder = _detect_encoder(header)
+    shape = encoder._read_header(header)
+    end = encoder._payload_end(shape)
+    assert end <= height * width * channels, 'The header is corrupted, the payload would not fit in the base'
+
+    with tempfile.TemporaryFile(dir=scratch_dir) as scratch_file:
+        stream = _scratch_stream(scratch_file, end)
+        for top, rows in bands:
+            flat = lsb_values(rows)
+            first = top * width * channels
+            # Values are copied as is, the encoders only look at the LSB they use
+            used = min(end - first, flat.size)
+            np.copyto(stream[first:first + used], flat[:used])
+            if first + used >= end:
+                break
+        logging.info('Payload of {} nibbles read to the scratch file'.format(end))
+
+        encoder._write_payload(stream, shape, output, band_rows, scratch)
+        del stream
+    return encoder
@@ -38,4 +38,15 @@ def np8_to_number_32(np8_len_arr):
 #         print(v)
         total += int(v) << (28- 4*i)
 #     print(total)
-    return total
\ No newline at end of file
+    return total
+def number_to_nibbles(number, count):
+    # Generalization of len_to_np8_16/len_to_np8_32 to `count` nibbles, MSBs first
+    assert 0 <= number < (1 << (4 * count))
+    shifts = np.arange(4 * (count - 1), -1, -4, dtype=np.uint64)
+    return ((np.uint64(number) >> shifts) & np.uint64(0x0F)).astype(np.uint8)
+
+def nibbles_to_number(nibbles):
+    total = 0
+    for v in nibbles:
+        total = (total << 4) | (int(v) & 0x0F)
+    return total
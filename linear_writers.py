@@ -0,0 +1,77 @@
+from PIL import Image
+from collections import namedtuple
+from pathlib import Path
+import numpy as np
+import zlib
+from linear_io import PNG_COLOR_TYPES, PngStreamWriter, NpyStreamWriter, image_shape, image_dtype, iter_bands, BAND_ROWS
+
+# Output formats of hide and reveal. The LSB we write are close to noise and compress badly: the default PNG
+# settings of Pillow (zlib level 6, adaptive filtering) often cost more than the encoding, for a few percent of size.
+#  - png: Pillow defaults, the historical output (band by band when streaming, unfiltered at level 6)
+#  - png-fast, png-store, png-rle: PNG written band by band with a fixed filter and zlib settings
+#  - tiff, bmp: uncompressed, through Pillow
+#  - npy: the raw array, memory-mapped when read back (see linear_io.open_base), for hand-offs between stages
+# Every format can be revealed from. 16 bits grayscale images are written as 16 bits PNG or TIFF, 16 bits images
+# with several bands only as npy, Pillow reading 16 bits color PNG as 8 bits.
+#  - `png` are the options of PngStreamWriter, None when the format cannot be written band by band
+#  - `pillow` is the format name given to Image.save, None when Pillow is not used for whole images
+Writer = namedtuple('Writer', ['extension', 'png', 'pillow'])
+WRITERS = {
+    'png': Writer('.png', dict(compress_level=6), 'PNG'),
+    'png-fast': Writer('.png', dict(compress_level=1), None),
+    'png-store': Writer('.png', dict(compress_level=0), None),
+    # Close to the size of the Pillow defaults, several times faster
+    'png-rle': Writer('.png', dict(compress_level=6, filter='up', strategy=zlib.Z_RLE), None),
+    'tiff': Writer('.tif', None, 'TIFF'),
+    'bmp': Writer('.bmp', None, 'BMP'),
+    'npy': Writer('.npy', None, None),
+}
+EXTENSIONS = { '.png': 'png', '.tif': 'tiff', '.tiff': 'tiff', '.bmp': 'bmp', '.npy': 'npy' }
+
+
+def writer_for(output, writer=None):
+    # Returns the writer to use for `output`, by default the one of its extension, and `output` with the extension
+    # of the writer
+    output = str(output)
+    suffix = Path(output).suffix.lower()
+    if writer is None:
+        writer = EXTENSIONS.get(suffix, 'png')
+    if EXTENSIONS.get(suffix) != writer and WRITERS[writer].extension != suffix:
+        output = str(Path(output).with_suffix(WRITERS[writer].extension))
+    return writer, output
+
+
+def can_stream(writer):
+    return writer == 'npy' or WRITERS[writer].png is not None
+
+
+def stream_writer(writer, output, shape, dtype=np.uint8):
+    # A writer of `shape` (height, width, bands) rows of `dtype` samples for `output`, see PngStreamWriter
+    height, width, bands = shape
+    if writer == 'npy':
+        return NpyStreamWriter(output, width, height, bands, dtype)
+    if not can_stream(writer):
+        raise ValueError('The {} writer cannot write band by band, use png or npy'.format(writer))
+    mode = next(mode for mode, (_, samples) in PNG_COLOR_TYPES.items() if samples == bands)
+    return PngStreamWriter(output, width, height, mode, depth=8 * np.dtype(dtype).itemsize, **WRITERS[writer].png)
+
+
+def save_image(image, output, writer=None, band_rows=BAND_ROWS):
+    # Writes `image` (a PIL image or an array) to `output` with `writer`, returns the path written, which can have
+    # another extension (see `writer_for`)
+    writer, output = writer_for(output, writer)
+    if writer == 'npy':
+        np.save(output, np.asarray(image))
+        return output
+    dtype, bands = image_dtype(image), image_shape(image)[2]
+    if dtype.itemsize > 1 and bands > 1:
+        raise ValueError('16 bits images with {} bands can only be written with the npy writer'.format(bands))
+    streamable = isinstance(image, np.ndarray) or image.mode in PNG_COLOR_TYPES or dtype.itemsize > 1
+    if WRITERS[writer].pillow is not None or not streamable:
+        image = Image.fromarray(image) if isinstance(image, np.ndarray) else image
+        image.save(output, format=WRITERS[writer].pillow or 'PNG')
+        return output
+    with stream_writer(writer, output, image_shape(image), dtype) as out:
+        for _, rows in iter_bands(image, band_rows):
+            out.write_rows(rows)
+    return output
@@ -1,5 +1,6 @@
 import click
-from PIL import Image, ImageMath
+import functools
+from PIL import Image, ImageMath, ImageChops
 
 MASKS = {
     0: 0b00000000,
@@ -48,13 +49,45 @@ def _full_merge(img1, img2, n=4):
 
 def _unmerge(img, n=4):
     r, g, b = img.split()
-    o_r = ImageMath.eval(" (a << n) & m ", a=r, m=MASKS[n], n=8-n).convert('L')
-    o_g = ImageMath.eval(" (a << n) & m ", a=g, m=MASKS[n], n=8-n).convert('L')
-    o_b = ImageMath.eval(" (a << n) & m ", a=b, m=MASKS[n], n=8-n).convert('L')
+    o_r = ImageMath.eval("(a << n) & m", a=r, m=MASKS[n], n=8-n).convert('L')
+    o_g = ImageMath.eval("(a << n) & m", a=g, m=MASKS[n], n=8-n).convert('L')
+    o_b = ImageMath.eval("(a << n) & m", a=b, m=MASKS[n], n=8-n).convert('L')
     output = Image.merge("RGB", (o_r, o_g, o_b))
     return output
 
 
+# Lookup table backend. The ImageMath expressions above split the bands and compute on 32 bits images, the
+# same operations are a per value mapping of each image: Image.point applies them to all the bands in one pass
+# on 8 bits, and ImageChops.add (which crops to the smaller image, like ImageMath) combines the two images.
+# The sum never goes past 255, the MSB of one image and the LSB of the other being disjoint.
+@functools.lru_cache(maxsize=None)
+def _tables(n, bands=3):
+    # Tables keeping the 8-n MSB, moving the n MSB to the LSB and moving the n LSB to the MSB, for every band
+    msb = [ v & MASKS[8-n] for v in range(256) ] * bands
+    shifted = [ v >> (8-n) for v in range(256) ] * bands
+    lsb = [ (v << (8-n)) & MASKS[n] for v in range(256) ] * bands
+    return msb, shifted, lsb
+
+def _lut_naive_merge(img1, img2, n=4):
+    msb, shifted, _ = _tables(n, len(img1.getbands()))
+    return ImageChops.add(img1.point(msb), img2.point(shifted))
+
+def _lut_full_merge(img1, img2, n=4):
+    msb, shifted, _ = _tables(n, len(img1.getbands()))
+    cleared = img1.point(msb)
+    cleared.paste(ImageChops.add(cleared, img2.point(shifted)))
+    return cleared
+
+def _lut_unmerge(img, n=4):
+    return img.point(_tables(n, len(img.getbands()))[2])
+
+# Naive merge, full merge and unmerge of each backend
+BACKENDS = {
+    'imagemath': (_naive_merge, _full_merge, _unmerge),
+    'lut': (_lut_naive_merge, _lut_full_merge, _lut_unmerge),
+}
+
+
 @click.group()
 def cli():
     pass
@@ -66,12 +99,14 @@ def cli():
 @click.option('--output', required=True, type=str, help='Output image')
 @click.option('-n', type=int, help='Number of bits to use')
 @click.option('--full/--naive', default=False, help='Use the full original image (slower)')
-def merge(img1, img2, output, n, full):
+@click.option('--backend', type=click.Choice(list(BACKENDS)), default='imagemath', help='ImageMath expressions per band, or lookup tables over all the bands at once (faster, same output)')
+def merge(img1, img2, output, n, full, backend):
     print('Using n = {} with method {}'.format(n, 'FULL' if full else 'CROPPED'))
+    naive_merge, full_merge, _ = BACKENDS[backend]
     if full:
-        merged_image = _full_merge(Image.open(img1), Image.open(img2), n)
+        merged_image = full_merge(Image.open(img1), Image.open(img2), n)
     else:
-        merged_image = _naive_merge(Image.open(img1), Image.open(img2), n)
+        merged_image = naive_merge(Image.open(img1), Image.open(img2), n)
     merged_image.save(output)
 
 
@@ -80,8 +115,9 @@ def merge(img1, img2, output, n, full):
 @click.option('--output', required=True, type=str, help='Output image')
 @click.option('-n', type=int, help='Number of bits to use')
 @click.option('--crop/--no-crop', default=False, help='Whether to crop the output image. Useful when image was saved with --full')
-def unmerge(img, output, n, crop):
-    unmerged_image = _unmerge(Image.open(img), n)
+@click.option('--backend', type=click.Choice(list(BACKENDS)), default='imagemath', help='ImageMath expressions per band, or lookup tables over all the bands at once (faster, same output)')
+def unmerge(img, output, n, crop, backend):
+    unmerged_image = BACKENDS[backend][2](Image.open(img), n)
     if crop:
         box = unmerged_image.getbbox()
         unmerged_image = unmerged_image.crop(box)
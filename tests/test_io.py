@@ -0,0 +1,35 @@
+from PIL import Image
+import numpy as np
+import pytest
+import linear_io
+from linear_io import read_rows
+
+
+@pytest.fixture(params=[ ('RGB', (300, 120, 3)), ('L', (300, 120)), ('I;16', (300, 120)) ])
+def png(request, tmp_path):
+    mode, shape = request.param
+    dtype = np.uint16 if mode == 'I;16' else np.uint8
+    array = np.random.default_rng(0).integers(0, np.iinfo(dtype).max, shape, dtype=dtype, endpoint=True)
+    path = tmp_path / 'base.png'
+    Image.fromarray(array, mode).save(path)
+    return path, array
+
+
+@pytest.mark.parametrize('rows', [ 1, 7, 256, 300, 1000 ])
+def test_read_rows_decodes_the_first_rows(png, rows):
+    path, array = png
+    with Image.open(path) as image:
+        assert np.array_equal(read_rows(image, rows), array[:rows])
+
+
+def test_read_rows_falls_back_to_a_full_decode(png, monkeypatch):
+    # A Pillow version whose decoders refuse the shrunk tile
+    def broken_prefix(image, rows):
+        prefix = Image.open(image.filename)
+        prefix.tile = [ ('no-such-decoder', ) + tuple(prefix.tile[0][1:]) ]
+        return prefix
+
+    monkeypatch.setattr(linear_io, '_prefix_tile', broken_prefix)
+    path, array = png
+    with Image.open(path) as image:
+        assert np.array_equal(read_rows(image, 7), array[:7])
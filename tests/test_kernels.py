@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+from linear_kernels import fill_noise
+
+
+def _noise(seed, size, **options):
+    np.random.seed(seed)
+    flat = np.zeros(size, dtype=np.uint8)
+    fill_noise(flat, 5, **options)
+    return flat
+
+
+@pytest.mark.parametrize('bits', [ 1, 4, 8 ])
+def test_noise_does_not_depend_on_threads_or_chunks(bits):
+    expected = _noise(0, 100003, bits=bits)
+    assert not expected[:5].any()
+    assert expected.max() < 1 << bits
+    for threads, chunk_size in [ (4, 4096), (3, 1001), (1, 7) ]:
+        assert np.array_equal(_noise(0, 100003, bits=bits, threads=threads, chunk_size=chunk_size), expected)
+
+
+def test_noise_keeps_the_msb():
+    flat = np.full(1000, 0xA0, dtype=np.uint8)
+    fill_noise(flat, 0, bits=4)
+    assert np.all(flat & 0xF0 == 0xA0)
+    assert len(np.unique(flat)) == 16
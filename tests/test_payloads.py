@@ -0,0 +1,46 @@
+from PIL import Image
+import numpy as np
+import hashlib
+import gc
+import pytest
+import linear_payloads
+from linear_payloads import PreparedPayload, payload_cache, prepare
+
+
+@pytest.fixture
+def blake2b_calls(monkeypatch):
+    calls, blake2b = [], hashlib.blake2b
+
+    def counting_blake2b(*args, **kwargs):
+        calls.append(args)
+        return blake2b(*args, **kwargs)
+
+    payload_cache.clear()
+    monkeypatch.setattr(linear_payloads.hashlib, 'blake2b', counting_blake2b)
+    yield calls
+    payload_cache.clear()
+
+
+def _build(secret):
+    return PreparedPayload((1, ), np.zeros(1, dtype=np.uint8), 1)
+
+
+@pytest.mark.parametrize('make_secret', [
+    lambda a: Image.fromarray(a),
+    lambda a: a,
+], ids=[ 'image', 'array' ])
+def test_secret_hashed_once_per_object(blake2b_calls, make_secret):
+    secret = make_secret(np.random.default_rng(0).integers(0, 256, (64, 48, 3), dtype=np.uint8))
+    first = prepare(secret, ('test', ), _build)
+    second = prepare(secret, ('test', ), _build)
+    assert second is first
+    assert len(blake2b_calls) == 1
+
+
+def test_digest_dropped_with_its_secret(blake2b_calls):
+    secret = np.zeros((8, 8, 3), dtype=np.uint8)
+    prepare(secret, ('test', ), _build)
+    assert len(payload_cache.digests) == 1
+    del secret
+    gc.collect()
+    assert not payload_cache.digests
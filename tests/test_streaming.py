@@ -0,0 +1,28 @@
+from PIL import Image
+import numpy as np
+import pytest
+from linear_encoding_methods import LosslessEncoder, LossyEncoder
+from linear_streaming import stream_hide, stream_reveal
+
+
+def _random_image(shape, mode, seed):
+    return Image.fromarray(np.random.default_rng(seed).integers(0, 256, shape, dtype=np.uint8), mode)
+
+
+@pytest.mark.parametrize('method', [ LosslessEncoder, LossyEncoder ])
+def test_rgba_secret_streamed_as_in_memory(tmp_path, method):
+    # Only the RGB channels are hidden, the streamed and in memory layouts being the same
+    base = _random_image((200, 200, 3), 'RGB', 0)
+    secret = _random_image((50, 60, 4), 'RGBA', 1)
+    in_memory = np.asarray(method().hide(base, secret, add_noise=False, engrave_method=True))
+    stream_hide(method(), base, secret, str(tmp_path / 'streamed.png'), band_rows=16)
+    with Image.open(tmp_path / 'streamed.png') as streamed:
+        assert np.array_equal(np.asarray(streamed), in_memory)
+
+    with Image.open(tmp_path / 'streamed.png') as streamed:
+        stream_reveal(streamed, str(tmp_path / 'revealed.png'), band_rows=16)
+    expected = np.asarray(secret.convert('RGB'))
+    if method is LossyEncoder:
+        expected = expected & 0xF0
+    with Image.open(tmp_path / 'revealed.png') as revealed:
+        assert np.array_equal(np.asarray(revealed), expected)